@@ -0,0 +1,315 @@
+"""The (optional) in-memory access index.
+
+For deployments where the whole person/session mapping (for the configured
+proposal codes) fits comfortably in memory we periodically load it from ISPyB,
+in one streamed query, into a compact index that serves both
+'/target-access/{username}' and '/users/{tas}' without any upstream calls.
+
+Users and target access strings (TAS) are coded as integers. Each user has a
+sorted array of TAS codes and each TAS has an array of user codes. A new index
+(generation) is built alongside the one in use and then swapped in by
+replacing a single (module) reference.
+
+The index is built with its own query rather than the stored procedure we use
+for individual users, so before a new index is used the sets of a (random)
+sample of its users are compared with the stored procedure's, and an index
+that disagrees is not used. Users whose sets have changed since the previous
+index have their change published (by one of the workers).
+"""
+
+import bisect
+import logging
+import random
+import sys
+import threading
+import time
+from array import array
+from collections.abc import Iterable
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from pymemcache.client.retrying import RetryingClient
+
+from .common import (
+    get_index_change_key,
+    get_memcached_retrying_client,
+    publish_user_change,
+    utc_now,
+)
+from .config import Config
+from .ispyb_access import get_connector, get_tas_from_remote_ispyb
+from .tas_codec import get_tas_set_etag
+
+if TYPE_CHECKING:
+    from .remote_ispyb_connector import SSHConnector
+
+_LOGGER = logging.getLogger(__name__)
+
+# Every session membership.
+# The proposal code restriction is added when we have configured codes.
+_MEMBERSHIP_QUERY: str = (
+    "SELECT p.login, pr.proposalCode, pr.proposalNumber, bs.visit_number"
+    " FROM Session_has_Person shp"
+    " JOIN BLSession bs ON bs.sessionId = shp.sessionId"
+    " JOIN Proposal pr ON pr.proposalId = bs.proposalId"
+    " JOIN Person p ON p.personId = shp.personId"
+    " WHERE p.login IS NOT NULL"
+)
+
+# An index is not used if it is older than this number of refresh intervals
+# (i.e. we've been unable to build a new one for some time).
+_MAX_AGE_INTERVALS: int = 3
+
+
+class AccessIndex:
+    """A generation of the person/session mapping."""
+
+    def __init__(self, memberships: Iterable[tuple[str, str]]):
+        """Builds the index from (login, TAS) pairs."""
+        user_codes: dict[str, int] = {}
+        tas_codes: dict[str, int] = {}
+        user_tas_sets: list[set[int]] = []
+        tas_user_sets: list[set[int]] = []
+        for login, tas in memberships:
+            user_code: int | None = user_codes.get(login)
+            if user_code is None:
+                user_code = len(user_codes)
+                user_codes[sys.intern(login)] = user_code
+                user_tas_sets.append(set())
+            tas_code: int | None = tas_codes.get(tas)
+            if tas_code is None:
+                tas_code = len(tas_codes)
+                tas_codes[sys.intern(tas)] = tas_code
+                tas_user_sets.append(set())
+            user_tas_sets[user_code].add(tas_code)
+            tas_user_sets[tas_code].add(user_code)
+
+        self._user_codes: dict[str, int] = user_codes
+        self._tas_codes: dict[str, int] = tas_codes
+        # Code to value lookups (the codes are list indices)
+        self._users: list[str] = list(user_codes)
+        self._tas: list[str] = list(tas_codes)
+        self._user_tas: list[array] = [
+            array("I", sorted(codes)) for codes in user_tas_sets
+        ]
+        self._tas_users: list[array] = [
+            array("I", sorted(codes)) for codes in tas_user_sets
+        ]
+        self._user_etags: dict[str, str] = {}
+        self.built: datetime = utc_now()
+        self.num_memberships: int = sum(len(codes) for codes in self._user_tas)
+
+    @property
+    def num_users(self) -> int:
+        return len(self._users)
+
+    @property
+    def num_tas(self) -> int:
+        return len(self._tas)
+
+    @property
+    def users(self) -> list[str]:
+        return self._users
+
+    def sample_users(self, count: int) -> list[str]:
+        """A random sample of (up to count) users."""
+        return random.sample(self._users, min(count, len(self._users)))
+
+    def get_user_tas(self, username: str) -> set[str]:
+        """The TAS for a user. Users we do not know have none."""
+        user_code: int | None = self._user_codes.get(username)
+        if user_code is None:
+            return set()
+        tas: list[str] = self._tas
+        return {tas[code] for code in self._user_tas[user_code]}
+
+    def has_user_tas(self, username: str, tas: str) -> bool:
+        """True if a user is a member of a TAS (without building their set)."""
+        user_code: int | None = self._user_codes.get(username)
+        tas_code: int | None = self._tas_codes.get(tas)
+        if user_code is None or tas_code is None:
+            return False
+        codes: array = self._user_tas[user_code]
+        index: int = bisect.bisect_left(codes, tas_code)
+        return index < len(codes) and codes[index] == tas_code
+
+    def get_user_etag(self, username: str) -> str:
+        """The ETag of a user's TAS, calculated once (per index)."""
+        etag: str | None = self._user_etags.get(username)
+        if etag is None:
+            etag = get_tas_set_etag(self.get_user_tas(username))
+            self._user_etags[username] = etag
+        return etag
+
+    def get_tas_users(self, tas: str) -> set[str]:
+        """The users of a TAS. TAS we do not know have none."""
+        tas_code: int | None = self._tas_codes.get(tas)
+        if tas_code is None:
+            return set()
+        users: list[str] = self._users
+        return {users[code] for code in self._tas_users[tas_code]}
+
+
+# The index in use (None until the first one is built)
+_ACCESS_INDEX: AccessIndex | None = None
+
+
+def get_access_index() -> AccessIndex | None:
+    """The current index, or None if there isn't one
+    (or it's too old to be trusted).
+    """
+    access_index: AccessIndex | None = _ACCESS_INDEX
+    if access_index is None:
+        return None
+    max_age_s: int = _MAX_AGE_INTERVALS * Config.ACCESS_INDEX_REFRESH_SECONDS
+    if (utc_now() - access_index.built).total_seconds() > max_age_s:
+        return None
+    return access_index
+
+
+def _memberships(connector: "SSHConnector") -> Iterable[tuple[str, str]]:
+    """Streams (login, TAS) pairs from ISPyB, applying the same rules
+    we use for the records of an individual user.
+    """
+    query: str = _MEMBERSHIP_QUERY
+    args: list[str] | None = None
+    if Config.TAS_CODES_SET:
+        args = sorted(Config.TAS_CODES_SET)
+        query += f" AND pr.proposalCode IN ({', '.join(['%s'] * len(args))})"
+    for login, code, proposal_number, visit_number in connector.call_query_stream(
+        query, args
+    ):
+        pc_str: str = f"{code}" if code else ""
+        pn_str: str = f"{proposal_number}"
+        sn_str: str = f"{visit_number}"
+        if not pc_str or not pn_str.isdigit() or not sn_str.isdigit():
+            continue
+        if int(pn_str) and int(sn_str):
+            yield login, f"{pc_str}{pn_str}-{sn_str}"
+
+
+def _verify(access_index: AccessIndex, connector: "SSHConnector") -> bool:
+    """Compares the sets of a sample of the index's users with those of the
+    ISPyB stored procedure, returning False if any disagree (or cannot be
+    collected).
+    """
+    for username in access_index.sample_users(Config.ACCESS_INDEX_VERIFY_USERS):
+        tas_set: set[str] | None = get_tas_from_remote_ispyb(
+            username=username, ssh_connector=connector
+        )
+        if tas_set is None:
+            _LOGGER.warning("Cannot verify the access index (for '%s')", username)
+            return False
+        indexed_tas_set: set[str] = access_index.get_user_tas(username)
+        if tas_set != indexed_tas_set:
+            _LOGGER.error(
+                "Access index disagrees with ISPyB for '%s' (missing=%s extra=%s)",
+                username,
+                sorted(tas_set - indexed_tas_set),
+                sorted(indexed_tas_set - tas_set),
+            )
+            return False
+    return True
+
+
+def _publish_changes(old_index: AccessIndex, new_index: AccessIndex) -> int:
+    """Publishes the change of each user whose set differs between two indexes,
+    unless another worker has, returning the number of changes we published.
+    """
+    if Config.CHANGE_EVENT_RETENTION_SECONDS <= 0:
+        return 0
+    num_published: int = 0
+    client: RetryingClient = get_memcached_retrying_client()
+    try:
+        for username in set(old_index.users).union(new_index.users):
+            old_tas: set[str] = old_index.get_user_tas(username)
+            new_tas: set[str] = new_index.get_user_tas(username)
+            if old_tas == new_tas:
+                continue
+            etag: str = new_index.get_user_etag(username)
+            if client.add(
+                get_index_change_key(username, etag),
+                utc_now(),
+                expire=max(1, Config.ACCESS_INDEX_REFRESH_SECONDS),
+                noreply=False,
+            ):
+                publish_user_change(client, username, old_tas, new_tas, etag)
+                num_published += 1
+    finally:
+        client.close()
+    return num_published
+
+
+def load_access_index() -> bool:
+    """Builds a new index from ISPyB and, if it agrees with the stored procedure,
+    swaps it in (publishing the changes since the previous index).
+    """
+    global _ACCESS_INDEX  # pylint: disable=global-statement
+    # pylint: disable=import-outside-toplevel
+    import ispyb
+    import pymysql
+
+    connector: SSHConnector | None = get_connector()
+    if not connector:
+        _LOGGER.warning("No SSH connector - cannot load the access index")
+        return False
+
+    start: float = time.monotonic()
+    try:
+        access_index: AccessIndex = AccessIndex(_memberships(connector))
+        verified: bool = _verify(access_index, connector)
+    except (pymysql.MySQLError, ispyb.ISPyBException) as err:
+        _LOGGER.warning("%s loading the access index (%s)", err.__class__.__name__, err)
+        return False
+    finally:
+        connector.stop()
+    if not verified:
+        # Requests fall back to the cache (and the stored procedure)
+        _ACCESS_INDEX = None
+        return False
+
+    old_index: AccessIndex | None = _ACCESS_INDEX
+    _ACCESS_INDEX = access_index
+    _LOGGER.info(
+        "Loaded access index in %.1fs (users=%d tas=%d memberships=%d)",
+        time.monotonic() - start,
+        access_index.num_users,
+        access_index.num_tas,
+        access_index.num_memberships,
+    )
+    if old_index:
+        try:
+            num_published: int = _publish_changes(old_index, access_index)
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            _LOGGER.warning("Unexpected %s publishing index changes", repr(ex))
+        else:
+            _LOGGER.info("Published %d access index change(s)", num_published)
+    return True
+
+
+class AccessIndexLoader:
+    """A (daemon) thread that loads the index now, and then at the given interval."""
+
+    def __init__(self, interval_s: int):
+        self._interval_s: int = interval_s
+        self._stop_event: threading.Event = threading.Event()
+        self._thread: threading.Thread = threading.Thread(
+            target=self._run, name="access-index-loader", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._thread.join(timeout=5)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                load_access_index()
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                # Never let the thread die
+                _LOGGER.warning("Unexpected %s loading the access index", repr(ex))
+            if self._stop_event.wait(self._interval_s):
+                break
@@ -0,0 +1,200 @@
+"""Admission control for upstream (ISPyB) work.
+
+Each ISPyB operation (an SSH tunnel and a MySQL session) started by a request
+must first be admitted. A process admits at most the configured number of
+operations at once, and a bounded number of requests can wait (up to a timeout,
+or their deadline) for one to finish. Requests beyond that are rejected
+immediately, so under overload we fail (or serve what we have cached) quickly
+rather than pile up work on ISPyB.
+
+An optional pod-wide limit is shared through the cache: an admitted operation
+also has to 'add' one of a fixed number of slot keys, each of which expires
+(so a slot is not lost if its process dies).
+
+Each process keeps its number of in-flight operations and waiting requests
+in a small shared-memory file, so the stats can add them up for every worker.
+"""
+
+import logging
+import mmap
+import os
+import random
+import threading
+from collections.abc import Iterator
+from contextlib import AbstractContextManager, contextmanager
+
+from pymemcache.client.retrying import RetryingClient
+
+from .common import (
+    UPSTREAM_REJECTED_COUNTER_KEY,
+    UPSTREAM_SLOT_KEY_PREFIX,
+    get_memcached_retrying_client,
+)
+from .config import Config
+from .counters import incr_counter
+from .deadline import Deadline, get_deadline
+from .prometheus_metrics import PrometheusMetrics
+from .shared_memory import create_worker_mmap, read_worker_files, remove_worker_file
+
+_LOGGER = logging.getLogger(__name__)
+
+# The (64-bit) number of in-flight operations and of waiting requests
+_GAUGES_SIZE: int = 2 * 8
+_GAUGES_SUFFIX: str = ".upstream"
+
+
+class AdmissionRejected(Exception):
+    """Raised when upstream work cannot be admitted (we're overloaded)."""
+
+
+def _acquire_pod_slot() -> str | None:
+    """Adds one of the pod's slot keys, returning the key (or None if they're
+    all held). Slots are tried in a random order to reduce contention.
+    """
+    client: RetryingClient = get_memcached_retrying_client()
+    try:
+        slots: list[int] = list(range(Config.UPSTREAM_POD_MAX_CONCURRENCY))
+        random.shuffle(slots)
+        for slot in slots:
+            key: str = f"{UPSTREAM_SLOT_KEY_PREFIX}{slot}"
+            if client.add(
+                key,
+                os.getpid(),
+                expire=Config.UPSTREAM_POD_SLOT_SECONDS,
+                noreply=False,
+            ):
+                return key
+    finally:
+        client.close()
+    return None
+
+
+def _release_pod_slot(key: str) -> None:
+    client: RetryingClient = get_memcached_retrying_client()
+    try:
+        client.delete(key)
+    finally:
+        client.close()
+
+
+class AdmissionController:
+    """Limits the number of concurrent upstream operations (in a process)."""
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self._slots: threading.BoundedSemaphore = threading.BoundedSemaphore(
+            max(1, max_concurrency)
+        )
+        self._max_queue: int = max_queue
+        self._lock: threading.Lock = threading.Lock()
+        self._in_flight: int = 0
+        self._waiting: int = 0
+        # The shared-memory gauges (created when first needed)
+        self._mmap: mmap.mmap | None = None
+        self._path: str | None = None
+        self._gauges: memoryview | None = None
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        _LOGGER.warning("Rejected upstream work (%s)", reason)
+        incr_counter(UPSTREAM_REJECTED_COUNTER_KEY)
+        PrometheusMetrics.new_upstream_rejection()
+        return AdmissionRejected(reason)
+
+    def _set_gauges(self) -> None:
+        """Publishes the in-flight operations and waiting requests.
+        Called with the lock held.
+        """
+        if self._gauges is None:
+            self._mmap, self._path = create_worker_mmap(_GAUGES_SUFFIX, _GAUGES_SIZE)
+            self._gauges = memoryview(self._mmap).cast("q")
+        self._gauges[0] = self._in_flight
+        self._gauges[1] = self._waiting
+        PrometheusMetrics.set_upstream_in_flight(self._in_flight)
+        PrometheusMetrics.set_upstream_queue_depth(self._waiting)
+
+    def close(self) -> None:
+        """Removes the shared-memory gauges."""
+        with self._lock:
+            if self._gauges is not None and self._mmap is not None:
+                self._gauges.release()
+                self._mmap.close()
+                remove_worker_file(self._path)
+                self._gauges = None
+                self._mmap = None
+
+    def _wait_for_slot(self) -> None:
+        """Waits (if there's room in the queue) for a slot,
+        raising AdmissionRejected if we can't have one.
+        """
+        with self._lock:
+            if self._waiting >= self._max_queue:
+                raise self._reject("queue full")
+            self._waiting += 1
+            self._set_gauges()
+        timeout_s: float = Config.UPSTREAM_QUEUE_TIMEOUT_SECONDS
+        deadline: Deadline | None = get_deadline()
+        if deadline:
+            timeout_s = min(timeout_s, deadline.remaining_s())
+        try:
+            acquired: bool = timeout_s > 0 and self._slots.acquire(timeout=timeout_s)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                self._set_gauges()
+        if not acquired:
+            if deadline and deadline.remaining_s() <= 0:
+                deadline.exhausted = True
+            raise self._reject("queue timeout")
+
+    def _set_in_flight(self, change: int) -> None:
+        with self._lock:
+            self._in_flight += change
+            self._set_gauges()
+
+    @contextmanager
+    def admit(self) -> Iterator[None]:
+        """Admits the upstream work done in the 'with' block,
+        or raises AdmissionRejected.
+        """
+        if not self._slots.acquire(blocking=False):
+            self._wait_for_slot()
+        pod_slot_key: str | None = None
+        try:
+            if Config.UPSTREAM_POD_MAX_CONCURRENCY > 0:
+                pod_slot_key = _acquire_pod_slot()
+                if pod_slot_key is None:
+                    raise self._reject("pod limit")
+            self._set_in_flight(1)
+            try:
+                yield
+            finally:
+                self._set_in_flight(-1)
+        finally:
+            if pod_slot_key:
+                _release_pod_slot(pod_slot_key)
+            self._slots.release()
+
+
+_ADMISSION_CONTROLLER: AdmissionController = AdmissionController(
+    Config.UPSTREAM_MAX_CONCURRENCY, Config.UPSTREAM_MAX_QUEUE
+)
+
+
+def upstream_admission() -> AbstractContextManager:
+    """Admission (for this process) of upstream work."""
+    return _ADMISSION_CONTROLLER.admit()
+
+
+def close_upstream_admission() -> None:
+    """Removes this process's (shared-memory) admission gauges."""
+    _ADMISSION_CONTROLLER.close()
+
+
+def get_upstream_gauges() -> tuple[int, int]:
+    """The in-flight operations and waiting requests of every running worker."""
+    in_flight: int = 0
+    waiting: int = 0
+    for data in read_worker_files(_GAUGES_SUFFIX, _GAUGES_SIZE):
+        values: memoryview = memoryview(data).cast("q")
+        in_flight += values[0]
+        waiting += values[1]
+    return in_flight, waiting
@@ -1,17 +1,21 @@
-"""The entrypoint for the Fragalysis Stack FastAPI ISPyB Target Access Authenticator."""
+"""The entrypoint for the Fragalysis Stack FastAPI ISPyB Target Access Authenticator.
+
+Importing this module does no work beyond defining the apps. Logging,
+counter resets and any (mock) data are set up when an app starts (in its
+lifespan) and modules that are slow to import are imported when first needed,
+so workers start quickly.
+"""
 
-import json
 import logging
 import multiprocessing
+from collections import Counter
+from collections.abc import AsyncIterator, Callable, Iterator
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
-from logging.config import dictConfig
+from functools import cache, partial
 from typing import Annotated, Any
 from urllib.parse import quote
 
-import ispyb
-import pymysql
-import sshtunnel
-import yaml
 from fastapi import (
     FastAPI,
     Header,
@@ -19,44 +23,180 @@ from fastapi import (
     Response,
     status,
 )
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from pymemcache.client.retrying import RetryingClient
 
+from .access_index import AccessIndex, AccessIndexLoader, get_access_index
+from .admission import (
+    AdmissionRejected,
+    close_upstream_admission,
+    upstream_admission,
+)
+from .change_events import change_event_stream
+from .change_poller import ChangePoller
 from .common import (
+    CHANGE_POLL_USER_COUNTER_KEY,
     ISPYB_PING_COUNTER_KEY,
     ISPYB_QUERY_COUNTER_KEY,
+    MAX_ENCODED_USERNAME_LENGTH,
     PING_CACHE_KEY,
     PING_CACHE_TIMESTAMP_KEY,
     PING_COUNTER_KEY,
     PING_STATUS_CHANGE_TIMESTAMP_KEY,
     QUERY_COUNTER_KEY,
-    get_encoded_username_timestamp_key,
+    REFRESH_CHANGED_COUNTER_KEY,
+    REFRESH_LEASE_CONTENDED_COUNTER_KEY,
+    REFRESH_LEASE_TAKEOVER_COUNTER_KEY,
+    REFRESH_UNCHANGED_COUNTER_KEY,
+    UPSTREAM_REJECTED_COUNTER_KEY,
+    UserTasRecord,
+    UserTimestamp,
+    check_cache_tas_codes,
+    configure_logging,
     get_memcached_retrying_client,
+    get_user_response_body,
+    get_user_tas_membership,
+    get_user_tas_record,
+    get_user_timestamp,
+    invalidate_users,
+    new_cache_generation,
+    publish_change_event,
+    publish_user_change,
+    set_user_tas,
     split_tas,
+    user_cache_expiry_s,
+    user_cache_life_s,
     utc_now,
     valid_encoded_username,
 )
 from .config import Config
-from .remote_ispyb_connector import SSHConnector
-from .stats import get_statistics
-
-# Configure logging
-print("Configuring logging...")
-_LOGGING_CONFIG: dict[str, Any] = {}
-with open("logging.config", "r", encoding="utf8") as stream:
-    try:
-        _LOGGING_CONFIG = json.loads(stream.read())
-    except json.decoder.JSONDecodeError as exc:
-        print(exc)
-dictConfig(_LOGGING_CONFIG)
-print("Configured logging.")
+from .counters import CounterFlusher, incr_counter
+from .deadline import Deadline, deadline_scope, new_deadline
+from .ispyb_access import (
+    CONNECTOR_CONFIGURED,
+    get_connector,
+    get_tas_from_remote_ispyb,
+    get_users_from_remote_ispyb,
+    log_connector_configuration,
+)
+from .msgpack_codec import MSGPACK_MEDIA_TYPE, packb, wants_msgpack
+from .prewarm import record_requested_users
+from .refresh_lease import (
+    acquire_refresh_lease,
+    release_refresh_lease,
+    take_over_refresh_lease,
+    wait_for_refresh,
+)
+from .rolling_stats import RollingStatsMiddleware, close_rolling_stats
+from .shared_memory import claim_pod_startup
+from .tas_codec import get_tas_set_etag
+from .timing import TimingMiddleware, timed
 
 _LOGGER = logging.getLogger(__name__)
 
+# Serialises this process's cache reads and writes. It's released while we wait
+# for ISPyB (limited by the admission controller) or for another worker.
 _SEMAPHORE = multiprocessing.Semaphore()
 
-auth = FastAPI()
-stats = FastAPI()
+
+@contextmanager
+def _semaphore_released() -> Iterator[None]:
+    """Releases the (held) _SEMAPHORE for the code in the 'with' block,
+    so our other requests are not held up while we wait (for ISPyB,
+    or another worker).
+    """
+    _SEMAPHORE.release()
+    try:
+        yield
+    finally:
+        _SEMAPHORE.acquire()
+
+
+# The number of requests for each user (in this process).
+# Written to the prewarm 'top users' file when we shut down.
+_REQUESTED_USERS: Counter = Counter()
+
+
+def _startup() -> None:
+    """Work done once for each pod (by the first worker to start, the one that
+    creates the pod's startup marker). Clears the counters, starts a new
+    cache generation if the proposal codes have changed
+    and (optionally) injects mock data.
+    """
+    if not claim_pod_startup():
+        _LOGGER.debug("Startup already done (by another worker)")
+        return
+
+    client: RetryingClient = get_memcached_retrying_client()
+    assert client
+    _LOGGER.info("Running startup...")
+    # Forget every user's set if it was collected with different proposal codes
+    # (normally already done by the prewarm)
+    check_cache_tas_codes(client)
+
+    # Inject some mock data for "dave lister"?
+    if Config.ENABLE_DAVE_LISTER:
+        set_user_tas(client, quote("dave lister"), set(["sb99999-9"]), utc_now())
+
+    # Clear counter/stats values
+    # We count the number of ping calls and query calls
+    client.set(PING_COUNTER_KEY, 0)
+    client.set(ISPYB_PING_COUNTER_KEY, 0)
+    client.set(QUERY_COUNTER_KEY, 0)
+    client.set(ISPYB_QUERY_COUNTER_KEY, 0)
+    client.set(CHANGE_POLL_USER_COUNTER_KEY, 0)
+    client.set(UPSTREAM_REJECTED_COUNTER_KEY, 0)
+    client.set(REFRESH_CHANGED_COUNTER_KEY, 0)
+    client.set(REFRESH_UNCHANGED_COUNTER_KEY, 0)
+    client.set(REFRESH_LEASE_CONTENDED_COUNTER_KEY, 0)
+    client.set(REFRESH_LEASE_TAKEOVER_COUNTER_KEY, 0)
+    client.close()
+
+
+@asynccontextmanager
+async def _auth_lifespan(_: FastAPI) -> AsyncIterator[None]:
+    """Runs the (once per pod) startup, starts the counter flusher and the
+    (optional) change poller and access index loader, and records
+    the most-requested users when the auth app shuts down.
+    """
+    configure_logging()
+    log_connector_configuration()
+    _startup()
+
+    counter_flusher: CounterFlusher = CounterFlusher(Config.COUNTER_FLUSH_SECONDS)
+    counter_flusher.start()
+
+    change_poller: ChangePoller | None = None
+    if Config.CHANGE_POLL_INTERVAL_SECONDS > 0 and CONNECTOR_CONFIGURED:
+        change_poller = ChangePoller(Config.CHANGE_POLL_INTERVAL_SECONDS)
+        change_poller.start()
+    access_index_loader: AccessIndexLoader | None = None
+    if Config.ACCESS_INDEX_REFRESH_SECONDS > 0 and CONNECTOR_CONFIGURED:
+        access_index_loader = AccessIndexLoader(Config.ACCESS_INDEX_REFRESH_SECONDS)
+        access_index_loader.start()
+    yield
+    if change_poller:
+        change_poller.stop()
+    if access_index_loader:
+        access_index_loader.stop()
+    counter_flusher.stop()
+    close_rolling_stats()
+    close_upstream_admission()
+    record_requested_users(_REQUESTED_USERS)
+
+
+@asynccontextmanager
+async def _stats_lifespan(_: FastAPI) -> AsyncIterator[None]:
+    """Configures logging for the stats app."""
+    configure_logging()
+    yield
+
+
+auth = FastAPI(lifespan=_auth_lifespan)
+auth.add_middleware(TimingMiddleware)
+auth.add_middleware(RollingStatsMiddleware)
+stats = FastAPI(lifespan=_stats_lifespan)
 
 _VERSION_KIND: str = "ISPYB"
 _VERSION_NAME: str = "XChem Python FastAPI TAS Authenticator"
@@ -67,30 +207,14 @@ _VERSION_NAME: str = "XChem Python FastAPI TAS Authenticator"
 # This UTC is recorded against the key 'timestamp-{url-encoded-username}'.
 # If the timestamp of the cache has expired we try and collect a new set of
 # target access strings. if that fails we return the existing cache.
-_MAX_USER_CACHE_AGE: timedelta = timedelta(minutes=Config.CACHE_EXPIRY_MINUTES)
 _MAX_PING_CACHE_AGE: timedelta = timedelta(seconds=Config.PING_CACHE_EXPIRY_SECONDS)
 
 
-# Do we have sufficient configuration for an SSH connector?
-_SSH_CONNECTOR_CONFIGURED: bool = False
-if (
-    Config.ISPYB_HOST
-    and Config.ISPYB_PORT
-    and Config.ISPYB_USER
-    and Config.ISPYB_PASSWORD
-    and Config.SSH_HOST
-    and Config.SSH_USER
-    and (Config.SSH_PRIVATE_KEY_FILENAME or Config.SSH_PASSWORD)
-):
-    # Create a connector
-    _SSH_CONNECTOR_CONFIGURED = True
-    _LOGGER.info("Config OK - Can establish ISPyB connections")
-else:
-    _LOGGER.warning("Insufficient configuration to establish ISPyB connections")
-
-# Get our version (from the 'VERSION' file)
-with open("VERSION", "r", encoding="utf-8") as version_file:
-    _VERSION: str = version_file.read().strip()
+@cache
+def _get_version() -> str:
+    """Our version (from the 'VERSION' file), read once."""
+    with open("VERSION", "r", encoding="utf-8") as version_file:
+        return version_file.read().strip()
 
 
 class TargetAccessGetVersionResponse(BaseModel):
@@ -120,6 +244,13 @@ class TargetAccessGetUserTasResponse(BaseModel):
     target_access: set[str]
 
 
+class TargetAccessGetUserTasMemberResponse(BaseModel):
+    """/target-access/{username}/{tas} GET response."""
+
+    # True if the user has access to the Target Access string
+    access: bool
+
+
 class TargetAccessGetTasUsersResponse(BaseModel):
     """/users/{tas} GET response."""
 
@@ -129,193 +260,43 @@ class TargetAccessGetTasUsersResponse(BaseModel):
     users: set[str]
 
 
-def _get_connector() -> SSHConnector | None:
-    """Tries to create an SSHConnector(), which may fail."""
-    conn: SSHConnector | None = None
-    if _SSH_CONNECTOR_CONFIGURED:
-        _LOGGER.debug("Creating SSHConnector() for '%s'..", Config.SSH_HOST)
-        try:
-            conn = SSHConnector()
-        except ispyb.ConnectionError:
-            # The ISPyB connection failed.
-            # Nothing else to do here, metrics are already updated
-            _LOGGER.warning("ISPyB connection failure")
-        except sshtunnel.BaseSSHTunnelForwarderError:
-            _LOGGER.warning("Failed to establish a connector")
-    else:
-        _LOGGER.debug("Insufficient configuration to create a connector")
+class TargetAccessInvalidateRequest(BaseModel):
+    """/target-access/invalidate POST request."""
 
-    return conn
+    # Users to invalidate
+    usernames: set[str] = set()
+    # Target Access strings whose users (members) are to be invalidated
+    tas: set[str] = set()
+    # Invalidate every user (by starting a new cache generation)
+    all: bool = False  # pylint: disable=redefined-builtin
 
 
-def _get_tas_from_remote_ispyb(username: str) -> set[str] | None:
-    """Gets the user's proposal. It returns None on error, an empty set if
-    there are no proposals or a set of proposals.
-    """
-    assert username
-
-    ssh_connector: SSHConnector | None = _get_connector()
-    if not ssh_connector:
-        _LOGGER.warning("No SSH connector for user '%s'", username)
-        return None
-
-    prop_id_set: set[str] = set()
-    rs: list[dict[str, Any]] | None = None
-    try:
-        rs = ssh_connector.core.retrieve_sessions_for_person_login(username)
-    except ispyb.NoResult:
-        _LOGGER.debug("ispyb.NoResult for user '%s'", username)
-        rs = []
-    # Request done, always stop the server
-    if ssh_connector.server:
-        ssh_connector.server.stop()
-
-    # Anything to process?
-    if rs is None:
-        return None
-    if not rs:
-        _LOGGER.debug("No results for user '%s'", username)
-        return prop_id_set
-
-    # Typically you'll find the following fields in each item
-    # in the rs response: -
-    #
-    #    'id': 0000000,
-    #    'proposalId': 00000,
-    #    'startDate': datetime.datetime(2022, 12, 1, 15, 56, 30)
-    #    'endDate': datetime.datetime(2022, 12, 3, 18, 34, 9)
-    #    'beamline': 'i00-0'
-    #    'proposalCode': 'lb'
-    #    'proposalNumber': '12345'
-    #    'sessionNumber': 1
-    #    'comments': None
-    #    'personRoleOnSession': 'Data Access'
-    #    'personRemoteOnSession': 1
-    #
-    # Codes are expected to consist of 2 letters.
-    # Typically: lb, mx, nt, nr, sw, bi.
-    # The codes we collect are defined in Config.TAS_CODES_SET.
-    # If this is not set (is blank) we collect all codes.
-    #
-    # The resultant strings should correspond to a title value in a Project record.
-    # We only return records where there is a sessionNumber,
-    # and we should get this sort of set: -
-    #
-    #       {"lb12345-20", "lb12345-22"}
-    #                       --      --
-    #                        | ----- |
-    #                     Code   |   Session
-    #                         Proposal
-    for record in rs:
-        if "proposalCode" in record:
-            pc_str = f'{record["proposalCode"]}'
-            if not pc_str:
-                continue
-            if not Config.TAS_CODES_SET or pc_str in Config.TAS_CODES_SET:
-                pn_str = f'{record["proposalNumber"]}'
-                sn_str = f'{record["sessionNumber"]}'
-                # We'll use these values if they represent integers...
-                pn_int = None
-                sn_int = None
-                try:
-                    pn_int = int(pn_str)
-                    sn_int = int(sn_str)
-                except ValueError:
-                    _LOGGER.debug(
-                        "Proposal or session is not a number (%s, %s)", pn_str, sn_str
-                    )
-                if pn_int and sn_int:
-                    # OK - add "<code><proposalNum>-<sessionNum>"
-                    prop_id_set.add(f"{pc_str}{pn_str}-{sn_str}")
-
-    # Display the collected results for the user.
-    # These will be cached.
-    count = len(prop_id_set)
-    _LOGGER.debug(
-        "%s proposals from %s records for '%s': %s",
-        count,
-        len(rs),
-        username,
-        prop_id_set,
-    )
-    return prop_id_set
-
+class TargetAccessInvalidateResponse(BaseModel):
+    """/target-access/ invalidation (DELETE and POST) response."""
 
-def _get_users_from_remote_ispyb(
-    code: str, proposal_number: str, visit_number: str
-) -> set[str] | None:
-    """Gets the users (logins) that are members of a proposal visit.
-    It returns None if ISPyB cannot be reached at all, an empty set if the
-    visit has no members, is not known, or the query itself failed, and
-    otherwise a set of logins.
+    # Number of users invalidated
+    count: int
+    # The users invalidated
+    usernames: set[str]
+    # The new cache generation (when every user is invalidated)
+    generation: int | None = None
+
+
+def _try_memcached_client_get(
+    client: RetryingClient,
+    key: str,
+    getter: Callable[[RetryingClient, str], Any] | None = None,
+) -> Any:
+    """Common memcached get() logic, handling expected exceptions.
+    A getter can be provided for values that are not simply client.get().
     """
-    ssh_connector: SSHConnector | None = _get_connector()
-    if not ssh_connector:
-        _LOGGER.warning(
-            "No SSH connector for '%s%s-%s'", code, proposal_number, visit_number
-        )
-        return None
-
-    rs: list[dict[str, Any]] = []
-    try:
-        rs = ssh_connector.core.retrieve_persons_for_session(
-            code, proposal_number, visit_number
-        )
-    except ispyb.NoResult:
-        _LOGGER.debug(
-            "ispyb.NoResult for '%s%s-%s'", code, proposal_number, visit_number
-        )
-    except (pymysql.MySQLError, ispyb.ISPyBException) as ispyb_err:
-        # The query failed - typically because our database account is not
-        # permitted to execute the stored procedure. We treat this as "no
-        # members" (the caller gets an empty set), but it is an operational
-        # problem so it is logged as a warning rather than passed over.
-        _LOGGER.warning(
-            "%s calling retrieve_persons_for_session for '%s%s-%s' (%s)",
-            ispyb_err.__class__.__name__,
-            code,
-            proposal_number,
-            visit_number,
-            ispyb_err,
-        )
-    finally:
-        # Request done, always stop the server
-        if ssh_connector.server:
-            ssh_connector.server.stop()
-
-    # Each record is expected to look like this,
-    # and it is the 'login' we return: -
-    #
-    #   'familyName': 'Dave'
-    #   'givenName': 'Lister'
-    #   'login': 'abc12345'
-    #   'role': 'Principal Investigator'
-    #   'title': None
-    #
-    # Records without a login are of no use to the caller (the login is the
-    # value the stack knows a user by), so they are dropped.
-    user_set: set[str] = {record["login"] for record in rs if record.get("login")}
-
-    _LOGGER.debug(
-        "%s users from %s records for '%s%s-%s': %s",
-        len(user_set),
-        len(rs),
-        code,
-        proposal_number,
-        visit_number,
-        user_set,
-    )
-    return user_set
-
-
-def _try_memcached_client_get(client: RetryingClient, key: str) -> Any:
-    """Common memcached get() logic, handling expected exceptions."""
     response: Any = None
     err: str | None = None
     err_msg: str | None = None
 
     try:
-        response = client.get(key)
+        with timed("memcached"):
+            response = getter(client, key) if getter else client.get(key)
     except AssertionError as a_err:
         err = a_err.__class__.__name__
         err_msg = str(a_err)
@@ -335,27 +316,6 @@ def _try_memcached_client_get(client: RetryingClient, key: str) -> Any:
     return response
 
 
-# Inject some mock data for "dave lister"?
-if Config.ENABLE_DAVE_LISTER:
-    _DUMMY_USER: str = quote("dave lister")
-    dummy_user_client: RetryingClient = get_memcached_retrying_client()
-    assert dummy_user_client
-    dummy_user_client.set(_DUMMY_USER, set(["sb99999-9"]))
-    dummy_user_client.set(get_encoded_username_timestamp_key(_DUMMY_USER), utc_now())
-    dummy_user_client.close()
-
-
-# Clear counter/stats values
-# We count the number of ping calls and query calls
-counter_client: RetryingClient = get_memcached_retrying_client()
-assert counter_client
-counter_client.set(PING_COUNTER_KEY, 0)
-counter_client.set(ISPYB_PING_COUNTER_KEY, 0)
-counter_client.set(QUERY_COUNTER_KEY, 0)
-counter_client.set(ISPYB_QUERY_COUNTER_KEY, 0)
-counter_client.close()
-
-
 # Endpoints (in-cluster) for the ISPyP Authenticator -----------------------------------
 
 
@@ -365,7 +325,7 @@ def get_taa_version() -> TargetAccessGetVersionResponse:
     return TargetAccessGetVersionResponse(
         kind=_VERSION_KIND,
         name=_VERSION_NAME,
-        version=_VERSION,
+        version=_get_version(),
     )
 
 
@@ -379,7 +339,7 @@ def ping():
     with _SEMAPHORE:
         client: RetryingClient = get_memcached_retrying_client()
         assert client
-        client.incr(PING_COUNTER_KEY, 1)
+        incr_counter(PING_COUNTER_KEY)
 
         # Current ping state (in the cache)
         # we do this so we can log changes.
@@ -397,13 +357,21 @@ def ping():
             or now - ping_cache_timestamp > _MAX_PING_CACHE_AGE
         ):
             _LOGGER.debug("ping cache value is too old - refreshing...")
-            if ssh_connector := _get_connector():
-                assert ssh_connector.server
-                ssh_connector.server.stop()
-                status_str = "OK"
-            client.incr(ISPYB_PING_COUNTER_KEY, 1)
-            client.set(PING_CACHE_KEY, status_str)
-            client.set(PING_CACHE_TIMESTAMP_KEY, now)
+            try:
+                # Our other requests can use the cache while we wait for ISPyB
+                # (the admission controller limits our ISPyB operations)
+                with _semaphore_released(), upstream_admission():
+                    if ssh_connector := get_connector():
+                        ssh_connector.stop()
+                        status_str = "OK"
+            except AdmissionRejected:
+                # We're too busy to ping ISPyB (which suggests it's working).
+                # Keep the current status, and try again next time.
+                status_str = pre_ping_status or status_str
+            else:
+                incr_counter(ISPYB_PING_COUNTER_KEY)
+                client.set(PING_CACHE_KEY, status_str)
+                client.set(PING_CACHE_TIMESTAMP_KEY, now)
         else:
             # Ping has not expired and should be set to something...
             status_str = pre_ping_status
@@ -417,14 +385,281 @@ def ping():
     return TargetAccessGetPingResponse(ping=status_str)
 
 
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """True if an If-None-Match header value matches our ETag.
+    If-None-Match uses the 'weak' comparison, so any 'W/' prefix is ignored.
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == f'"{etag}"':
+            return True
+    return False
+
+
+def _representation_etag(etag: str, msgpack: bool) -> str:
+    """The ETag of a set's JSON or MessagePack representation.
+    (different representations must have different ETags).
+    """
+    return f"{etag}-msgpack" if msgpack else etag
+
+
+def _cache_headers(etag: str | None, max_age_s: int) -> dict[str, str]:
+    """The ETag, Cache-Control and Vary headers for a response.
+    Without an ETag (nothing is cached) the response should not be cached either.
+    """
+    if etag is None:
+        return {"Cache-Control": "no-cache", "Vary": "Accept"}
+    return {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"max-age={max(0, max_age_s)}",
+        "Vary": "Accept",
+    }
+
+
+def _request_deadline(x_request_timeout: str | None) -> Deadline | None:
+    """The deadline for a request's upstream work (if it has one)."""
+    try:
+        return new_deadline(x_request_timeout)
+    except ValueError as v_err:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid X-Request-Timeout ('{x_request_timeout}')",
+        ) from v_err
+
+
+def _negotiated_response(
+    model: BaseModel, response: Response, headers: dict[str, str], msgpack: bool
+) -> Any:
+    """Returns the model as a MessagePack response, or (for JSON)
+    the model itself, with the headers added to the response.
+    """
+    if msgpack:
+        with timed("serialize"):
+            content: bytes = packb(model.model_dump())
+        return Response(
+            content=content,
+            media_type=MSGPACK_MEDIA_TYPE,
+            headers=headers,
+        )
+    response.headers.update(headers)
+    return model
+
+
+def _check_username(username: str) -> str:
+    """The (url-encoded) cache key of a username, raising an HTTPException
+    if it's not a name we can cache.
+    """
+    # FastAPI decodes url-encoded strings and memcached keys cannot contain spaces
+    # so we need to re-encode the username for cache lookup.
+    # memcached has a key size limit of 250 characters,
+    # some of which are used by the key's namespace.
+    encoded_username: str = quote(username)
+    if not valid_encoded_username(encoded_username):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Encoded username is empty or exceeds"
+            f" {MAX_ENCODED_USERNAME_LENGTH} characters",
+        )
+    return encoded_username
+
+
+def _refresh_user_tas(
+    client: RetryingClient,
+    username: str,
+    encoded_username: str,
+    existing_cache: UserTasRecord | None,
+    user_timestamp: UserTimestamp | None,
+    now: datetime,
+    deadline: Deadline | None,
+) -> tuple[set[str], str | None, int]:
+    """Refreshes a user's TAS set (from ISPyB), returning it, its ETag
+    (None if it's not cached) and its life (seconds). If it cannot be refreshed
+    any (expired) cached set is returned, otherwise an HTTPException (a 503)
+    is raised if the deadline was exhausted (or we're overloaded)
+    and an empty set is returned if ISPyB failed.
+    Called with the _SEMAPHORE held, which is released while ISPyB is queried.
+    """
+    user_cache: set[str] = set()
+    # The ETag of the set, and its remaining life (if it's cached)
+    user_etag: str | None = None
+    max_age_s: int = 0
+    _LOGGER.debug("Attempting to refresh the cache for '%s'...", username)
+    remote_tas_set: set[str] | None = None
+    rejected: bool = False
+    with deadline_scope(deadline):
+        try:
+            # Our other requests can use the cache while we wait for ISPyB
+            # (the admission controller limits our ISPyB operations)
+            with _semaphore_released(), upstream_admission():
+                remote_tas_set = get_tas_from_remote_ispyb(username=username)
+            # Always increment the query count
+            incr_counter(ISPYB_QUERY_COUNTER_KEY)
+        except AdmissionRejected:
+            rejected = True
+    # Did we get anything (None indicates an error)
+    if remote_tas_set is not None:
+        # Got something (may be empty).
+        # An empty list is considered successful - it means the user is known
+        # but does not have access to any proposals/visits.
+        user_cache = remote_tas_set
+        # Reset the user's cache timestamp.
+        # We'll try this user again at the next expiry.
+        _LOGGER.info("Cache replacement for '%s' (size=%d)", username, len(user_cache))
+        # Adapt the user's expiry - lengthening it if the set
+        # has not changed, otherwise returning to the configured expiry
+        changed: bool = True
+        if existing_cache is not None:
+            changed = existing_cache.etag != get_tas_set_etag(user_cache)
+            incr_counter(
+                REFRESH_CHANGED_COUNTER_KEY
+                if changed
+                else REFRESH_UNCHANGED_COUNTER_KEY
+            )
+        expiry_s: int = user_cache_expiry_s(user_timestamp, changed)
+        max_age_s = user_cache_life_s(expiry_s=expiry_s)
+        with timed("cache-write"):
+            user_etag = set_user_tas(
+                client,
+                encoded_username,
+                user_cache,
+                now,
+                life_s=max_age_s,
+                expiry_s=expiry_s,
+            )
+            if existing_cache is None:
+                # There's no previous set (it was never cached, or was lost)
+                # to describe a change with - subscribers fetch the user again
+                publish_change_event(client, "invalidate", {"usernames": [username]})
+            elif changed:
+                publish_user_change(
+                    client, username, existing_cache.tas, user_cache, user_etag
+                )
+    elif existing_cache is not None:
+        # Resulty was 'None' - indicates an ISPyB failure.
+        # Return the existing (expired) set, and try this user again
+        # next time we get a query.
+        _LOGGER.warning(
+            "Failed to get TAS set for '%s' (returning the cached set)",
+            username,
+        )
+        user_cache = existing_cache.tas
+        user_etag = existing_cache.etag
+    elif rejected or (deadline and deadline.exhausted):
+        # Nothing cached, and we're overloaded or the caller's time
+        # has run out. Fail quickly rather than pretend the user
+        # has no access.
+        _LOGGER.warning(
+            "Unable to refresh '%s' (%s)",
+            username,
+            "overloaded" if rejected else "deadline exhausted",
+        )
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Unable to get target access strings from ISPyB in time",
+            headers={"Retry-After": "1"} if rejected else None,
+        )
+    else:
+        _LOGGER.warning("Failed to get TAS set for '%s'", username)
+        # Resulty was 'None' - indicates an ISPyB failure.
+        # Do nothing - try this user again next time we get a query.
+        # For now we'll just return an empty set for the user_cache
+        # (set earlier)
+
+    return user_cache, user_etag, max_age_s
+
+
+def _get_user_tas(
+    client: RetryingClient,
+    username: str,
+    encoded_username: str,
+    user_timestamp: UserTimestamp | None,
+    now: datetime,
+    deadline: Deadline | None,
+) -> tuple[set[str], str | None, int]:
+    """A user's TAS set, its ETag (None if it's not cached) and its remaining
+    life (seconds). A set that is not cached, or has expired, is refreshed
+    (from ISPyB) by the worker holding the user's refresh lease. Other workers
+    return the expired set (with no remaining life) or, if there is none,
+    wait for the refresh (taking it over if it does not arrive in time).
+    Called with the _SEMAPHORE held, which is released while we wait.
+    """
+    # The remaining life of the cached set (negative once it has expired)
+    remaining_s: float = user_timestamp.remaining_s(now) if user_timestamp else -1
+
+    # If the user's cache record is not present (may have been ejected by memcached),
+    # too old, or there is no cache timestamp then refresh the cache
+    # using the underlying ISPyB DB.
+    existing_cache: UserTasRecord | None = _try_memcached_client_get(
+        client, encoded_username, getter=get_user_tas_record
+    )
+    if existing_cache is not None and remaining_s >= 0:
+        # Cache has not expired and should be set to something...
+        return existing_cache.tas, existing_cache.etag, int(remaining_s)
+
+    # Is another worker (or pod) refreshing the user?
+    # (None if the cache could not be reached, when we refresh regardless)
+    leased: bool | None = _try_memcached_client_get(
+        client, encoded_username, getter=acquire_refresh_lease
+    )
+    if leased is False:
+        if existing_cache is not None:
+            return existing_cache.tas, existing_cache.etag, 0
+        with _semaphore_released(), timed("lease-wait"):
+            refreshed: UserTimestamp | None = wait_for_refresh(
+                client, encoded_username, user_timestamp, deadline
+            )
+        # The refresh reached the cache (the record is read with its timestamp)
+        if refreshed and (
+            refreshed_cache := _try_memcached_client_get(
+                client, encoded_username, getter=get_user_tas_record
+            )
+        ):
+            return (
+                refreshed_cache.tas,
+                refreshed_cache.etag,
+                max(0, int(refreshed.remaining_s(utc_now()))),
+            )
+        leased = take_over_refresh_lease(client, encoded_username)
+
+    try:
+        return _refresh_user_tas(
+            client,
+            username,
+            encoded_username,
+            existing_cache,
+            user_timestamp,
+            now,
+            deadline,
+        )
+    finally:
+        if leased:
+            release_refresh_lease(client, encoded_username)
+
+
 @auth.get("/target-access/{username}", status_code=status.HTTP_200_OK)
 def get_taa_user_tas(
     username: str,
+    response: Response,
     x_taaquerykey: Annotated[str | None, Header()] = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+    accept: Annotated[str | None, Header()] = None,
+    x_request_timeout: Annotated[str | None, Header()] = None,
 ):
     """Returns the list of target access strings for a user.
     The user must provide a valid 'query key' - the one we've been
     configured with.
+
+    The response carries an ETag for the set, and a Cache-Control max-age
+    of the remaining life of the cached set. If the caller provides
+    a matching If-None-Match a 304 (Not Modified) is returned.
+    The response is JSON unless the caller's Accept header prefers MessagePack.
+
+    ISPyB is given until the request's deadline (the configured request
+    timeout, or the caller's shorter X-Request-Timeout) to refresh the set.
+    If it cannot, any (expired) cached set is returned, otherwise
+    a 503 if the deadline was exhausted.
     """
     # We can only continue if the correct query key has been provided.
     if Config.QUERY_KEY and x_taaquerykey != Config.QUERY_KEY:
@@ -432,99 +667,127 @@ def get_taa_user_tas(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Invalid/missing X_TAAQueryKey",
         )
+    deadline: Deadline | None = _request_deadline(x_request_timeout)
 
     _LOGGER.debug("Request for '%s'", username)
 
-    # FastAPI decodes url-encoded strings and memcached keys cannot contain spaces
-    # so we need to re-encode the username for cache lookup.
-    # memcached has a key size limit of 250 characters.
-    encoded_username: str = quote(username)
-    if len(encoded_username) > 250:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Encoded username exceeds 250 characters",
-        )
+    encoded_username: str = _check_username(username)
 
-    if not valid_encoded_username(encoded_username):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Username cannot be '{username}'",
+    use_msgpack: bool = wants_msgpack(accept)
+    headers: dict[str, str]
+
+    # Can we use the in-memory access index?
+    # If so there's no need for the cache (or ISPyB).
+    access_index: AccessIndex | None = get_access_index()
+    if access_index:
+        incr_counter(QUERY_COUNTER_KEY)
+        _REQUESTED_USERS[username] += 1
+        index_etag: str = _representation_etag(
+            access_index.get_user_etag(username), use_msgpack
+        )
+        index_age_s: float = (utc_now() - access_index.built).total_seconds()
+        headers = _cache_headers(
+            index_etag, int(Config.ACCESS_INDEX_REFRESH_SECONDS - index_age_s)
+        )
+        if _etag_matches(if_none_match, index_etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        index_tas: set[str] = access_index.get_user_tas(username)
+        _LOGGER.debug(
+            "Returning %s (indexed) records for '%s'", len(index_tas), username
+        )
+        return _negotiated_response(
+            TargetAccessGetUserTasResponse(
+                count=len(index_tas),
+                target_access=index_tas,
+            ),
+            response,
+            headers,
+            use_msgpack,
         )
 
     with _SEMAPHORE:
         client: RetryingClient = get_memcached_retrying_client()
         assert client
-        client.incr(QUERY_COUNTER_KEY, 1)
+        incr_counter(QUERY_COUNTER_KEY)
+        _REQUESTED_USERS[username] += 1
 
-        # If the user's cache record is not present (may have been ejected by memcached),
-        # too old, or there is no cache timestamp then refresh the cache
-        # using the underlying ISPyB DB.
-        existing_cache: set[str] | None = _try_memcached_client_get(
-            client, encoded_username
-        )
-        user_timestamp_key: str = get_encoded_username_timestamp_key(encoded_username)
-        user_cache_timestamp: datetime = _try_memcached_client_get(
-            client, user_timestamp_key
+        user_timestamp: UserTimestamp | None = _try_memcached_client_get(
+            client, encoded_username, getter=get_user_timestamp
         )
         now: datetime = utc_now()
-        user_cache: set[str] = set()
-        if (
-            existing_cache is None
-            or not user_cache_timestamp
-            or now - user_cache_timestamp > _MAX_USER_CACHE_AGE
-        ):
-            _LOGGER.debug("Attempting to refresh the cache for '%s'...", username)
-            remote_tas_set: set[str] | None = _get_tas_from_remote_ispyb(
-                username=username
+        # The remaining life of the cached set (negative once it has expired)
+        remaining_s: float = user_timestamp.remaining_s(now) if user_timestamp else -1
+
+        # If the cache has not expired and we have a pre-serialized response
+        # we simply return it - there's no need to decode (or re-encode) the set.
+        if remaining_s >= 0 and (
+            response_body := _try_memcached_client_get(
+                client,
+                encoded_username,
+                getter=partial(get_user_response_body, msgpack=use_msgpack),
             )
-            # Always increment the query count
-            client.incr(ISPYB_QUERY_COUNTER_KEY, 1)
-            # Did we get anything (None indicates an error)
-            if remote_tas_set is not None:
-                # Got something (may be empty).
-                # An empty list is considered successful - it means the user is known
-                # but does not have access to any proposals/visits.
-                user_cache = remote_tas_set
-                # Reset the user's cache timestamp.
-                # We'll try this user again at the next expiry.
-                _LOGGER.info(
-                    "Cache replacement for '%s' (size=%d)", username, len(user_cache)
+        ):
+            client.close()
+            body_etag: str = _representation_etag(response_body.etag, use_msgpack)
+            headers = _cache_headers(body_etag, int(remaining_s))
+            _LOGGER.debug("Returning cached response for '%s'", username)
+            if _etag_matches(if_none_match, body_etag):
+                return Response(
+                    status_code=status.HTTP_304_NOT_MODIFIED, headers=headers
                 )
-                client.set(encoded_username, user_cache)
-                client.set(user_timestamp_key, now)
-            else:
-                _LOGGER.warning("Failed to get TAS set for '%s'", username)
-                # Resulty was 'None' - indicates an ISPyB failure.
-                # Do nothing - try this user again next time we get a query.
-                # For now we'll just return an empty set for the user_cache
-                # (set earlier)
-        else:
-            # Cache has not expired and should be set to something...
-            user_cache = existing_cache
+            return Response(
+                content=response_body.body,
+                media_type=MSGPACK_MEDIA_TYPE if use_msgpack else "application/json",
+                headers=headers,
+            )
 
-        client.close()
+        try:
+            user_cache, user_etag, max_age_s = _get_user_tas(
+                client, username, encoded_username, user_timestamp, now, deadline
+            )
+        finally:
+            client.close()
+
+        if user_etag is not None:
+            user_etag = _representation_etag(user_etag, use_msgpack)
+        headers = _cache_headers(user_etag, max_age_s)
+        if user_etag is not None and _etag_matches(if_none_match, user_etag):
+            _LOGGER.debug("Not modified for '%s'", username)
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
 
         count: int = len(user_cache)
         record: str = "record" if count == 1 else "records"
         _LOGGER.debug("Returning %s %s for '%s'", count, record, username)
 
-    return TargetAccessGetUserTasResponse(
-        count=count,
-        target_access=user_cache,
+    return _negotiated_response(
+        TargetAccessGetUserTasResponse(
+            count=count,
+            target_access=user_cache,
+        ),
+        response,
+        headers,
+        use_msgpack,
     )
 
 
-@auth.get("/users/{tas}", status_code=status.HTTP_200_OK)
-def get_taa_tas_users(
+@auth.get("/target-access/{username}/{tas}", status_code=status.HTTP_200_OK)
+def get_taa_user_tas_member(
+    username: str,
     tas: str,
+    response: Response,
     x_taaquerykey: Annotated[str | None, Header()] = None,
+    accept: Annotated[str | None, Header()] = None,
+    x_request_timeout: Annotated[str | None, Header()] = None,
 ):
-    """Returns the set of users (logins) that are members of a target access
-    string. The caller must provide a valid 'query key' - the one we've been
+    """Returns whether a user has access to a (single) target access string.
+    The user must provide a valid 'query key' - the one we've been
     configured with.
 
-    Unlike /target-access/{username} this is not cached - every call results
-    in a query of the underlying ISPyB database.
+    The check uses the user's cached set, which is refreshed just as it is
+    for /target-access/{username}, so the caller need not download
+    (and search) the whole set. The response carries a Cache-Control max-age
+    of the remaining life of the cached set, and is JSON unless
+    the caller's Accept header prefers MessagePack.
     """
     # We can only continue if the correct query key has been provided.
     if Config.QUERY_KEY and x_taaquerykey != Config.QUERY_KEY:
@@ -532,9 +795,94 @@ def get_taa_tas_users(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Invalid/missing X_TAAQueryKey",
         )
+    deadline: Deadline | None = _request_deadline(x_request_timeout)
 
-    _LOGGER.debug("Request for '%s'", tas)
+    _LOGGER.debug("Request for '%s' (%s)", username, tas)
+
+    encoded_username: str = _check_username(username)
+    if not split_tas(tas):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Not a target access string ('{tas}')",
+        )
+
+    use_msgpack: bool = wants_msgpack(accept)
+    access: bool
+    # The remaining life of the answer (None if nothing is cached)
+    max_age_s: int | None
+
+    # Can we use the in-memory access index?
+    access_index: AccessIndex | None = get_access_index()
+    if access_index:
+        incr_counter(QUERY_COUNTER_KEY)
+        _REQUESTED_USERS[username] += 1
+        access = access_index.has_user_tas(username, tas)
+        index_age_s: float = (utc_now() - access_index.built).total_seconds()
+        max_age_s = int(Config.ACCESS_INDEX_REFRESH_SECONDS - index_age_s)
+    else:
+        with _SEMAPHORE:
+            client: RetryingClient = get_memcached_retrying_client()
+            assert client
+            incr_counter(QUERY_COUNTER_KEY)
+            _REQUESTED_USERS[username] += 1
+            try:
+                user_timestamp: UserTimestamp | None = _try_memcached_client_get(
+                    client, encoded_username, getter=get_user_timestamp
+                )
+                now: datetime = utc_now()
+                # The remaining life of the cached set (negative once it's expired)
+                remaining_s: float = (
+                    user_timestamp.remaining_s(now) if user_timestamp else -1
+                )
+                # A (recently checked) set that has not expired
+                # is normally kept (decoded) by this process
+                members: frozenset[str] | None = None
+                if user_timestamp and remaining_s >= 0:
+                    members = _try_memcached_client_get(
+                        client,
+                        encoded_username,
+                        getter=partial(
+                            get_user_tas_membership, timestamp=user_timestamp
+                        ),
+                    )
+                if members is not None:
+                    access = tas in members
+                    max_age_s = int(remaining_s)
+                else:
+                    user_cache, user_etag, max_age_s = _get_user_tas(
+                        client,
+                        username,
+                        encoded_username,
+                        user_timestamp,
+                        now,
+                        deadline,
+                    )
+                    access = tas in user_cache
+                    if user_etag is None:
+                        # Nothing is cached (ISPyB failed)
+                        max_age_s = None
+            finally:
+                client.close()
+
+    _LOGGER.debug("Returning access=%s for '%s' (%s)", access, username, tas)
+    return _negotiated_response(
+        TargetAccessGetUserTasMemberResponse(access=access),
+        response,
+        {
+            "Cache-Control": (
+                "no-cache" if max_age_s is None else f"max-age={max(0, max_age_s)}"
+            ),
+            "Vary": "Accept",
+        },
+        use_msgpack,
+    )
 
+
+def _get_tas_users(tas: str, deadline: Deadline | None) -> set[str]:
+    """The users (logins) that are members of a target access string,
+    from the access index (if we have one) or ISPyB. An HTTPException
+    is raised if the TAS is not valid, or ISPyB cannot be queried.
+    """
     tas_parts: tuple[str, str, str] | None = split_tas(tas)
     if not tas_parts:
         raise HTTPException(
@@ -543,11 +891,24 @@ def get_taa_tas_users(
         )
     code, proposal_number, visit_number = tas_parts
 
-    user_set: set[str] | None = _get_users_from_remote_ispyb(
-        code=code,
-        proposal_number=proposal_number,
-        visit_number=visit_number,
-    )
+    user_set: set[str] | None
+    if access_index := get_access_index():
+        user_set = access_index.get_tas_users(tas)
+    else:
+        with deadline_scope(deadline):
+            try:
+                with upstream_admission():
+                    user_set = get_users_from_remote_ispyb(
+                        code=code,
+                        proposal_number=proposal_number,
+                        visit_number=visit_number,
+                    )
+            except AdmissionRejected as a_rejected:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too busy to get users from ISPyB",
+                    headers={"Retry-After": "1"},
+                ) from a_rejected
     if user_set is None:
         # An ISPyB failure. We deliberately do not return an empty set here -
         # the caller must be able to tell "nobody" from "we do not know".
@@ -555,14 +916,163 @@ def get_taa_tas_users(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Unable to get users from ISPyB",
         )
+    return user_set
+
+
+@auth.get("/users/{tas}", status_code=status.HTTP_200_OK)
+def get_taa_tas_users(
+    tas: str,
+    response: Response,
+    x_taaquerykey: Annotated[str | None, Header()] = None,
+    accept: Annotated[str | None, Header()] = None,
+    x_request_timeout: Annotated[str | None, Header()] = None,
+):
+    """Returns the set of users (logins) that are members of a target access
+    string. The caller must provide a valid 'query key' - the one we've been
+    configured with.
+
+    Unlike /target-access/{username} this is not cached - every call results
+    in a query of the underlying ISPyB database, unless we have an access index.
+    The response is JSON unless the caller's Accept header prefers MessagePack.
+    """
+    # We can only continue if the correct query key has been provided.
+    if Config.QUERY_KEY and x_taaquerykey != Config.QUERY_KEY:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid/missing X_TAAQueryKey",
+        )
+    deadline: Deadline | None = _request_deadline(x_request_timeout)
+
+    _LOGGER.debug("Request for '%s'", tas)
+
+    user_set: set[str] = _get_tas_users(tas, deadline)
 
     count: int = len(user_set)
     user: str = "user" if count == 1 else "users"
     _LOGGER.debug("Returning %s %s for '%s'", count, user, tas)
 
-    return TargetAccessGetTasUsersResponse(
-        count=count,
-        users=user_set,
+    return _negotiated_response(
+        TargetAccessGetTasUsersResponse(
+            count=count,
+            users=user_set,
+        ),
+        response,
+        {"Vary": "Accept"},
+        wants_msgpack(accept),
+    )
+
+
+def _check_invalidate_key(x_taainvalidatekey: str | None) -> None:
+    """Raises an HTTPException unless the caller can invalidate
+    (invalidation must be enabled, by configuring its key).
+    """
+    if not Config.INVALIDATE_KEY or x_taainvalidatekey != Config.INVALIDATE_KEY:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid/missing X_TAAInvalidateKey",
+        )
+
+
+def _invalidate(usernames: set[str]) -> TargetAccessInvalidateResponse:
+    """Invalidates users (between this process's other cache reads and writes)."""
+    with _SEMAPHORE:
+        client: RetryingClient = get_memcached_retrying_client()
+        try:
+            invalidated: set[str] = invalidate_users(client, usernames)
+        finally:
+            client.close()
+    return TargetAccessInvalidateResponse(count=len(invalidated), usernames=invalidated)
+
+
+@auth.delete("/target-access/{username}", status_code=status.HTTP_200_OK)
+def delete_taa_user_tas(
+    username: str,
+    x_taainvalidatekey: Annotated[str | None, Header()] = None,
+) -> TargetAccessInvalidateResponse:
+    """Invalidates a user's cached target access strings, so they're collected
+    (from ISPyB) when next requested. The caller must provide
+    the configured 'invalidate key'.
+    """
+    _check_invalidate_key(x_taainvalidatekey)
+    _check_username(username)
+    _LOGGER.info("Invalidation of '%s'", username)
+    return _invalidate({username})
+
+
+@auth.post("/target-access/invalidate", status_code=status.HTTP_200_OK)
+def post_taa_invalidate(
+    invalidation: TargetAccessInvalidateRequest,
+    x_taainvalidatekey: Annotated[str | None, Header()] = None,
+    x_request_timeout: Annotated[str | None, Header()] = None,
+) -> TargetAccessInvalidateResponse:
+    """Invalidates the cached target access strings of a number of users,
+    given by username and/or target access string (its members are found
+    using the access index, or ISPyB). The caller must provide
+    the configured 'invalidate key'.
+
+    Users who have been removed from a TAS are no longer its members,
+    so they need to be invalidated by username. Every user is invalidated
+    (in constant time) by starting a new cache generation.
+    """
+    _check_invalidate_key(x_taainvalidatekey)
+    if invalidation.all:
+        client: RetryingClient = get_memcached_retrying_client()
+        try:
+            generation: int = new_cache_generation(client)
+        finally:
+            client.close()
+        _LOGGER.info("Invalidation of all users (generation=%d)", generation)
+        return TargetAccessInvalidateResponse(
+            count=0, usernames=set(), generation=generation
+        )
+    deadline: Deadline | None = _request_deadline(x_request_timeout)
+
+    usernames: set[str] = set(invalidation.usernames)
+    for username in usernames:
+        _check_username(username)
+    for tas in invalidation.tas:
+        usernames |= _get_tas_users(tas, deadline)
+    _LOGGER.info(
+        "Invalidation of %d user(s) (usernames=%d tas=%d)",
+        len(usernames),
+        len(invalidation.usernames),
+        len(invalidation.tas),
+    )
+    return _invalidate(usernames)
+
+
+@auth.get("/events/target-access", status_code=status.HTTP_200_OK)
+async def get_taa_events(
+    x_taaquerykey: Annotated[str | None, Header()] = None,
+    last_event_id: Annotated[str | None, Header()] = None,
+) -> StreamingResponse:
+    """A (server-sent event) stream of changes to users' target access strings.
+    The caller must provide a valid 'query key' - the one we've been
+    configured with.
+
+    A 'change' event is sent whenever a refresh changes a user's set
+    (with the TAS added and removed, and the set's new ETag) and an
+    'invalidate' event whenever users (or all users) are invalidated.
+    A subscriber that reconnects with a Last-Event-ID is sent the events
+    it missed, or a 'reset' event if they're no longer held.
+    """
+    # We can only continue if the correct query key has been provided.
+    if Config.QUERY_KEY and x_taaquerykey != Config.QUERY_KEY:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid/missing X_TAAQueryKey",
+        )
+    if Config.CHANGE_EVENT_RETENTION_SECONDS <= 0:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Change events are not enabled",
+        )
+    _LOGGER.info("New change event subscriber (last_event_id=%s)", last_event_id)
+    return StreamingResponse(
+        change_event_stream(last_event_id),
+        media_type="text/event-stream",
+        # Not to be cached, or buffered (by a proxy)
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
@@ -579,13 +1089,19 @@ def get_stats(
             detail="Invalid/missing X_TAAStatsKey",
         )
 
+    # Only the stats app needs these (slow to import) modules
+    # pylint: disable=import-outside-toplevel
+    import yaml
+
+    from .stats import get_statistics
+
     # Get the base statistics (a map)
     data = get_statistics()
     # And add some extra stuff...
     data["auth"] = {
         "kind": _VERSION_KIND,
         "name": _VERSION_NAME,
-        "version": _VERSION,
+        "version": _get_version(),
     }
     return Response(
         content=yaml.dump(data, default_flow_style=False),
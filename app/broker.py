@@ -0,0 +1,339 @@
+"""A (local) broker of ISPyB calls, shared by all the workers of the app.
+
+Each uvicorn worker would otherwise create its own SSH tunnel (and database
+connection) for every call it makes, multiplying the load on (and the handshakes
+with) the upstream services. With TAA_BROKER set to 'yes' the entrypoint starts
+this process, which owns one tunnel and a pool of (up to TAA_BROKER_POOL_SIZE)
+database connections through it. Connections are kept (and reused) between
+calls, and closed once the pool has been idle for TAA_BROKER_IDLE_SECONDS.
+
+The workers send their 'retrieve' calls (a user's sessions, or a visit's
+persons) to the broker over a Unix socket (TAA_BROKER_SOCKET), as a line of JSON,
+and receive the records (or a failure) as a line of JSON: -
+
+    {"operation": "sessions", "args": ["abc12345"], "timeout_s": 14.9}
+    {"ok": true, "exhausted": false, "records": [{"proposalCode": "lb", ...}]}
+
+Identical calls that are in progress (from any worker) share one ISPyB call.
+A 'status' request returns the state of the pool and the broker's counts,
+which are reported by the stats app.
+
+Run from the project root: -
+
+    python -m app.broker
+"""
+
+import json
+import logging
+import os
+import signal
+import socketserver
+import threading
+import time
+from collections.abc import Callable
+from types import FrameType
+from typing import TYPE_CHECKING, Any
+
+from .common import configure_logging
+from .config import Config
+from .deadline import Deadline, deadline_scope
+from .ispyb_access import get_connector, retrieve_persons, retrieve_sessions
+
+if TYPE_CHECKING:
+    from .remote_ispyb_connector import SSHConnector
+
+_LOGGER = logging.getLogger(__name__)
+
+# The calls we make (the arguments are followed by the connector)
+_OPERATIONS: dict[str, Callable[..., list[dict[str, Any]]]] = {
+    "sessions": retrieve_sessions,
+    "persons": retrieve_persons,
+}
+
+
+class _ConnectorPool:
+    """A pool of connectors. The first connector owns the tunnel,
+    the others connect (to the database) through it. Connectors that fail
+    are stopped, and if the tunnel's connector fails the pool is reset
+    (the connectors in use are stopped when they are released).
+    """
+
+    def __init__(self, size: int):
+        self._size: int = max(1, size)
+        self._available: threading.Semaphore = threading.Semaphore(self._size)
+        self._lock: threading.Lock = threading.Lock()
+        # Connectors are created one at a time (the first creates the tunnel)
+        self._create_lock: threading.Lock = threading.Lock()
+        self._tunnel: SSHConnector | None = None
+        self._idle: list[SSHConnector] = []
+        self._in_use: int = 0
+        # Incremented when the pool is reset
+        self._generation: int = 0
+        self._last_used: float = time.monotonic()
+        self.connectors_created: int = 0
+
+    def acquire(self, timeout_s: float | None) -> "tuple[SSHConnector, int] | None":
+        """A connector (and the pool's generation), or None if one cannot be
+        created, or none is available in time.
+        """
+        if not self._available.acquire(timeout=timeout_s):
+            return None
+        with self._lock:
+            self._in_use += 1
+            self._last_used = time.monotonic()
+            while self._idle:
+                connector: SSHConnector = self._idle.pop()
+                if (
+                    connector.last_activity_ts
+                    and time.time() - connector.last_activity_ts
+                    < connector.conn_inactivity
+                ):
+                    return connector, self._generation
+                # Idle for too long to be used
+                # (without its tunnel none of the connectors can be used)
+                if connector is self._tunnel:
+                    self._reset()
+                self._stop(connector)
+            generation: int = self._generation
+        with self._create_lock:
+            new_connector: SSHConnector | None = (
+                get_connector(server=self._tunnel.server)
+                if self._tunnel and self._tunnel.server
+                else get_connector()
+            )
+        if new_connector is None:
+            self._done_with()
+            return None
+        with self._lock:
+            self.connectors_created += 1
+            if self._tunnel is None and new_connector.owns_server:
+                self._tunnel = new_connector
+        return new_connector, generation
+
+    def release(self, connector: "SSHConnector", generation: int, ok: bool) -> None:
+        """Returns a connector to the pool (stopping it if it failed)."""
+        with self._lock:
+            if ok and generation == self._generation:
+                self._idle.append(connector)
+            elif connector is self._tunnel:
+                self._reset()
+                self._stop(connector)
+            else:
+                self._stop(connector)
+        self._done_with()
+
+    def _done_with(self) -> None:
+        with self._lock:
+            self._in_use -= 1
+            self._last_used = time.monotonic()
+        self._available.release()
+
+    def _stop(self, connector: "SSHConnector") -> None:
+        try:
+            connector.stop()
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            _LOGGER.warning("Unexpected %s stopping a connector", repr(ex))
+
+    def _reset(self) -> None:
+        """Stops the idle connectors (the tunnel's last). Called with the lock."""
+        self._generation += 1
+        idle: list[SSHConnector] = self._idle
+        self._idle = []
+        if self._tunnel in idle:
+            idle.remove(self._tunnel)
+            idle.append(self._tunnel)
+        self._tunnel = None
+        for connector in idle:
+            self._stop(connector)
+
+    def close_if_idle(self, idle_s: float) -> None:
+        """Stops the connectors if none have been used for a while."""
+        with self._lock:
+            if (
+                self._idle
+                and not self._in_use
+                and time.monotonic() - self._last_used > idle_s
+            ):
+                _LOGGER.info("Closing %d idle connector(s)", len(self._idle))
+                self._reset()
+
+    def close(self) -> None:
+        with self._lock:
+            self._reset()
+
+    def get_status(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "pool_size": self._size,
+                "connectors": len(self._idle) + self._in_use,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "tunnel": self._tunnel is not None,
+                "connectors_created": self.connectors_created,
+            }
+
+
+class _Call:
+    """A call in progress, shared by identical requests."""
+
+    def __init__(self) -> None:
+        self.done: threading.Event = threading.Event()
+        self.records: list[dict[str, Any]] | None = None
+        self.exhausted: bool = False
+
+
+class _Broker:
+    """Makes calls (with the pool's connectors), sharing identical calls."""
+
+    def __init__(self, pool_size: int):
+        self._pool: _ConnectorPool = _ConnectorPool(pool_size)
+        self._lock: threading.Lock = threading.Lock()
+        self._calls: dict[str, _Call] = {}
+        self._counts: dict[str, int] = {"calls": 0, "shared": 0, "failed": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def call(
+        self, operation: str, args: list[str], timeout_s: float | None
+    ) -> tuple[list[dict[str, Any]] | None, bool]:
+        """The records of a call (None if it failed) and whether the call's
+        deadline was exhausted. An identical call in progress is shared.
+        """
+        key: str = json.dumps([operation, args])
+        with self._lock:
+            call: _Call | None = self._calls.get(key)
+            shared: bool = call is not None
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+        if shared:
+            self._count("shared")
+            if not call.done.wait(timeout_s):
+                return None, True
+            return call.records, call.exhausted
+
+        self._count("calls")
+        try:
+            call.records, call.exhausted = self._make_call(operation, args, timeout_s)
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        if call.records is None:
+            self._count("failed")
+        return call.records, call.exhausted
+
+    def _make_call(
+        self, operation: str, args: list[str], timeout_s: float | None
+    ) -> tuple[list[dict[str, Any]] | None, bool]:
+        deadline: Deadline | None = Deadline(timeout_s) if timeout_s else None
+        with deadline_scope(deadline):
+            acquired: tuple[SSHConnector, int] | None = self._pool.acquire(timeout_s)
+            if acquired is None:
+                return None, bool(deadline and deadline.remaining_s() <= 0)
+            connector, generation = acquired
+            ok: bool = False
+            try:
+                records: list[dict[str, Any]] = _OPERATIONS[operation](*args, connector)
+                ok = True
+                return records, False
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                _LOGGER.warning("Unexpected %s from '%s' call", repr(ex), operation)
+                return None, bool(deadline and deadline.exhausted)
+            finally:
+                self._pool.release(connector, generation, ok)
+
+    def close_if_idle(self) -> None:
+        self._pool.close_if_idle(Config.BROKER_IDLE_SECONDS)
+
+    def close(self) -> None:
+        self._pool.close()
+
+    def get_status(self) -> dict[str, Any]:
+        with self._lock:
+            status: dict[str, Any] = dict(self._counts)
+            status["in_progress"] = len(self._calls)
+        return status | self._pool.get_status()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Handles a request (a line of JSON) from a worker."""
+
+    def handle(self) -> None:
+        broker: _Broker = self.server.broker  # type: ignore[attr-defined]
+        response: dict[str, Any]
+        try:
+            request: dict[str, Any] = json.loads(self.rfile.readline())
+            operation: str = request.get("operation", "")
+            if operation == "status":
+                response = {"ok": True, "status": broker.get_status()}
+            elif operation in _OPERATIONS:
+                records, exhausted = broker.call(
+                    operation, list(request.get("args", [])), request.get("timeout_s")
+                )
+                response = {
+                    "ok": records is not None,
+                    "exhausted": exhausted,
+                    "records": records,
+                }
+            else:
+                response = {"ok": False, "error": f"Unknown operation '{operation}'"}
+        except ValueError as ex:
+            response = {"ok": False, "error": f"Invalid request ({ex})"}
+        # Records hold (database) dates, which are sent as strings
+        self.wfile.write(json.dumps(response, default=str).encode("utf-8") + b"\n")
+
+
+class _BrokerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, broker: _Broker):
+        super().__init__(path, _RequestHandler)
+        self.broker: _Broker = broker
+
+
+def main() -> None:
+    configure_logging()
+    if os.path.exists(Config.BROKER_SOCKET):
+        # Left by a previous broker
+        os.remove(Config.BROKER_SOCKET)
+    broker: _Broker = _Broker(Config.BROKER_POOL_SIZE)
+    server: _BrokerServer = _BrokerServer(Config.BROKER_SOCKET, broker)
+    # Only our (own user's) processes can use the broker
+    os.chmod(Config.BROKER_SOCKET, 0o600)
+
+    stop_event: threading.Event = threading.Event()
+
+    def stop(signum: int, _: FrameType | None) -> None:
+        _LOGGER.info("Stopping broker (signal %d)", signum)
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    thread: threading.Thread = threading.Thread(
+        target=server.serve_forever, name="broker-server", daemon=True
+    )
+    thread.start()
+    _LOGGER.info(
+        "Broker listening on '%s' (pool_size=%d)",
+        Config.BROKER_SOCKET,
+        Config.BROKER_POOL_SIZE,
+    )
+    # Close the pool's connectors when they're idle (until we're stopped)
+    while not stop_event.wait(min(10.0, Config.BROKER_IDLE_SECONDS)):
+        try:
+            broker.close_if_idle()
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            _LOGGER.warning("Unexpected %s closing idle connectors", repr(ex))
+
+    server.shutdown()
+    server.server_close()
+    broker.close()
+    os.remove(Config.BROKER_SOCKET)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""The workers' side of the (optional) ISPyB broker (see 'broker.py').
+
+Each call is a connection to the broker's Unix socket, a request and a response
+(each a line of JSON). The request carries the time left before the caller's
+deadline, which the broker uses for its own (connection) timeouts.
+"""
+
+import json
+import socket
+from typing import Any
+
+from .config import Config
+from .deadline import Deadline, get_deadline
+
+# The time (seconds) we wait for the broker when there is no deadline
+_DEFAULT_TIMEOUT_S: float = 60.0
+# The extra time (seconds) we allow the broker to respond after a deadline
+_RESPONSE_GRACE_S: float = 1.0
+
+
+class BrokerUnavailable(Exception):
+    """Raised when the broker cannot be reached (or does not respond)."""
+
+
+def send_broker_request(request: dict[str, Any], timeout_s: float) -> dict[str, Any]:
+    """Sends a request to the broker, returning its response.
+    Raises BrokerUnavailable if there is no (valid) response.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout_s)
+            sock.connect(Config.BROKER_SOCKET)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as response_file:
+                line: bytes = response_file.readline()
+    except OSError as ex:
+        raise BrokerUnavailable(repr(ex)) from ex
+    try:
+        return json.loads(line)
+    except ValueError as ex:
+        raise BrokerUnavailable("Invalid (or no) response") from ex
+
+
+def call_broker(operation: str, args: list[str]) -> list[dict[str, Any]] | None:
+    """Asks the broker to make a 'retrieve' call, returning the records,
+    or None if the call could not be made (the current deadline is marked
+    as exhausted if it was because there was no time left).
+    Raises BrokerUnavailable if the broker cannot be reached.
+    """
+    deadline: Deadline | None = get_deadline()
+    timeout_s: float | None = deadline.remaining_s() if deadline else None
+    if deadline and timeout_s is not None and timeout_s <= 0:
+        deadline.exhausted = True
+        return None
+    response: dict[str, Any] = send_broker_request(
+        {"operation": operation, "args": args, "timeout_s": timeout_s},
+        timeout_s + _RESPONSE_GRACE_S if timeout_s else _DEFAULT_TIMEOUT_S,
+    )
+    if response.get("exhausted") and deadline:
+        deadline.exhausted = True
+    return response.get("records") if response.get("ok") else None
+
+
+def get_broker_status() -> dict[str, Any]:
+    """The broker's state (its pool of connections and its calls).
+    Raises BrokerUnavailable if the broker cannot be reached.
+    """
+    response: dict[str, Any] = send_broker_request({"operation": "status"}, 2.0)
+    return response.get("status", {})
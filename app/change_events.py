@@ -0,0 +1,122 @@
+"""The stream of target access changes (server-sent events).
+
+Whenever a refresh changes a user's cached set (and whenever users are
+invalidated) an event is published to the cache, under its own sequence number
+(see 'publish_change_event()'), so every worker (in the pod) sees it.
+Each stream polls the cache for new events and sends them to its subscriber: -
+
+    id: 17
+    event: change
+    data: {"username": "abc12345", "added": ["lb00000-2"], "removed": [], ...}
+
+A subscriber can keep its own (long-lived) copy of users' sets, and update
+(or drop) a user's copy when it sees a 'change' (or 'invalidate') event.
+Events are only held for a while, so a subscriber that reconnects (with the
+'Last-Event-ID' of the last event it saw) after its events have gone,
+or whose stream finds an event has gone before it could be sent,
+is sent a 'reset' event, and must drop everything.
+"""
+
+import asyncio
+import json
+import logging
+from collections.abc import AsyncIterator
+from typing import Any
+
+from pymemcache.client.retrying import RetryingClient
+from starlette.concurrency import run_in_threadpool
+
+from .common import (
+    CHANGE_EVENT_SEQUENCE_KEY,
+    get_change_event_key,
+    get_memcached_retrying_client,
+)
+from .config import Config
+
+_LOGGER = logging.getLogger(__name__)
+
+# The most events read from the cache at once
+_BATCH_SIZE: int = 100
+
+
+def _format_event(sequence: int | None, event: str, data: dict[str, Any]) -> str:
+    """An event, as sent to the stream."""
+    event_id: str = "" if sequence is None else f"id: {sequence}\n"
+    return f"{event_id}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _get_sequence(client: RetryingClient) -> int:
+    """The sequence number of the latest event (0 if there are none)."""
+    return int(client.get(CHANGE_EVENT_SEQUENCE_KEY) or 0)
+
+
+def _get_events(client: RetryingClient, first: int, last: int) -> dict[int, Any]:
+    """The (remaining) events, by sequence number, from first to last."""
+    events: dict[str, Any] = client.get_many(
+        [get_change_event_key(sequence) for sequence in range(first, last + 1)]
+    )
+    return {
+        sequence: json.loads(events[key])
+        for sequence in range(first, last + 1)
+        if (key := get_change_event_key(sequence)) in events
+    }
+
+
+async def change_event_stream(last_event_id: str | None) -> AsyncIterator[str]:
+    """The events published after the given event (or, without one, from now).
+    The (blocking) cache calls are made in the thread pool.
+    """
+    client: RetryingClient = await run_in_threadpool(get_memcached_retrying_client)
+    try:
+        latest: int = await run_in_threadpool(_get_sequence, client)
+        sent: int = latest
+        if last_event_id and last_event_id.isdigit() and int(last_event_id) <= latest:
+            sent = int(last_event_id)
+        elif last_event_id:
+            # Not an event we know (the cache may have been restarted)
+            yield _format_event(None, "reset", {})
+        # How long (milliseconds) the subscriber should wait before reconnecting
+        yield f"retry: {int(1_000 * Config.CHANGE_EVENT_POLL_SECONDS)}\n\n"
+
+        # An event found to be missing (it may be about to be written)
+        missing: int | None = None
+        idle_s: float = 0.0
+        while True:
+            if sent < latest:
+                waiting: bool = False
+                last: int = min(latest, sent + _BATCH_SIZE)
+                events: dict[int, Any] = await run_in_threadpool(
+                    _get_events, client, sent + 1, last
+                )
+                for sequence in range(sent + 1, last + 1):
+                    event: Any = events.get(sequence)
+                    if event is None and missing != sequence:
+                        # Look again at the next poll
+                        missing = sequence
+                        waiting = True
+                        break
+                    if event is None:
+                        # Gone - the subscriber must start again
+                        _LOGGER.info("Change event %d is missing (reset)", sequence)
+                        yield _format_event(None, "reset", {})
+                        sent = latest
+                        break
+                    yield _format_event(sequence, event["event"], event["data"])
+                    sent = sequence
+                    idle_s = 0.0
+                if sent < latest and not waiting:
+                    # More to read (the batch was full)
+                    continue
+            elif idle_s >= Config.CHANGE_EVENT_KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                idle_s = 0.0
+
+            await asyncio.sleep(Config.CHANGE_EVENT_POLL_SECONDS)
+            idle_s += Config.CHANGE_EVENT_POLL_SECONDS
+            latest = await run_in_threadpool(_get_sequence, client)
+            if latest < sent:
+                # The sequence has gone back (the cache was restarted)
+                yield _format_event(None, "reset", {})
+                sent = latest
+    finally:
+        client.close()
@@ -0,0 +1,328 @@
+"""Incremental change polling of ISPyB.
+
+Rather than relying on cache expiry alone, we periodically ask ISPyB for the
+session memberships that have changed and invalidate (or refresh) the cached
+target access strings of the users affected. Users that are not cached
+are left alone.
+
+Changes are found in two ways. Each poll finds the sessions that have changed,
+those whose 'lastUpdate' is at (or beyond) a high-water mark (the largest
+'lastUpdate' we have seen). But adding (or removing) a person does not update
+the session (and memberships have no timestamp of their own), so a less frequent
+reconcile compares the members of the sessions that have not ended with those
+found by the last reconcile.
+
+Every worker runs a poller thread, but a memcached lease (an 'add' with an
+expiry of the poll interval) ensures only one of them polls in each interval.
+The high-water mark and the members of each session are kept in memcached,
+so they are shared too.
+"""
+
+import logging
+import threading
+from datetime import datetime
+from typing import TYPE_CHECKING, Any
+from urllib.parse import quote
+
+from pymemcache.client.retrying import RetryingClient
+
+from .common import (
+    CHANGE_POLL_HIGH_WATER_MARK_KEY,
+    CHANGE_POLL_HIGH_WATER_MARK_SESSIONS_KEY,
+    CHANGE_POLL_LEASE_KEY,
+    CHANGE_POLL_MEMBERS_KEY_PREFIX,
+    CHANGE_POLL_RECONCILE_TIMESTAMP_KEY,
+    CHANGE_POLL_TIMESTAMP_KEY,
+    CHANGE_POLL_USER_COUNTER_KEY,
+    MAX_RELATIVE_EXPIRE_S,
+    UserTasRecord,
+    get_cache_namespace,
+    get_encoded_username_key,
+    get_encoded_username_timestamp_key,
+    get_memcached_retrying_client,
+    get_user_tas_record,
+    publish_change_event,
+    publish_user_change,
+    set_user_tas,
+    utc_now,
+    valid_encoded_username,
+)
+from .config import Config
+from .ispyb_access import get_connector, get_tas_from_remote_ispyb
+
+if TYPE_CHECKING:
+    from .remote_ispyb_connector import SSHConnector
+
+_LOGGER = logging.getLogger(__name__)
+
+# The number of reconcile intervals the record of a reconcile is kept for
+_RECONCILE_RECORD_INTERVALS: int = 3
+
+# The latest change in ISPyB (used as the initial high-water mark).
+# 'lastUpdate' is a (naive) database timestamp, so we never compare it
+# with our own clock.
+_HIGH_WATER_MARK_QUERY: str = "SELECT MAX(lastUpdate) AS lastUpdate FROM BLSession"
+# Session memberships for sessions changed since (or at) the high-water mark.
+# Several sessions can share the mark, so we look at it again
+# (skipping the sessions that we've already seen at it).
+_CHANGES_QUERY: str = (
+    "SELECT bs.sessionId, p.login, pr.proposalCode, bs.lastUpdate"
+    " FROM BLSession bs"
+    " JOIN Proposal pr ON pr.proposalId = bs.proposalId"
+    " JOIN Session_has_Person shp ON shp.sessionId = bs.sessionId"
+    " JOIN Person p ON p.personId = shp.personId"
+    " WHERE bs.lastUpdate >= %s"
+)
+# The memberships of the sessions that have not ended (used by the reconcile).
+# NOTE: Membership changes for sessions that have ended (which we no longer
+#       compare) still rely on cache expiry.
+_OPEN_MEMBERSHIPS_QUERY: str = (
+    "SELECT bs.sessionId, p.login, pr.proposalCode"
+    " FROM Session_has_Person shp"
+    " JOIN BLSession bs ON bs.sessionId = shp.sessionId"
+    " JOIN Proposal pr ON pr.proposalId = bs.proposalId"
+    " JOIN Person p ON p.personId = shp.personId"
+    " WHERE p.login IS NOT NULL"
+    " AND (bs.endDate IS NULL OR bs.endDate >= NOW())"
+)
+
+
+def _of_interest(record: dict[str, Any]) -> bool:
+    """True if a membership is for a session with one of our proposal codes."""
+    return bool(record.get("login")) and (
+        not Config.TAS_CODES_SET
+        or f'{record.get("proposalCode")}' in Config.TAS_CODES_SET
+    )
+
+
+def _affected_users(rs: list[dict[str, Any]]) -> set[str]:
+    """The logins in the changes that are of interest to us."""
+    return {record["login"] for record in rs if _of_interest(record)}
+
+
+def _open_memberships(connector: "SSHConnector") -> dict[int, list[str]]:
+    """The (sorted) logins of each session that has not ended."""
+    memberships: dict[int, set[str]] = {}
+    for record in connector.call_query(_OPEN_MEMBERSHIPS_QUERY):
+        if _of_interest(record):
+            memberships.setdefault(record["sessionId"], set()).add(record["login"])
+    return {session: sorted(logins) for session, logins in memberships.items()}
+
+
+def _members_key(session: int) -> str:
+    """The cache key holding a session's members (at the last reconcile)."""
+    return f"{CHANGE_POLL_MEMBERS_KEY_PREFIX}{session}"
+
+
+def _reconcile_interval_s() -> int:
+    """The (effective) time between reconciles - no shorter than the poll interval."""
+    return max(
+        Config.CHANGE_POLL_RECONCILE_SECONDS, Config.CHANGE_POLL_INTERVAL_SECONDS
+    )
+
+
+def _reconcile_due(reconciled: datetime | None) -> bool:
+    """True if the memberships should be reconciled, given the time
+    of the last reconcile (None if there is no record of one).
+    """
+    if Config.CHANGE_POLL_RECONCILE_SECONDS <= 0:
+        return False
+    return (
+        reconciled is None
+        or (utc_now() - reconciled).total_seconds()
+        >= Config.CHANGE_POLL_RECONCILE_SECONDS
+    )
+
+
+def _reconcile_memberships(
+    client: RetryingClient, connector: "SSHConnector", reconciled: datetime | None
+) -> set[str]:
+    """The logins added to (or removed from) the sessions that have not ended,
+    since the last reconcile (nothing has changed if there is no record of one).
+    Sessions that are no longer open have ended (rather than lost their members)
+    so they are ignored. Each session's members are kept under a key of their
+    own (so every item is small) for a few reconcile intervals, as is the time
+    of the reconcile.
+    """
+    memberships: dict[int, list[str]] = _open_memberships(connector)
+    keys: dict[int, str] = {session: _members_key(session) for session in memberships}
+    usernames: set[str] = set()
+    if reconciled is not None and keys:
+        previous: dict[str, Any] = client.get_many(list(keys.values()))
+        for session, logins in memberships.items():
+            usernames |= set(logins).symmetric_difference(
+                previous.get(keys[session], [])
+            )
+    expire: int = min(
+        _RECONCILE_RECORD_INTERVALS * _reconcile_interval_s(), MAX_RELATIVE_EXPIRE_S
+    )
+    failed: list[str] = (
+        client.set_many(
+            {keys[session]: logins for session, logins in memberships.items()},
+            expire=expire,
+            noreply=False,
+        )
+        if keys
+        else []
+    )
+    if failed:
+        _LOGGER.warning("Unable to record the members of %d sessions", len(failed))
+    if not client.set(
+        CHANGE_POLL_RECONCILE_TIMESTAMP_KEY, utc_now(), expire=expire, noreply=False
+    ):
+        _LOGGER.warning("Unable to record the time of the reconcile")
+    _LOGGER.info(
+        "Reconciled %d open sessions (%d users changed)",
+        len(memberships),
+        len(usernames),
+    )
+    return usernames
+
+
+def _update_user(
+    client: RetryingClient, connector: "SSHConnector", username: str
+) -> bool:
+    """Invalidates (or refreshes) a user's cache, if the user is cached.
+    Returns True if the user was cached.
+    """
+    encoded_username: str = quote(username)
+    if not valid_encoded_username(encoded_username):
+        return False
+    namespace: str = get_cache_namespace(client)
+    if client.get(get_encoded_username_key(namespace, encoded_username)) is None:
+        return False
+
+    if Config.CHANGE_POLL_REFRESH:
+        tas_set: set[str] | None = get_tas_from_remote_ispyb(
+            username=username, ssh_connector=connector
+        )
+        if tas_set is not None:
+            _LOGGER.info("Change refresh for '%s' (size=%d)", username, len(tas_set))
+            old_record: UserTasRecord | None = get_user_tas_record(
+                client, encoded_username
+            )
+            etag: str = set_user_tas(client, encoded_username, tas_set, utc_now())
+            if old_record is None:
+                publish_change_event(client, "invalidate", {"usernames": [username]})
+            elif old_record.etag != etag:
+                publish_user_change(client, username, old_record.tas, tas_set, etag)
+            return True
+    # Invalidate.
+    # Removing the timestamp forces a refresh at the next request
+    # while keeping the existing value (used if ISPyB cannot be reached).
+    _LOGGER.info("Change invalidation for '%s'", username)
+    client.delete(get_encoded_username_timestamp_key(namespace, encoded_username))
+    publish_change_event(client, "invalidate", {"usernames": [username]})
+    return True
+
+
+def poll_changes(client: RetryingClient) -> int | None:
+    """Polls ISPyB for changes, updating the cache for the affected users.
+    Returns the number of cached users affected,
+    or None if ISPyB could not be queried.
+    """
+    # pylint: disable=import-outside-toplevel
+    import ispyb
+    import pymysql
+
+    connector: SSHConnector | None = get_connector()
+    if not connector:
+        _LOGGER.warning("No SSH connector - cannot poll for changes")
+        return None
+
+    num_users: int | None = None
+    try:
+        high_water_mark: datetime | None = client.get(CHANGE_POLL_HIGH_WATER_MARK_KEY)
+        reconciled: datetime | None = client.get(CHANGE_POLL_RECONCILE_TIMESTAMP_KEY)
+        if high_water_mark is None:
+            # First poll - nothing has changed (that we have not seen).
+            rs = connector.call_query(_HIGH_WATER_MARK_QUERY)
+            if rs and rs[0]["lastUpdate"]:
+                client.set(CHANGE_POLL_HIGH_WATER_MARK_KEY, rs[0]["lastUpdate"])
+                client.set(CHANGE_POLL_HIGH_WATER_MARK_SESSIONS_KEY, [])
+                _LOGGER.info("Initial change high-water mark %s", rs[0]["lastUpdate"])
+            if _reconcile_due(reconciled):
+                # Record the memberships (ignoring any earlier record)
+                _reconcile_memberships(client, connector, None)
+            num_users = 0
+        else:
+            rs = connector.call_query(_CHANGES_QUERY, (high_water_mark,))
+            seen: list[int] = client.get(CHANGE_POLL_HIGH_WATER_MARK_SESSIONS_KEY) or []
+            changes: list[dict[str, Any]] = [
+                record
+                for record in rs
+                if record["lastUpdate"] != high_water_mark
+                or record["sessionId"] not in seen
+            ]
+            usernames: set[str] = _affected_users(changes)
+            if _reconcile_due(reconciled):
+                usernames |= _reconcile_memberships(client, connector, reconciled)
+            num_users = sum(
+                _update_user(client, connector, username) for username in usernames
+            )
+            if rs:
+                # All the sessions at the new mark are in the results
+                new_mark: datetime = max(record["lastUpdate"] for record in rs)
+                client.set(CHANGE_POLL_HIGH_WATER_MARK_KEY, new_mark)
+                client.set(
+                    CHANGE_POLL_HIGH_WATER_MARK_SESSIONS_KEY,
+                    sorted(
+                        {
+                            record["sessionId"]
+                            for record in rs
+                            if record["lastUpdate"] == new_mark
+                        }
+                    ),
+                )
+            _LOGGER.info(
+                "%d changes since %s (%d users, %d cached)",
+                len(changes),
+                high_water_mark,
+                len(usernames),
+                num_users,
+            )
+            client.incr(CHANGE_POLL_USER_COUNTER_KEY, num_users)
+        client.set(CHANGE_POLL_TIMESTAMP_KEY, utc_now())
+    except (pymysql.MySQLError, ispyb.ISPyBException) as err:
+        _LOGGER.warning("%s polling for changes (%s)", err.__class__.__name__, err)
+    finally:
+        connector.stop()
+
+    return num_users
+
+
+class ChangePoller:
+    """A (daemon) thread that polls for changes at the configured interval,
+    when it holds the poll lease.
+    """
+
+    def __init__(self, interval_s: int):
+        self._interval_s: int = interval_s
+        self._stop_event: threading.Event = threading.Event()
+        self._thread: threading.Thread = threading.Thread(
+            target=self._run, name="change-poller", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._thread.join(timeout=5)
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self._interval_s):
+            client: RetryingClient = get_memcached_retrying_client()
+            try:
+                if client.add(
+                    CHANGE_POLL_LEASE_KEY,
+                    utc_now(),
+                    expire=self._interval_s,
+                    noreply=False,
+                ):
+                    poll_changes(client)
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                # Never let the thread die
+                _LOGGER.warning("Unexpected %s polling for changes", repr(ex))
+            finally:
+                client.close()
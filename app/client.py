@@ -0,0 +1,366 @@
+"""A (pooled, caching) Python client of the authenticator's API.
+
+Callers (like the stack) used to make a new connection for every request.
+The client keeps its connections alive (in a pool), caches each user's target
+access strings locally for as long as the server's Cache-Control 'max-age'
+allows (and then revalidates them with their ETag, which normally costs a
+small 304 response), and coalesces concurrent lookups of the same user into
+one request. It also wraps the users, membership and invalidation endpoints,
+and records its own (client-side) request latencies: -
+
+    client = TargetAccessClient("http://auth", query_key="...")
+    tas: frozenset[str] = client.get_user_tas("abc12345")
+    access: bool = client.has_access("abc12345", "lb00000-1")
+    print(client.get_metrics())
+    client.close()
+
+The client is thread-safe. It only needs 'requests' (and our MessagePack codec).
+"""
+
+import json
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, NamedTuple
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .msgpack_codec import MSGPACK_MEDIA_TYPE, unpackb
+
+# The latencies (of each operation) kept for the metrics
+_LATENCY_SAMPLES: int = 1_000
+
+
+class TargetAccessClientError(Exception):
+    """Raised when a request fails. The status code is None
+    if there was no response.
+    """
+
+    def __init__(self, message: str, status_code: int | None = None):
+        super().__init__(message)
+        self.status_code: int | None = status_code
+
+
+class _CachedTas(NamedTuple):
+    """A user's (locally) cached set, its ETag, and when it expires
+    (a monotonic time).
+    """
+
+    tas: frozenset[str]
+    etag: str | None
+    expires: float
+
+
+class _Lookup:
+    """A lookup (of a user's set) in progress, shared by concurrent callers."""
+
+    def __init__(self) -> None:
+        self.done: threading.Event = threading.Event()
+        self.tas: frozenset[str] = frozenset()
+        self.error: Exception | None = None
+
+
+def _max_age_s(response: requests.Response) -> float | None:
+    """The response's Cache-Control max-age, or None if it's not to be cached."""
+    max_age_s: float | None = None
+    for directive in response.headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name in ("no-cache", "no-store"):
+            return None
+        if name == "max-age" and value.isdigit():
+            max_age_s = float(value)
+    return max_age_s
+
+
+def _percentile_ms(durations: list[float], percentile: int) -> float:
+    """A percentile of (sorted) durations (seconds), in milliseconds."""
+    index: int = min(len(durations) - 1, len(durations) * percentile // 100)
+    return round(1_000 * durations[index], 1)
+
+
+class TargetAccessClient:
+    """A client of the authenticator's API. Connections are pooled
+    (up to the pool size), and the sets of up to 'max_cached_users' users
+    are cached locally. With 'msgpack' the (compact) MessagePack responses
+    are requested. A request timeout (seconds) is passed to the server
+    (as 'X-Request-Timeout'), to limit the time it allows ISPyB.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        query_key: str | None = None,
+        invalidate_key: str | None = None,
+        timeout_s: float = 4.0,
+        request_timeout_s: float | None = None,
+        pool_size: int = 10,
+        max_cached_users: int = 10_000,
+        msgpack: bool = False,
+    ):
+        self._base_url: str = base_url.rstrip("/")
+        self._invalidate_key: str | None = invalidate_key
+        self._timeout_s: float = timeout_s
+        self._pool_size: int = pool_size
+        self._max_cached_users: int = max_cached_users
+
+        self._headers: dict[str, str] = {}
+        if query_key:
+            self._headers["X-TAAQueryKey"] = query_key
+        if request_timeout_s:
+            self._headers["X-Request-Timeout"] = f"{request_timeout_s}"
+        if msgpack:
+            self._headers["Accept"] = MSGPACK_MEDIA_TYPE
+
+        self._session: requests.Session = requests.Session()
+        adapter: HTTPAdapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        # Users' sets (least recently used first) and the lookups in progress
+        self._cache: OrderedDict[str, _CachedTas] = OrderedDict()
+        self._lookups: dict[str, _Lookup] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+        # Metrics
+        self._counts: Counter = Counter()
+        self._latencies: dict[str, deque[float]] = {}
+
+    def __enter__(self) -> "TargetAccessClient":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._session.close()
+
+    def _request(
+        self,
+        operation: str,
+        method: str,
+        path: str,
+        headers: dict[str, str] | None = None,
+        body: dict[str, Any] | None = None,
+    ) -> requests.Response:
+        """Makes a request, recording its latency (against the operation).
+        Raises a TargetAccessClientError if there is no response.
+        """
+        start: float = time.perf_counter()
+        try:
+            response: requests.Response = self._session.request(
+                method,
+                f"{self._base_url}{path}",
+                headers=self._headers | (headers or {}),
+                json=body,
+                timeout=self._timeout_s,
+            )
+        except requests.RequestException as ex:
+            self._count("errors")
+            raise TargetAccessClientError(f"{method} {path} failed ({ex})") from ex
+        finally:
+            self._record_latency(operation, time.perf_counter() - start)
+        self._count("requests")
+        return response
+
+    def _content(self, response: requests.Response) -> dict[str, Any]:
+        """The (JSON or MessagePack) content of a successful response.
+        Raises a TargetAccessClientError for any other response.
+        """
+        if response.status_code != 200:
+            self._count("errors")
+            raise TargetAccessClientError(
+                f"{response.request.method} {response.request.path_url}"
+                f" returned {response.status_code} ({response.text[:200]})",
+                response.status_code,
+            )
+        if response.headers.get("Content-Type", "").startswith(MSGPACK_MEDIA_TYPE):
+            return unpackb(response.content)
+        return json.loads(response.content)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def _record_latency(self, operation: str, duration_s: float) -> None:
+        with self._lock:
+            self._latencies.setdefault(
+                operation, deque(maxlen=_LATENCY_SAMPLES)
+            ).append(duration_s)
+
+    def _get_cached(self, username: str) -> _CachedTas | None:
+        """A user's cached set (fresh or not)."""
+        with self._lock:
+            cached: _CachedTas | None = self._cache.get(username)
+            if cached:
+                self._cache.move_to_end(username)
+            return cached
+
+    def _set_cached(self, username: str, cached: _CachedTas) -> None:
+        with self._lock:
+            self._cache[username] = cached
+            self._cache.move_to_end(username)
+            while len(self._cache) > self._max_cached_users:
+                self._cache.popitem(last=False)
+
+    def _forget(self, usernames: Iterable[str] | None) -> None:
+        """Forgets the cached sets of the given users (or all users if None)."""
+        with self._lock:
+            if usernames is None:
+                self._cache.clear()
+                return
+            for username in usernames:
+                self._cache.pop(username, None)
+
+    def _fetch_user_tas(self, username: str) -> frozenset[str]:
+        """Gets a user's set from the server (revalidating any cached set)."""
+        cached: _CachedTas | None = self._get_cached(username)
+        headers: dict[str, str] = {}
+        if cached and cached.etag:
+            headers["If-None-Match"] = cached.etag
+        response: requests.Response = self._request(
+            "target-access",
+            "GET",
+            f"/target-access/{quote(username, safe='')}",
+            headers=headers,
+        )
+        max_age_s: float | None = _max_age_s(response)
+        if response.status_code == 304 and cached:
+            self._count("not_modified")
+            tas: frozenset[str] = cached.tas
+        else:
+            tas = frozenset(self._content(response)["target_access"])
+        if max_age_s is None:
+            # Not to be cached (the server could not collect the set)
+            self._forget([username])
+        else:
+            self._set_cached(
+                username,
+                _CachedTas(
+                    tas, response.headers.get("ETag"), time.monotonic() + max_age_s
+                ),
+            )
+        return tas
+
+    def get_user_tas(self, username: str) -> frozenset[str]:
+        """The target access strings of a user, from the local cache
+        if they're fresh. Concurrent lookups of a user share one request.
+        """
+        cached: _CachedTas | None = self._get_cached(username)
+        if cached and cached.expires > time.monotonic():
+            self._count("local_hits")
+            return cached.tas
+
+        with self._lock:
+            lookup: _Lookup | None = self._lookups.get(username)
+            leader: bool = lookup is None
+            if lookup is None:
+                lookup = _Lookup()
+                self._lookups[username] = lookup
+        if not leader:
+            self._count("coalesced")
+            lookup.done.wait()
+            if lookup.error:
+                raise lookup.error
+            return lookup.tas
+
+        try:
+            lookup.tas = self._fetch_user_tas(username)
+        except Exception as ex:
+            lookup.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._lookups[username]
+            lookup.done.set()
+        return lookup.tas
+
+    def get_many_user_tas(self, usernames: Iterable[str]) -> dict[str, frozenset[str]]:
+        """The target access strings of a number of users (looked up
+        concurrently, over the pool's connections).
+        """
+        unique: list[str] = list(dict.fromkeys(usernames))
+        with ThreadPoolExecutor(max_workers=self._pool_size) as executor:
+            return dict(zip(unique, executor.map(self.get_user_tas, unique)))
+
+    def has_access(self, username: str, tas: str) -> bool:
+        """True if the user has access to the target access string.
+        A (fresh) cached set is used, otherwise the server is asked
+        (which only returns the answer, not the user's set).
+        """
+        cached: _CachedTas | None = self._get_cached(username)
+        if cached and cached.expires > time.monotonic():
+            self._count("local_hits")
+            return tas in cached.tas
+        response: requests.Response = self._request(
+            "membership",
+            "GET",
+            f"/target-access/{quote(username, safe='')}/{quote(tas, safe='')}",
+        )
+        return bool(self._content(response)["access"])
+
+    def get_tas_users(self, tas: str) -> set[str]:
+        """The users (ISPyB logins) that are members of a target access string."""
+        response: requests.Response = self._request(
+            "users", "GET", f"/users/{quote(tas, safe='')}"
+        )
+        return set(self._content(response)["users"])
+
+    def invalidate(
+        self,
+        usernames: Iterable[str] = (),
+        tas: Iterable[str] = (),
+        all_users: bool = False,
+    ) -> set[str]:
+        """Invalidates the (server's) cached sets of the given users,
+        and of the members of the given target access strings (or every user),
+        and forgets them locally. Returns the users invalidated.
+        """
+        headers: dict[str, str] = {}
+        if self._invalidate_key:
+            headers["X-TAAInvalidateKey"] = self._invalidate_key
+        response: requests.Response = self._request(
+            "invalidate",
+            "POST",
+            "/target-access/invalidate",
+            headers=headers,
+            body={"usernames": list(usernames), "tas": list(tas), "all": all_users},
+        )
+        invalidated: set[str] = set(self._content(response)["usernames"])
+        self._forget(None if all_users else invalidated)
+        return invalidated
+
+    def ping(self) -> bool:
+        """True if the authenticator can reach ISPyB."""
+        response: requests.Response = self._request("ping", "GET", "/ping/")
+        return self._content(response)["ping"] == "OK"
+
+    def get_metrics(self) -> dict[str, Any]:
+        """The client's counts, and the latency percentiles (milliseconds)
+        of its recent requests (of each operation).
+        """
+        with self._lock:
+            counts: dict[str, int] = dict(self._counts)
+            samples: dict[str, list[float]] = {
+                operation: sorted(latencies)
+                for operation, latencies in self._latencies.items()
+            }
+            cached_users: int = len(self._cache)
+        latency: dict[str, Any] = {}
+        for operation, durations in samples.items():
+            latency[operation] = {"samples": len(durations)} | {
+                f"p{percentile}_ms": _percentile_ms(durations, percentile)
+                for percentile in (50, 95, 99)
+            }
+        return {
+            "requests": counts.get("requests", 0),
+            "local_hits": counts.get("local_hits", 0),
+            "not_modified": counts.get("not_modified", 0),
+            "coalesced": counts.get("coalesced", 0),
+            "errors": counts.get("errors", 0),
+            "cached_users": cached_users,
+            "latency": latency,
+        }
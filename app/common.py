@@ -1,14 +1,37 @@
 """Values and helpers shared by the app and its debug utilities."""
 
+import hashlib
+import json
+import logging
+import random
 import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import Iterable
 from datetime import datetime, timezone
+from logging.config import dictConfig
+from typing import Any, NamedTuple
+from urllib.parse import quote
 
-from dateutil.parser import parse
 from pymemcache.client.base import Client
 from pymemcache.client.retrying import RetryingClient
 from pymemcache.exceptions import MemcacheUnexpectedCloseError
 
 from .config import Config
+from .tas_codec import (
+    TasChunks,
+    TasPayload,
+    TasResponseBody,
+    decode_tas_set,
+    encode_tas_response_body,
+    encode_tas_set,
+    get_tas_set_etag,
+)
+from .timing import timed
+
+_LOGGER = logging.getLogger(__name__)
 
 # Counters (stats)
 PING_CACHE_KEY: str = "ispyb-ping"
@@ -19,29 +42,111 @@ ISPYB_QUERY_COUNTER_KEY: str = "ispyb-query-counter"
 
 TIMESTAMP_KEY_PREFIX: str = "timestamp-"
 
+# User keys (and the keys of their values) are in a namespace, prefixed by the
+# (configured) namespace name and the cache generation, i.e. "taa:1:".
+# Incrementing the generation hides every user's values (which then age out).
+CACHE_GENERATION_KEY: str = "cache-generation"
+# The proposal codes the cache was built with
+# (the generation is incremented when they change)
+CACHE_TAS_CODES_KEY: str = "cache-tas-codes"
+# The longest expiry (seconds) memcached takes as a relative time
+# (longer expiry times are taken as a UNIX time)
+MAX_RELATIVE_EXPIRE_S: int = 30 * 24 * 60 * 60
+# The longest (encoded) username we cache,
+# leaving room for the namespace within memcached's 250 character key limit
+MAX_ENCODED_USERNAME_LENGTH: int = 220
+
 PING_CACHE_TIMESTAMP_KEY: str = f"{TIMESTAMP_KEY_PREFIX}{PING_CACHE_KEY}"
 PING_STATUS_CHANGE_TIMESTAMP_KEY: str = (
     f"{TIMESTAMP_KEY_PREFIX}ispyb-ping-status-change"
 )
 
+# Change polling.
+# The lease that allows one worker to poll, the time of the last poll,
+# the ISPyB 'lastUpdate' high-water mark (and the sessions seen at it),
+# the time of the last reconcile (of the members of the open sessions)
+# and the members of each session at it, and the number of users affected.
+CHANGE_POLL_LEASE_KEY: str = "change-poll-lease"
+CHANGE_POLL_TIMESTAMP_KEY: str = f"{TIMESTAMP_KEY_PREFIX}change-poll"
+CHANGE_POLL_HIGH_WATER_MARK_KEY: str = (
+    f"{TIMESTAMP_KEY_PREFIX}change-poll-high-water-mark"
+)
+CHANGE_POLL_HIGH_WATER_MARK_SESSIONS_KEY: str = "change-poll-high-water-mark-sessions"
+CHANGE_POLL_RECONCILE_TIMESTAMP_KEY: str = (
+    f"{TIMESTAMP_KEY_PREFIX}change-poll-reconcile"
+)
+CHANGE_POLL_MEMBERS_KEY_PREFIX: str = "change-poll-members-"
+CHANGE_POLL_USER_COUNTER_KEY: str = "change-poll-user-counter"
+
+# Upstream admission control.
+# The number of ISPyB operations rejected (because of overload)
+# and the (pod-wide) slots held by operations in progress.
+UPSTREAM_REJECTED_COUNTER_KEY: str = "upstream-rejected-counter"
+UPSTREAM_SLOT_KEY_PREFIX: str = "upstream-slot-"
+
+# Adaptive expiry.
+# The number of refreshes of a cached set that changed it, and that did not.
+REFRESH_CHANGED_COUNTER_KEY: str = "refresh-changed-counter"
+REFRESH_UNCHANGED_COUNTER_KEY: str = "refresh-unchanged-counter"
+
+# Refresh leases.
+# The number of refreshes that found another worker (or pod) refreshing
+# the same user, and the number of refreshes taken over from one that did not
+# finish (in time).
+REFRESH_LEASE_CONTENDED_COUNTER_KEY: str = "refresh-lease-contended-counter"
+REFRESH_LEASE_TAKEOVER_COUNTER_KEY: str = "refresh-lease-takeover-counter"
+
+# Change events (for the '/events/target-access' stream).
+# Each event is held (for a while) under a key with its sequence number,
+# and the latest sequence number is held under the sequence key.
+CHANGE_EVENT_SEQUENCE_KEY: str = "change-event-sequence"
+CHANGE_EVENT_KEY_PREFIX: str = "change-event-"
+
 # A target access string (TAS) is a proposal code, a proposal number and a
 # visit (session) number, i.e. "lb12345-1" is code "lb", proposal "12345",
 # visit "1". The parts are what the ISPyB stored procedures expect as arguments.
 TAS_PATTERN: re.Pattern = re.compile(r"^([a-zA-Z]+)(\d+)-(\d+)$")
 
-# List of invalid (reserved) usernames
-INVALID_USERNAMES: set[str] = {
-    ISPYB_PING_COUNTER_KEY,
-    ISPYB_QUERY_COUNTER_KEY,
-    PING_CACHE_KEY,
-    PING_COUNTER_KEY,
-    QUERY_COUNTER_KEY,
-}
+# This process's (recently read) cache generation, and when it was read
+_CACHE_GENERATION: int = 0
+_CACHE_GENERATION_READ: float = 0.0
+# This process's recently checked (decoded) sets, by user key, with their
+# collection time (least recently checked first)
+_MEMBERSHIP_SETS: OrderedDict[str, tuple[datetime, frozenset[str]]] = OrderedDict()
+_MEMBERSHIP_SETS_LOCK: threading.Lock = threading.Lock()
+
+
+def _parse_datetime(value: str) -> datetime:
+    """Parses a stored datetime (the str() of a datetime).
+    Anything else (unlikely) is left to the (slow to import) dateutil parser.
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        from dateutil.parser import parse  # pylint: disable=import-outside-toplevel
+
+        return parse(value)
+
+
+class UserTimestamp(NamedTuple):
+    """When a user's values were collected, their life (seconds)
+    and the (adaptive) expiry the life was based on (before any jitter).
+    """
+
+    collected: datetime
+    life_s: int
+    expiry_s: int
+
+    def remaining_s(self, now: datetime) -> float:
+        """The remaining life (negative once the values have expired)."""
+        return self.life_s - (now - self.collected).total_seconds()
 
 
 # We use custom serializers to convert our objects
 # to/from a string (which is the memcached native value type).
-# Memcached value size if limited to 1MB - about 90_000 TAS strings?
+# Memcached value size if limited to 1MB. TAS sets are stored in a compact
+# (encoded) form, compressed when large, and split into chunks
+# when they still exceed the item limit.
 class TaSerde:
     """Converts our values to and from the strings memcached stores,
     using the record flags to remember the original type.
@@ -56,6 +161,16 @@ class TaSerde:
             return (str(value), 2)
         if isinstance(value, datetime):
             return (str(value), 3)
+        if isinstance(value, TasPayload):
+            return (bytes(value), 5)
+        if isinstance(value, TasChunks):
+            return (value.to_str(), 6)
+        if isinstance(value, TasResponseBody):
+            return (bytes(value), 8)
+        if isinstance(value, UserTimestamp):
+            return (f"{value.life_s}/{value.expiry_s} {value.collected}", 9)
+        if isinstance(value, bytes):
+            return (value, 7)
         return (repr(value), 4)
 
     def deserialize(self, key, value, flags):
@@ -68,9 +183,23 @@ class TaSerde:
         if flags == 2:
             return int(value)
         if flags == 3:
-            return parse(value)
+            return _parse_datetime(value.decode("utf-8"))
         if flags == 4:
             return eval(value)  # pylint: disable=eval-used
+        if flags == 5:
+            return TasPayload(value)
+        if flags == 6:
+            return TasChunks.from_str(value.decode("utf-8"))
+        if flags == 7:
+            return value
+        if flags == 8:
+            return TasResponseBody(value)
+        if flags == 9:
+            lives, collected = value.decode("utf-8").split(" ", 1)
+            life_s, _, expiry_s = lives.partition("/")
+            return UserTimestamp(
+                _parse_datetime(collected), int(life_s), int(expiry_s or life_s)
+            )
         # How did we get here?
         assert False
 
@@ -94,16 +223,470 @@ def split_tas(tas: str) -> tuple[str, str, str] | None:
     return code, proposal_number, visit_number
 
 
-def get_encoded_username_timestamp_key(encoded_username: str) -> str:
+def get_change_event_key(sequence: int) -> str:
+    """The cache key holding a change event."""
+    return f"{CHANGE_EVENT_KEY_PREFIX}{sequence}"
+
+
+def publish_change_event(
+    client: RetryingClient, event: str, data: dict[str, Any]
+) -> int | None:
+    """Publishes a change event (the event type and its JSON data),
+    returning its sequence number, or None if change events are disabled.
+    """
+    if Config.CHANGE_EVENT_RETENTION_SECONDS <= 0:
+        return None
+    sequence: int | None = client.incr(CHANGE_EVENT_SEQUENCE_KEY, 1)
+    if sequence is None:
+        # No sequence (a new cache) - the first to add one wins
+        client.add(CHANGE_EVENT_SEQUENCE_KEY, 0, noreply=False)
+        sequence = client.incr(CHANGE_EVENT_SEQUENCE_KEY, 1)
+        if sequence is None:
+            return None
+    client.set(
+        get_change_event_key(int(sequence)),
+        json.dumps({"event": event, "data": data}),
+        expire=Config.CHANGE_EVENT_RETENTION_SECONDS,
+    )
+    return int(sequence)
+
+
+def publish_user_change(
+    client: RetryingClient,
+    username: str,
+    old_tas: set[str],
+    new_tas: set[str],
+    etag: str,
+) -> int | None:
+    """Publishes the change (the TAS added and removed) of a user's set,
+    and its new ETag.
+    """
+    _LOGGER.debug("Publishing a change for '%s'", username)
+    return publish_change_event(
+        client,
+        "change",
+        {
+            "username": username,
+            "added": sorted(new_tas - old_tas),
+            "removed": sorted(old_tas - new_tas),
+            "etag": etag,
+        },
+    )
+
+
+def get_cache_generation(client: RetryingClient) -> int:
+    """The cache generation, read from the cache (and kept for a short while).
+    The first generation is 1.
+    """
+    global _CACHE_GENERATION, _CACHE_GENERATION_READ  # pylint: disable=global-statement
+    now: float = time.monotonic()
+    if now - _CACHE_GENERATION_READ > Config.CACHE_GENERATION_SECONDS:
+        generation: Any = client.get(CACHE_GENERATION_KEY)
+        if generation is None:
+            # No generation (a new cache) - the first to add one wins
+            client.add(CACHE_GENERATION_KEY, 1, noreply=False)
+            generation = client.get(CACHE_GENERATION_KEY) or 1
+        _CACHE_GENERATION = int(generation)
+        _CACHE_GENERATION_READ = now
+    return _CACHE_GENERATION
+
+
+def new_cache_generation(client: RetryingClient) -> int:
+    """Starts a new cache generation, so all users' values are forgotten
+    (by every worker within the time a generation is kept for).
+    Returns the new generation.
+    """
+    global _CACHE_GENERATION, _CACHE_GENERATION_READ  # pylint: disable=global-statement
+    generation: int | None = client.incr(CACHE_GENERATION_KEY, 1)
+    if generation is None:
+        # No generation (a new cache). The first generation was implied.
+        client.add(CACHE_GENERATION_KEY, 2, noreply=False)
+        generation = int(client.get(CACHE_GENERATION_KEY) or 2)
+    _CACHE_GENERATION = generation
+    _CACHE_GENERATION_READ = time.monotonic()
+    _LOGGER.info("New cache generation (%d)", generation)
+    publish_change_event(client, "invalidate", {"all": True})
+    return generation
+
+
+def check_cache_tas_codes(client: RetryingClient) -> None:
+    """Records the proposal codes the cache is built with, starting a new cache
+    generation if they're not the codes it was built with. A cache without codes
+    (a new or restarted cache) has nothing to forget, so its generation is kept.
+    """
+    tas_codes: Any = client.get(CACHE_TAS_CODES_KEY)
+    if tas_codes == Config.TAS_CODES:
+        return
+    if tas_codes is not None:
+        _LOGGER.info("Proposal codes have changed (to '%s')", Config.TAS_CODES)
+        new_cache_generation(client)
+    client.set(CACHE_TAS_CODES_KEY, Config.TAS_CODES)
+
+
+def get_cache_namespace(client: RetryingClient) -> str:
+    """The prefix of the keys of users (and their values)."""
+    return f"{Config.CACHE_NAMESPACE}:{get_cache_generation(client)}:"
+
+
+def get_encoded_username_key(namespace: str, encoded_username: str) -> str:
+    """The cache key holding a user's TAS set."""
+    return f"{namespace}u:{encoded_username}"
+
+
+def get_encoded_username_timestamp_key(namespace: str, encoded_username: str) -> str:
     """The cache key holding the time a user's values were collected."""
-    return f"{TIMESTAMP_KEY_PREFIX}{encoded_username}"
+    return f"{namespace}t:{encoded_username}"
+
+
+def get_encoded_username_lease_key(namespace: str, encoded_username: str) -> str:
+    """The cache key of the lease held by the worker refreshing a user's values."""
+    return f"{namespace}l:{encoded_username}"
+
+
+def get_encoded_username_chunk_key(
+    namespace: str, encoded_username: str, chunk: int
+) -> str:
+    """The cache key holding one chunk of a user's (large) TAS set.
+    The username is hashed to keep the key within memcached's key size limit.
+    """
+    digest: str = hashlib.sha1(encoded_username.encode("utf-8")).hexdigest()
+    return f"{namespace}c{chunk}:{digest}"
+
+
+def get_encoded_username_response_key(
+    namespace: str, encoded_username: str, msgpack: bool = False
+) -> str:
+    """The cache key holding a user's pre-serialized target-access response
+    (JSON or MessagePack).
+    The username is hashed to keep the key within memcached's key size limit.
+    """
+    digest: str = hashlib.sha1(encoded_username.encode("utf-8")).hexdigest()
+    media: str = "m" if msgpack else ""
+    return f"{namespace}r{media}:{digest}"
+
+
+def get_index_change_key(username: str, etag: str) -> str:
+    """The cache key claimed by the worker that publishes a change (a user's
+    new ETag) found by reloading its access index, so the change is published
+    once rather than by every worker. The key is a hash, to limit its size.
+    """
+    digest: str = hashlib.sha1(f"{username} {etag}".encode("utf-8")).hexdigest()
+    return f"index-change:{digest}"
+
+
+def user_cache_expiry_s(timestamp: UserTimestamp | None, changed: bool) -> int:
+    """The (adaptive) expiry (seconds) of a refreshed set, given the timestamp
+    of the set it replaces and whether the refresh changed it. The expiry of an
+    unchanged set grows (up to the configured maximum), otherwise it's
+    the configured expiry.
+    """
+    expiry_s: int = Config.CACHE_EXPIRY_MINUTES * 60
+    if changed or timestamp is None:
+        return expiry_s
+    max_expiry_s: int = max(expiry_s, Config.CACHE_EXPIRY_MAX_MINUTES * 60)
+    grown_s: int = round(timestamp.expiry_s * Config.CACHE_EXPIRY_GROWTH)
+    return min(max_expiry_s, max(expiry_s, grown_s))
+
+
+def user_cache_life_s(stagger: bool = False, expiry_s: int | None = None) -> int:
+    """The life (seconds) of a newly collected set. The expiry (the configured
+    expiry by default) reduced by a random amount (up to the configured jitter).
+    A staggered life is anywhere in the expiry period, to spread out the expiry
+    of sets that are collected together (by the prewarm).
+    """
+    if expiry_s is None:
+        expiry_s = Config.CACHE_EXPIRY_MINUTES * 60
+    if stagger:
+        return max(1, round(random.uniform(0, expiry_s)))
+    jitter_s: float = expiry_s * min(Config.CACHE_EXPIRY_JITTER_PERCENT, 100) / 100
+    return max(1, round(expiry_s - random.uniform(0, jitter_s)))
+
+
+def user_cache_retention_s(expiry_s: int) -> int:
+    """How long (seconds) memcached keeps the values of a set with the given
+    expiry. No set outlives its expiry, and memcached keeps its values for
+    the configured retention after that.
+    """
+    retention_s: int = expiry_s + max(0, Config.CACHE_RETENTION_MINUTES) * 60
+    return max(1, min(retention_s, MAX_RELATIVE_EXPIRE_S))
 
 
 def valid_encoded_username(encoded_username: str) -> bool:
-    """False if the name would collide with one of our own cache keys."""
-    if encoded_username in INVALID_USERNAMES:
-        return False
-    return not encoded_username.startswith(TIMESTAMP_KEY_PREFIX)
+    """False if the name is empty, or too long for our cache keys.
+    (User keys are in their own namespace, so any other name can be cached.)
+    """
+    return 0 < len(encoded_username) <= MAX_ENCODED_USERNAME_LENGTH
+
+
+class UserTasRecord(NamedTuple):
+    """A user's cached TAS set and details of how it's stored."""
+
+    tas: set[str]
+    etag: str
+    stored_bytes: int
+    compressed: bool
+    chunks: int
+
+
+def set_user_tas(
+    client: RetryingClient,
+    encoded_username: str,
+    tas_set: set[str],
+    collected: datetime,
+    life_s: int | None = None,
+    expiry_s: int | None = None,
+) -> str:
+    """Caches a user's target access strings and the time they were collected,
+    returning the ETag of the set. The set's life (and the expiry it's based on)
+    is recorded with the time. The configured expiry is used if one is not
+    provided, and a (jittered) life if one is not provided.
+    Sets too large for a single cache item are written as chunks,
+    followed by a description of them (under the user's key).
+
+    The target-access response bodies (JSON and MessagePack) are also cached,
+    so requests can be answered without decoding the set. A body is not cached
+    if it's too large for a single item.
+
+    Every value is given a (memcached) expiry, the set's expiry plus the
+    configured retention, so the values of an old cache generation are removed.
+    """
+    with timed("serialize"):
+        payload: TasPayload = encode_tas_set(
+            tas_set, Config.CACHE_COMPRESS_THRESHOLD_BYTES
+        )
+    if expiry_s is None:
+        expiry_s = Config.CACHE_EXPIRY_MINUTES * 60
+    if life_s is None:
+        life_s = user_cache_life_s(expiry_s=expiry_s)
+    expire: int = user_cache_retention_s(expiry_s)
+    limit: int = Config.CACHE_ITEM_LIMIT_BYTES
+    namespace: str = get_cache_namespace(client)
+    user_key: str = get_encoded_username_key(namespace, encoded_username)
+    old_value: Any = client.get(user_key)
+    num_chunks: int = 0
+    if len(payload) <= limit:
+        client.set(user_key, payload, expire=expire)
+    else:
+        num_chunks = (len(payload) + limit - 1) // limit
+        for chunk in range(num_chunks):
+            client.set(
+                get_encoded_username_chunk_key(namespace, encoded_username, chunk),
+                bytes(payload[chunk * limit : (chunk + 1) * limit]),
+                expire=expire,
+            )
+        client.set(
+            user_key,
+            TasChunks(
+                num_chunks=num_chunks, size=len(payload), crc=zlib.crc32(payload)
+            ),
+            expire=expire,
+        )
+    # Remove chunks we no longer need
+    if isinstance(old_value, TasChunks) and old_value.num_chunks > num_chunks:
+        client.delete_many(
+            [
+                get_encoded_username_chunk_key(namespace, encoded_username, chunk)
+                for chunk in range(num_chunks, old_value.num_chunks)
+            ]
+        )
+    for msgpack in (False, True):
+        with timed("serialize"):
+            response_body: TasResponseBody = encode_tas_response_body(
+                tas_set, payload.etag, msgpack=msgpack
+            )
+        response_key: str = get_encoded_username_response_key(
+            namespace, encoded_username, msgpack=msgpack
+        )
+        if len(response_body) <= limit:
+            client.set(response_key, response_body, expire=expire)
+        else:
+            client.delete(response_key)
+    client.set(
+        get_encoded_username_timestamp_key(namespace, encoded_username),
+        UserTimestamp(collected, life_s, expiry_s),
+        expire=expire,
+    )
+    return payload.etag
+
+
+def get_user_timestamp(
+    client: RetryingClient, encoded_username: str
+) -> UserTimestamp | None:
+    """When a user's values were collected, and their life."""
+    value: Any = client.get(
+        get_encoded_username_timestamp_key(
+            get_cache_namespace(client), encoded_username
+        )
+    )
+    return value if isinstance(value, UserTimestamp) else None
+
+
+def get_user_response_body(
+    client: RetryingClient, encoded_username: str, msgpack: bool = False
+) -> TasResponseBody | None:
+    """Gets a user's cached (pre-serialized) target-access response."""
+    value: Any = client.get(
+        get_encoded_username_response_key(
+            get_cache_namespace(client), encoded_username, msgpack=msgpack
+        )
+    )
+    return value if isinstance(value, TasResponseBody) else None
+
+
+def delete_users_tas(client: RetryingClient, encoded_usernames: list[str]) -> None:
+    """Removes the cached target access strings of the given users (including
+    any chunks, the cached responses and the collection timestamp).
+    The users' values are read (for their chunks) and their keys deleted
+    in one (multi-key) operation each.
+    """
+    if not encoded_usernames:
+        return
+    namespace: str = get_cache_namespace(client)
+    user_keys: list[str] = [
+        get_encoded_username_key(namespace, encoded_username)
+        for encoded_username in encoded_usernames
+    ]
+    keys: list[str] = list(user_keys)
+    values: dict[str, Any] = client.get_many(user_keys)
+    for encoded_username, user_key in zip(encoded_usernames, user_keys):
+        keys.extend(
+            (
+                get_encoded_username_timestamp_key(namespace, encoded_username),
+                get_encoded_username_response_key(namespace, encoded_username),
+                get_encoded_username_response_key(
+                    namespace, encoded_username, msgpack=True
+                ),
+            )
+        )
+        value: Any = values.get(user_key)
+        if isinstance(value, TasChunks):
+            keys.extend(
+                get_encoded_username_chunk_key(namespace, encoded_username, chunk)
+                for chunk in range(value.num_chunks)
+            )
+    client.delete_many(keys)
+
+
+def invalidate_users(client: RetryingClient, usernames: Iterable[str]) -> set[str]:
+    """Invalidates the cached target access strings of the given users,
+    so they're collected again when next requested. Usernames we would never
+    cache (too long) are skipped. Returns the usernames invalidated.
+    """
+    invalidated: dict[str, str] = {}
+    for username in usernames:
+        encoded_username: str = quote(username)
+        if valid_encoded_username(encoded_username):
+            invalidated[encoded_username] = username
+    delete_users_tas(client, list(invalidated))
+    if invalidated:
+        _LOGGER.info("Invalidated %d user(s)", len(invalidated))
+        publish_change_event(
+            client, "invalidate", {"usernames": sorted(invalidated.values())}
+        )
+    return set(invalidated.values())
+
+
+def get_user_tas_record(
+    client: RetryingClient, encoded_username: str
+) -> UserTasRecord | None:
+    """Gets a user's cached TAS set (reassembling any chunks).
+    None is returned if there is nothing cached, or what is cached
+    is incomplete or fails its integrity checks.
+    """
+    namespace: str = get_cache_namespace(client)
+    value: Any = client.get(get_encoded_username_key(namespace, encoded_username))
+    if value is None:
+        return None
+    if isinstance(value, set):
+        # A (legacy) repr() value
+        return UserTasRecord(
+            tas=value,
+            etag=get_tas_set_etag(value),
+            stored_bytes=len(repr(value)),
+            compressed=False,
+            chunks=0,
+        )
+
+    num_chunks: int = 0
+    payload: bytes
+    if isinstance(value, TasChunks):
+        num_chunks = value.num_chunks
+        chunk_keys: list[str] = [
+            get_encoded_username_chunk_key(namespace, encoded_username, chunk)
+            for chunk in range(num_chunks)
+        ]
+        chunks: dict[str, bytes] = client.get_many(chunk_keys)
+        if len(chunks) != num_chunks:
+            _LOGGER.warning("Missing TAS chunks for '%s'", encoded_username)
+            return None
+        payload = b"".join(chunks[key] for key in chunk_keys)
+        if len(payload) != value.size or zlib.crc32(payload) != value.crc:
+            _LOGGER.warning("Corrupt TAS chunks for '%s'", encoded_username)
+            return None
+    elif isinstance(value, TasPayload):
+        payload = value
+    else:
+        _LOGGER.warning("Unexpected TAS value type for '%s'", encoded_username)
+        return None
+
+    try:
+        tas_set: set[str] = decode_tas_set(payload)
+    except (ValueError, zlib.error) as err:
+        _LOGGER.warning("Corrupt TAS value for '%s' (%s)", encoded_username, err)
+        return None
+    tas_payload: TasPayload = TasPayload(payload)
+    return UserTasRecord(
+        tas=tas_set,
+        etag=tas_payload.etag,
+        stored_bytes=len(payload),
+        compressed=tas_payload.compressed,
+        chunks=num_chunks,
+    )
+
+
+def get_user_tas_membership(
+    client: RetryingClient, encoded_username: str, timestamp: UserTimestamp
+) -> frozenset[str] | None:
+    """A user's cached TAS set, for membership checks, or None if it's not cached.
+    The sets of recently checked users are kept (decoded) by this process for as
+    long as the timestamp's collection time is unchanged (every new set is given
+    a new timestamp), so most checks need nothing more than the timestamp.
+    """
+    key: str = get_encoded_username_key(get_cache_namespace(client), encoded_username)
+    with _MEMBERSHIP_SETS_LOCK:
+        kept: tuple[datetime, frozenset[str]] | None = _MEMBERSHIP_SETS.get(key)
+        if kept and kept[0] == timestamp.collected:
+            _MEMBERSHIP_SETS.move_to_end(key)
+            return kept[1]
+    record: UserTasRecord | None = get_user_tas_record(client, encoded_username)
+    if record is None:
+        return None
+    members: frozenset[str] = frozenset(record.tas)
+    with _MEMBERSHIP_SETS_LOCK:
+        _MEMBERSHIP_SETS[key] = (timestamp.collected, members)
+        _MEMBERSHIP_SETS.move_to_end(key)
+        while len(_MEMBERSHIP_SETS) > Config.MEMBERSHIP_CACHE_USERS:
+            _MEMBERSHIP_SETS.popitem(last=False)
+    return members
+
+
+def get_user_tas(client: RetryingClient, encoded_username: str) -> set[str] | None:
+    """Gets a user's cached TAS set, None if there isn't one (that we can use)."""
+    record: UserTasRecord | None = get_user_tas_record(client, encoded_username)
+    return record.tas if record else None
+
+
+def configure_logging() -> None:
+    """Configures logging from the 'logging.config' file."""
+    print("Configuring logging...")
+    logging_config: dict[str, Any] = {}
+    with open("logging.config", "r", encoding="utf8") as stream:
+        try:
+            logging_config = json.loads(stream.read())
+        except json.decoder.JSONDecodeError as exc:
+            print(exc)
+    dictConfig(logging_config)
+    print("Configured logging.")
 
 
 def get_memcached_retrying_client() -> RetryingClient:
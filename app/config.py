@@ -7,6 +7,38 @@ class Config:
     """Simple config module where all environment variables can be found."""
 
     CACHE_EXPIRY_MINUTES: int = int(os.environ.get("TAA_CACHE_EXPIRY_MINUTES", "15"))
+    # The life of each cached set is reduced by a random amount, up to this
+    # percentage of the expiry, so sets collected together do not expire together.
+    # Sets collected by the prewarm are also staggered (unless disabled),
+    # their lives spread evenly across the whole expiry period - jitter alone
+    # does little to spread the refreshes of a prewarm.
+    CACHE_EXPIRY_JITTER_PERCENT: float = float(
+        os.environ.get("TAA_CACHE_EXPIRY_JITTER_PERCENT", "10")
+    )
+    CACHE_EXPIRY_STAGGER: bool = (
+        os.environ.get("TAA_CACHE_EXPIRY_STAGGER", "yes").lower() == "yes"
+    )
+    # Adaptive expiry. The expiry of a set that is unchanged when it's refreshed
+    # is multiplied by the growth factor (up to the maximum), the expiry of a set
+    # that has changed returns to TAA_CACHE_EXPIRY_MINUTES.
+    # A maximum no larger than TAA_CACHE_EXPIRY_MINUTES disables adaptation.
+    CACHE_EXPIRY_MAX_MINUTES: int = int(
+        os.environ.get("TAA_CACHE_EXPIRY_MAX_MINUTES", "60")
+    )
+    CACHE_EXPIRY_GROWTH: float = float(os.environ.get("TAA_CACHE_EXPIRY_GROWTH", "2"))
+    # How long (after its expiry) memcached keeps a user's values. An expired set
+    # is returned if ISPyB fails, and the values of an old cache generation
+    # (which are never read again) are removed once it has passed.
+    CACHE_RETENTION_MINUTES: int = int(
+        os.environ.get("TAA_CACHE_RETENTION_MINUTES", "60")
+    )
+    # User keys (and the keys of their values) are prefixed by the namespace and
+    # the cache generation. A new generation (a global invalidation) is seen
+    # by every worker within TAA_CACHE_GENERATION_SECONDS.
+    CACHE_NAMESPACE: str = os.environ.get("TAA_CACHE_NAMESPACE", "taa")
+    CACHE_GENERATION_SECONDS: float = float(
+        os.environ.get("TAA_CACHE_GENERATION_SECONDS", "5")
+    )
     PING_CACHE_EXPIRY_SECONDS: int = int(
         os.environ.get("TAA_PING_CACHE_EXPIRY_SECONDS", "55")
     )
@@ -29,6 +61,9 @@ class Config:
 
     QUERY_KEY: str | None = os.getenv("TAA_QUERY_KEY")
     STATS_KEY: str | None = os.getenv("TAA_STATS_KEY")
+    # The key that must be provided to invalidate cached target access strings.
+    # Invalidation is not possible (over the API) unless it's set.
+    INVALIDATE_KEY: str | None = os.getenv("TAA_INVALIDATE_KEY")
 
     # What proposal codes are we limited to?
     # It's empty (all codes) or a comma-separated set of codes like "lb,sw"
@@ -39,3 +74,175 @@ class Config:
     ENABLE_DAVE_LISTER: bool = (
         os.environ.get("TAA_ENABLE_DAVE_LISTER", "no").lower() == "yes"
     )
+
+    # Startup prewarm.
+    # Users whose target access strings are collected before we are 'ready'.
+    # A file of usernames (one per line) and/or a file of the most-requested users,
+    # which we write when we shut down (and read when we start).
+    PREWARM_USERNAMES_FILE: str | None = os.environ.get("TAA_PREWARM_USERNAMES_FILE")
+    PREWARM_TOP_USERS_FILE: str | None = os.environ.get("TAA_PREWARM_TOP_USERS_FILE")
+    PREWARM_TOP_USERS: int = int(os.environ.get("TAA_PREWARM_TOP_USERS", "200"))
+    # The number of concurrent ISPyB queries (over one SSH tunnel),
+    # the maximum query rate (0 for no limit),
+    # and the time we allow before going 'ready' regardless.
+    PREWARM_CONCURRENCY: int = int(os.environ.get("TAA_PREWARM_CONCURRENCY", "4"))
+    PREWARM_QUERIES_PER_SECOND: float = float(
+        os.environ.get("TAA_PREWARM_QUERIES_PER_SECOND", "5")
+    )
+    PREWARM_BUDGET_SECONDS: float = float(
+        os.environ.get("TAA_PREWARM_BUDGET_SECONDS", "60")
+    )
+
+    # Change polling.
+    # How often (if at all) we ask ISPyB for session membership changes
+    # and whether affected (cached) users are refreshed, or simply invalidated.
+    CHANGE_POLL_INTERVAL_SECONDS: int = int(
+        os.environ.get("TAA_CHANGE_POLL_INTERVAL_SECONDS", "0")
+    )
+    CHANGE_POLL_REFRESH: bool = (
+        os.environ.get("TAA_CHANGE_POLL_REFRESH", "no").lower() == "yes"
+    )
+    # How often the members of every open session are compared with those
+    # of the last comparison (membership changes do not update the session).
+    CHANGE_POLL_RECONCILE_SECONDS: int = int(
+        os.environ.get("TAA_CHANGE_POLL_RECONCILE_SECONDS", "600")
+    )
+
+    # Change events (the '/events/target-access' stream).
+    # How long (seconds) each event is held in the cache (0 disables events),
+    # how often each stream looks for new events and how often
+    # an idle stream sends a keep-alive (comment).
+    CHANGE_EVENT_RETENTION_SECONDS: int = int(
+        os.environ.get("TAA_CHANGE_EVENT_RETENTION_SECONDS", "600")
+    )
+    CHANGE_EVENT_POLL_SECONDS: float = float(
+        os.environ.get("TAA_CHANGE_EVENT_POLL_SECONDS", "1")
+    )
+    CHANGE_EVENT_KEEPALIVE_SECONDS: float = float(
+        os.environ.get("TAA_CHANGE_EVENT_KEEPALIVE_SECONDS", "15")
+    )
+
+    # The (optional) in-memory access index.
+    # If set, the whole person/session mapping is loaded (at this interval)
+    # and both target-access and users requests are served from it.
+    ACCESS_INDEX_REFRESH_SECONDS: int = int(
+        os.environ.get("TAA_ACCESS_INDEX_REFRESH_SECONDS", "0")
+    )
+    # The number of (random) users whose indexed sets are compared with those
+    # of the ISPyB stored procedure each time an index is loaded.
+    # An index that disagrees is not used.
+    ACCESS_INDEX_VERIFY_USERS: int = int(
+        os.environ.get("TAA_ACCESS_INDEX_VERIFY_USERS", "5")
+    )
+
+    # Cached TAS sets are compressed if their encoding exceeds this size,
+    # and split across several cache items if they still exceed the item limit
+    # (memcached's default maximum item size is 1MB, and includes the key).
+    CACHE_COMPRESS_THRESHOLD_BYTES: int = int(
+        os.environ.get("TAA_CACHE_COMPRESS_THRESHOLD_BYTES", "16384")
+    )
+    CACHE_ITEM_LIMIT_BYTES: int = int(
+        os.environ.get("TAA_CACHE_ITEM_LIMIT_BYTES", "1000000")
+    )
+    # The number of (recently checked) users whose decoded sets each worker keeps
+    # for single-visit membership checks (0 keeps none)
+    MEMBERSHIP_CACHE_USERS: int = int(
+        os.environ.get("TAA_MEMBERSHIP_CACHE_USERS", "1000")
+    )
+
+    # Request counters are kept (in shared memory) by each worker
+    # and added to the cache at this interval (and when the worker stops).
+    # Each worker's counters are a file in the counters directory
+    # (so the stats can include counts that are yet to be added).
+    COUNTER_FLUSH_SECONDS: int = int(os.environ.get("TAA_COUNTER_FLUSH_SECONDS", "10"))
+    COUNTERS_DIRECTORY: str = os.environ.get(
+        "TAA_COUNTERS_DIRECTORY", "/dev/shm/taa-counters"
+    )
+
+    # Request timing.
+    # Do we return the time spent in each phase of a request
+    # (in a 'Server-Timing' header), and the duration (milliseconds)
+    # above which requests are logged (with their phases). 0 disables the log.
+    SERVER_TIMING: bool = os.environ.get("TAA_SERVER_TIMING", "no").lower() == "yes"
+    SLOW_REQUEST_MS: int = int(os.environ.get("TAA_SLOW_REQUEST_MS", "2000"))
+
+    # Upstream (ISPyB) connections.
+    # The SSH (tunnel) timeout, and the database connection attempts, with
+    # exponential backoff (and jitter) between them, from the initial delay
+    # to a maximum (seconds).
+    SSH_TIMEOUT_SECONDS: float = float(os.environ.get("TAA_SSH_TIMEOUT_SECONDS", "5"))
+    ISPYB_CONNECT_ATTEMPTS: int = int(os.environ.get("TAA_ISPYB_CONNECT_ATTEMPTS", "5"))
+    ISPYB_CONNECT_BACKOFF_SECONDS: float = float(
+        os.environ.get("TAA_ISPYB_CONNECT_BACKOFF_SECONDS", "0.25")
+    )
+    ISPYB_CONNECT_BACKOFF_MAX_SECONDS: float = float(
+        os.environ.get("TAA_ISPYB_CONNECT_BACKOFF_MAX_SECONDS", "2")
+    )
+    # The time (seconds) a request allows for its upstream work (0 for no limit).
+    # Callers can ask for less with an 'X-Request-Timeout' header.
+    REQUEST_TIMEOUT_SECONDS: float = float(
+        os.environ.get("TAA_REQUEST_TIMEOUT_SECONDS", "15")
+    )
+
+    # Upstream (ISPyB) admission control.
+    # The number of concurrent ISPyB operations (in each process), the number of
+    # requests that can wait for one (the rest are rejected) and how long
+    # (seconds) they can wait. An optional limit for the whole pod (0 for none)
+    # is shared through the cache, where each operation holds a 'slot' that
+    # expires (in case its process dies) after the given time (seconds).
+    UPSTREAM_MAX_CONCURRENCY: int = int(
+        os.environ.get("TAA_UPSTREAM_MAX_CONCURRENCY", "4")
+    )
+    UPSTREAM_MAX_QUEUE: int = int(os.environ.get("TAA_UPSTREAM_MAX_QUEUE", "16"))
+    UPSTREAM_QUEUE_TIMEOUT_SECONDS: float = float(
+        os.environ.get("TAA_UPSTREAM_QUEUE_TIMEOUT_SECONDS", "5")
+    )
+    UPSTREAM_POD_MAX_CONCURRENCY: int = int(
+        os.environ.get("TAA_UPSTREAM_POD_MAX_CONCURRENCY", "0")
+    )
+    UPSTREAM_POD_SLOT_SECONDS: int = int(
+        os.environ.get("TAA_UPSTREAM_POD_SLOT_SECONDS", "60")
+    )
+
+    # Refresh leases.
+    # Only the worker (of any pod sharing the cache) holding a user's lease
+    # refreshes the user's set. The lease expires (in case its process dies)
+    # after the given time (seconds), which should exceed the request timeout.
+    # Others serve the expired set or, if nothing is cached, wait (up to the
+    # given time, in seconds) for the refresh before taking it over.
+    REFRESH_LEASE_SECONDS: int = int(os.environ.get("TAA_REFRESH_LEASE_SECONDS", "20"))
+    REFRESH_LEASE_WAIT_SECONDS: float = float(
+        os.environ.get("TAA_REFRESH_LEASE_WAIT_SECONDS", "2")
+    )
+
+    # ISPyB endpoints.
+    # An optional (comma-separated) list of '<ssh-host>/<ispyb-host>[:<ispyb-port>]'
+    # used instead of the SSH and ISPyB host. The number of consecutive failures
+    # after which an endpoint is avoided, and for how long (seconds).
+    # Requests can be 'hedged' - repeated on another endpoint if the first
+    # has not answered within its 95th percentile latency (or the given delay
+    # until we know it), using the first answer.
+    ISPYB_ENDPOINTS: str = os.environ.get("TAA_ISPYB_ENDPOINTS", "")
+    ENDPOINT_FAILURE_THRESHOLD: int = int(
+        os.environ.get("TAA_ENDPOINT_FAILURE_THRESHOLD", "3")
+    )
+    ENDPOINT_COOLDOWN_SECONDS: float = float(
+        os.environ.get("TAA_ENDPOINT_COOLDOWN_SECONDS", "30")
+    )
+    HEDGE_REQUESTS: bool = os.environ.get("TAA_HEDGE_REQUESTS", "no").lower() == "yes"
+    HEDGE_DELAY_SECONDS: float = float(os.environ.get("TAA_HEDGE_DELAY_SECONDS", "1.5"))
+
+    # Do we connect to the ISPyB database directly (without an SSH tunnel)?
+    # For deployments that can reach the database, the SSH settings
+    # are not needed.
+    ISPYB_DIRECT: bool = os.environ.get("TAA_ISPYB_DIRECT", "no").lower() == "yes"
+
+    # The (optional) ISPyB broker.
+    # A separate process (started by the entrypoint) that owns one tunnel
+    # and a pool of database connections, and makes the 'retrieve' calls
+    # of all the workers (reached over a Unix socket). Idle connections
+    # are closed after TAA_BROKER_IDLE_SECONDS.
+    BROKER: bool = os.environ.get("TAA_BROKER", "no").lower() == "yes"
+    BROKER_SOCKET: str = os.environ.get("TAA_BROKER_SOCKET", "/tmp/taa-broker.sock")
+    BROKER_POOL_SIZE: int = int(os.environ.get("TAA_BROKER_POOL_SIZE", "4"))
+    BROKER_IDLE_SECONDS: float = float(os.environ.get("TAA_BROKER_IDLE_SECONDS", "300"))
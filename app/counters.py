@@ -0,0 +1,181 @@
+"""Request counters, kept by each worker and added to the cache in batches.
+
+Counting a request used to be a memcached 'incr' (a network round-trip)
+in the request's critical section. Now each worker counts in memory and a
+(daemon) thread adds what it has counted to the cache at an interval,
+and when the worker stops.
+
+A worker's counters live in a small shared-memory file (one per process)
+holding two values for each counter: the number counted and the number
+added to the cache (flushed). The stats add the difference, for every
+running worker, to the values in the cache.
+"""
+
+import logging
+import mmap
+import threading
+
+from pymemcache.client.retrying import RetryingClient
+
+from .common import (
+    ISPYB_PING_COUNTER_KEY,
+    ISPYB_QUERY_COUNTER_KEY,
+    PING_COUNTER_KEY,
+    QUERY_COUNTER_KEY,
+    REFRESH_CHANGED_COUNTER_KEY,
+    REFRESH_LEASE_CONTENDED_COUNTER_KEY,
+    REFRESH_LEASE_TAKEOVER_COUNTER_KEY,
+    REFRESH_UNCHANGED_COUNTER_KEY,
+    UPSTREAM_REJECTED_COUNTER_KEY,
+    get_memcached_retrying_client,
+)
+from .rolling_stats import record_count
+from .shared_memory import create_worker_mmap, read_worker_files, remove_worker_file
+
+_LOGGER = logging.getLogger(__name__)
+
+# The counters we keep (in the order they are stored)
+COUNTER_KEYS: tuple[str, ...] = (
+    PING_COUNTER_KEY,
+    ISPYB_PING_COUNTER_KEY,
+    QUERY_COUNTER_KEY,
+    ISPYB_QUERY_COUNTER_KEY,
+    UPSTREAM_REJECTED_COUNTER_KEY,
+    REFRESH_CHANGED_COUNTER_KEY,
+    REFRESH_UNCHANGED_COUNTER_KEY,
+    REFRESH_LEASE_CONTENDED_COUNTER_KEY,
+    REFRESH_LEASE_TAKEOVER_COUNTER_KEY,
+)
+_COUNTER_INDEX: dict[str, int] = {key: index for index, key in enumerate(COUNTER_KEYS)}
+_NUM_COUNTERS: int = len(COUNTER_KEYS)
+# A counted and a flushed (64-bit) value for each counter
+_COUNTERS_SIZE: int = 2 * _NUM_COUNTERS * 8
+_COUNTERS_SUFFIX: str = ".counters"
+
+
+def _add_count(client: RetryingClient, key: str, value: int) -> bool:
+    """Adds to a counter in the cache, returning False if it could not be added.
+    A counter that's missing (a new cache, or evicted) is created with the value
+    (unless another worker creates it first, when we add to theirs).
+    """
+    if client.incr(key, value) is not None:
+        return True
+    if client.add(key, value, noreply=False):
+        return True
+    return client.incr(key, value) is not None
+
+
+class _WorkerCounters:
+    """The counters of this process. If the counters file cannot be created
+    the counters are kept in (private) memory, and are only seen by the stats
+    once they have been flushed.
+    """
+
+    def __init__(self) -> None:
+        self._mmap: mmap.mmap
+        self.path: str | None
+        self._mmap, self.path = create_worker_mmap(_COUNTERS_SUFFIX, _COUNTERS_SIZE)
+        self._values: memoryview = memoryview(self._mmap).cast("q")
+        self._lock: threading.Lock = threading.Lock()
+
+    def add(self, index: int, value: int) -> None:
+        with self._lock:
+            self._values[index] += value
+
+    def flush(self, client: RetryingClient) -> None:
+        """Adds what's been counted (since the last flush) to the cache.
+        Counts that cannot be added are kept (for the next flush).
+        """
+        for index, key in enumerate(COUNTER_KEYS):
+            counted: int = self._values[index]
+            flushed: int = self._values[_NUM_COUNTERS + index]
+            if counted > flushed and _add_count(client, key, counted - flushed):
+                self._values[_NUM_COUNTERS + index] = counted
+
+    def close(self) -> None:
+        self._values.release()
+        self._mmap.close()
+        remove_worker_file(self.path)
+
+
+# This process's counters (created when first needed)
+_COUNTERS: _WorkerCounters | None = None
+_COUNTERS_LOCK: threading.Lock = threading.Lock()
+
+
+def _get_counters() -> _WorkerCounters:
+    global _COUNTERS  # pylint: disable=global-statement
+    with _COUNTERS_LOCK:
+        if _COUNTERS is None:
+            _COUNTERS = _WorkerCounters()
+        return _COUNTERS
+
+
+def _close_counters() -> None:
+    global _COUNTERS  # pylint: disable=global-statement
+    with _COUNTERS_LOCK:
+        if _COUNTERS is not None:
+            _COUNTERS.close()
+            _COUNTERS = None
+
+
+def incr_counter(key: str, value: int = 1) -> None:
+    """Counts (without any network I/O). The key must be one of COUNTER_KEYS.
+    The count is also recorded in the rolling stats.
+    """
+    (_COUNTERS or _get_counters()).add(_COUNTER_INDEX[key], value)
+    record_count(key, value)
+
+
+def flush_counters() -> None:
+    """Adds this process's (unflushed) counts to the cache."""
+    if _COUNTERS is None:
+        return
+    client: RetryingClient = get_memcached_retrying_client()
+    try:
+        _COUNTERS.flush(client)
+    finally:
+        client.close()
+
+
+def get_unflushed_counts() -> dict[str, int]:
+    """The counts (of all running workers) that are yet to reach the cache."""
+    unflushed: dict[str, int] = dict.fromkeys(COUNTER_KEYS, 0)
+    for data in read_worker_files(_COUNTERS_SUFFIX, _COUNTERS_SIZE):
+        values: memoryview = memoryview(data).cast("q")
+        for index, key in enumerate(COUNTER_KEYS):
+            unflushed[key] += max(0, values[index] - values[_NUM_COUNTERS + index])
+    return unflushed
+
+
+class CounterFlusher:
+    """A (daemon) thread that flushes this process's counters at the given
+    interval, and once more when stopped.
+    """
+
+    def __init__(self, interval_s: int):
+        self._interval_s: int = interval_s
+        self._stop_event: threading.Event = threading.Event()
+        self._thread: threading.Thread = threading.Thread(
+            target=self._run, name="counter-flusher", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._thread.join(timeout=5)
+        self._flush()
+        _close_counters()
+
+    def _flush(self) -> None:
+        try:
+            flush_counters()
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            # Never let the thread die
+            _LOGGER.warning("Unexpected %s flushing counters", repr(ex))
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self._interval_s):
+            self._flush()
@@ -0,0 +1,63 @@
+"""Request deadlines - the time a request allows for its upstream (ISPyB) work.
+
+An endpoint creates a Deadline (from the configured request timeout, or a
+shorter one from the caller's 'X-Request-Timeout' header) and makes it current
+(with 'deadline_scope()') around its upstream calls. The connector limits its
+SSH and database timeouts, and its connection retries, to the time that
+remains, and marks the deadline as 'exhausted' if it gives up because of it.
+The endpoint can then fall back to cached data, or fail quickly.
+"""
+
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from .config import Config
+
+
+class Deadline:
+    """The (monotonic) time by which upstream work must be done."""
+
+    __slots__ = ("expires", "exhausted")
+
+    def __init__(self, timeout_s: float):
+        self.expires: float = time.monotonic() + timeout_s
+        # Set when upstream work is abandoned because there was no time left
+        self.exhausted: bool = False
+
+    def remaining_s(self) -> float:
+        return self.expires - time.monotonic()
+
+
+_DEADLINE: ContextVar[Deadline | None] = ContextVar("deadline", default=None)
+
+
+def new_deadline(request_timeout: str | None) -> Deadline | None:
+    """A deadline for a request, from the configured request timeout and the
+    caller's (optional) timeout (seconds), the shorter of the two.
+    Returns None if neither sets a timeout. Raises ValueError
+    if the caller's timeout is not a positive number.
+    """
+    timeout_s: float = Config.REQUEST_TIMEOUT_SECONDS
+    if request_timeout is not None:
+        requested_s: float = float(request_timeout)
+        if not requested_s > 0:
+            raise ValueError(f"Not a positive timeout ('{request_timeout}')")
+        timeout_s = min(timeout_s, requested_s) if timeout_s > 0 else requested_s
+    return Deadline(timeout_s) if timeout_s > 0 else None
+
+
+@contextmanager
+def deadline_scope(deadline: Deadline | None) -> Iterator[None]:
+    """Makes a deadline current (for the code in the 'with' block)."""
+    token = _DEADLINE.set(deadline)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def get_deadline() -> Deadline | None:
+    """The current deadline, if there is one."""
+    return _DEADLINE.get()
@@ -0,0 +1,151 @@
+"""The ISPyB endpoints (SSH host and database) we can use, and their health.
+
+By default there is one endpoint, from the SSH and ISPyB host configuration.
+'TAA_ISPYB_ENDPOINTS' can provide a (comma-separated) list of them instead,
+each written '<ssh-host>/<ispyb-host>[:<ispyb-port>]'. All the endpoints share
+the same credentials. When we connect to ISPyB directly (without SSH)
+endpoints have no SSH host, and are written '<ispyb-host>[:<ispyb-port>]'.
+
+Each process tracks the health and latency of every endpoint. Endpoints are
+tried in order of their (smoothed) latency, healthy ones first. An endpoint is
+unhealthy for a cool-down period after a number of consecutive failures.
+The recent latencies of an endpoint also provide the delay (their 95th
+percentile) after which a request is 'hedged' (sent to another endpoint too).
+"""
+
+import logging
+import statistics
+import threading
+import time
+from collections import deque
+
+from .config import Config
+
+_LOGGER = logging.getLogger(__name__)
+
+# The weight of a new latency in the smoothed (moving average) latency
+_LATENCY_WEIGHT: float = 0.2
+# The number of recent latencies kept (for the hedge delay),
+# and the number we need before we trust their percentile
+_LATENCY_SAMPLES: int = 100
+_MIN_LATENCY_SAMPLES: int = 20
+
+
+class Endpoint:
+    """An SSH host and the ISPyB database reached through it."""
+
+    def __init__(self, ssh_host: str | None, ispyb_host: str, ispyb_port: int):
+        self.ssh_host: str | None = ssh_host
+        self.ispyb_host: str = ispyb_host
+        self.ispyb_port: int = ispyb_port
+        self.name: str = f"{ispyb_host}:{ispyb_port}"
+        if ssh_host:
+            self.name = f"{ssh_host}/{self.name}"
+        self._lock: threading.Lock = threading.Lock()
+        self._failures: int = 0
+        self._unhealthy_until: float = 0.0
+        self.latency_s: float | None = None
+        self._latencies: deque[float] = deque(maxlen=_LATENCY_SAMPLES)
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self._unhealthy_until
+
+    def record_success(self, latency_s: float | None = None) -> None:
+        """Records a successful use of the endpoint
+        (with the latency of the operation, if it's known).
+        """
+        with self._lock:
+            if self._failures >= Config.ENDPOINT_FAILURE_THRESHOLD:
+                _LOGGER.info("Endpoint %s has recovered", self.name)
+            self._failures = 0
+            self._unhealthy_until = 0.0
+            if latency_s is not None:
+                self._latencies.append(latency_s)
+                self.latency_s = (
+                    latency_s
+                    if self.latency_s is None
+                    else self.latency_s + _LATENCY_WEIGHT * (latency_s - self.latency_s)
+                )
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= Config.ENDPOINT_FAILURE_THRESHOLD:
+                if self.healthy:
+                    _LOGGER.warning(
+                        "Endpoint %s is unhealthy (%d failures)",
+                        self.name,
+                        self._failures,
+                    )
+                self._unhealthy_until = (
+                    time.monotonic() + Config.ENDPOINT_COOLDOWN_SECONDS
+                )
+
+    def hedge_delay_s(self) -> float:
+        """The time after which a request to this endpoint should be hedged,
+        the 95th percentile of its recent latencies (if we have enough of them).
+        """
+        with self._lock:
+            latencies: list[float] = list(self._latencies)
+        if len(latencies) < _MIN_LATENCY_SAMPLES:
+            return Config.HEDGE_DELAY_SECONDS
+        return statistics.quantiles(latencies, n=20)[-1]
+
+
+def _parse_endpoints(endpoints: str) -> list[Endpoint]:
+    """Endpoints from their configuration, skipping (and logging) bad ones."""
+    parsed: list[Endpoint] = []
+    for endpoint in endpoints.split(","):
+        endpoint = endpoint.strip()
+        if not endpoint:
+            continue
+        ssh_host, _, ispyb = endpoint.rpartition("/")
+        ispyb_host, _, ispyb_port = ispyb.partition(":")
+        if (
+            not ispyb_host
+            or (ispyb_port and not ispyb_port.isdigit())
+            or bool(ssh_host) == Config.ISPYB_DIRECT
+        ):
+            _LOGGER.warning("Ignoring badly formed endpoint '%s'", endpoint)
+            continue
+        parsed.append(
+            Endpoint(
+                ssh_host or None,
+                ispyb_host,
+                int(ispyb_port) if ispyb_port else Config.ISPYB_PORT,
+            )
+        )
+    return parsed
+
+
+ENDPOINTS: list[Endpoint] = (
+    _parse_endpoints(Config.ISPYB_ENDPOINTS)
+    if Config.ISPYB_ENDPOINTS
+    else (
+        [
+            Endpoint(
+                None if Config.ISPYB_DIRECT else Config.SSH_HOST,
+                Config.ISPYB_HOST,
+                Config.ISPYB_PORT,
+            )
+        ]
+        if (Config.ISPYB_DIRECT or Config.SSH_HOST)
+        and Config.ISPYB_HOST
+        and Config.ISPYB_PORT
+        else []
+    )
+)
+
+
+def get_ordered_endpoints() -> list[Endpoint]:
+    """The endpoints in the order they should be tried. Healthy endpoints
+    (fastest first, endpoints we've no latency for before any others),
+    followed by unhealthy ones (as a last resort).
+    """
+    healthy: list[Endpoint] = [endpoint for endpoint in ENDPOINTS if endpoint.healthy]
+    unhealthy: list[Endpoint] = [
+        endpoint for endpoint in ENDPOINTS if not endpoint.healthy
+    ]
+    healthy.sort(key=lambda endpoint: endpoint.latency_s or 0.0)
+    return healthy + unhealthy
@@ -0,0 +1,491 @@
+"""Queries of the remote ISPyB database, shared by the app and its startup stages.
+
+Nothing here touches the cache, it simply turns ISPyB records into
+the sets of target access strings (or users) that we cache and return.
+
+The ISPyB, SSH and MySQL modules (and our connector, which needs them)
+are slow to import, so they are only imported when we first need a connector.
+
+Connectors reach ISPyB through an SSH tunnel, or connect to it directly
+if we're configured to do so (when we can reach it without SSH).
+
+ISPyB calls use the best (healthy, fastest) endpoint, failing over to the
+others. If enabled, a call that has not been answered within the endpoint's
+hedge delay is also made on the next endpoint, and the first answer is used
+(the other call is cancelled). Either way, an error raised by a call is raised
+to the caller if no endpoint answers.
+
+If the (optional) broker is enabled the 'retrieve' calls are sent to it
+(see 'broker.py'), falling back to our own connectors if it cannot be reached.
+"""
+
+import logging
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from functools import partial
+from typing import TYPE_CHECKING, Any, TypeVar
+
+from .broker_client import BrokerUnavailable, call_broker
+from .config import Config
+from .deadline import Deadline, get_deadline
+from .endpoints import ENDPOINTS, Endpoint, get_ordered_endpoints
+from .timing import timed
+
+if TYPE_CHECKING:
+    import sshtunnel
+
+    from .remote_ispyb_connector import SSHConnector
+
+_LOGGER = logging.getLogger(__name__)
+
+# Do we have sufficient configuration for a connector?
+# (a direct connector does not need the SSH configuration)
+CONNECTOR_CONFIGURED: bool = bool(
+    ENDPOINTS
+    and Config.ISPYB_USER
+    and Config.ISPYB_PASSWORD
+    and (
+        Config.ISPYB_DIRECT
+        or (
+            Config.SSH_USER and (Config.SSH_PRIVATE_KEY_FILENAME or Config.SSH_PASSWORD)
+        )
+    )
+)
+
+_T = TypeVar("_T")
+
+# Threads for (hedged) ISPyB calls.
+# The 'losing' call is cancelled (it stops its own connector).
+_CALL_EXECUTOR: ThreadPoolExecutor = ThreadPoolExecutor(
+    max_workers=2 * max(1, Config.UPSTREAM_MAX_CONCURRENCY),
+    thread_name_prefix="ispyb-call",
+)
+
+
+class _EndpointUnavailable(Exception):
+    """Raised when we cannot create a connector for an endpoint."""
+
+
+class _CallCancelled(Exception):
+    """Raised by a hedged call that was cancelled before it could start."""
+
+
+class _Cancellation:
+    """Lets a hedged call cancel one of its calls (the one that lost)
+    by aborting its connector's query.
+    """
+
+    def __init__(self) -> None:
+        self._lock: threading.Lock = threading.Lock()
+        self._connector: SSHConnector | None = None
+        self.cancelled: bool = False
+
+    def attach(self, connector: "SSHConnector") -> bool:
+        """Attaches the call's connector, returning False if it's been cancelled."""
+        with self._lock:
+            self._connector = connector
+            return not self.cancelled
+
+    def detach(self) -> None:
+        with self._lock:
+            self._connector = None
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            if self._connector is not None:
+                self._connector.abort()
+
+
+def log_connector_configuration() -> None:
+    """Logs whether we have sufficient configuration for ISPyB connections."""
+    if CONNECTOR_CONFIGURED:
+        _LOGGER.info("Config OK - Can establish ISPyB connections")
+    else:
+        _LOGGER.warning("Insufficient configuration to establish ISPyB connections")
+
+
+def _create_connector(
+    server: "sshtunnel.SSHTunnelForwarder | None" = None,
+    endpoint: Endpoint | None = None,
+) -> "SSHConnector | None":
+    """Tries to create an SSHConnector() (or a DirectConnector()),
+    which may fail.
+    """
+    # pylint: disable=import-outside-toplevel
+    import ispyb
+    import sshtunnel
+
+    from .remote_ispyb_connector import DirectConnector, SSHConnector
+
+    conn: SSHConnector | None = None
+    _LOGGER.debug(
+        "Creating %s() for '%s'..",
+        "DirectConnector" if Config.ISPYB_DIRECT else "SSHConnector",
+        endpoint.name if endpoint else "shared tunnel",
+    )
+    try:
+        if Config.ISPYB_DIRECT:
+            conn = DirectConnector(endpoint=endpoint)
+        else:
+            conn = SSHConnector(server=server, endpoint=endpoint)
+    except ispyb.ConnectionError:
+        # The ISPyB connection failed.
+        # Nothing else to do here, metrics are already updated
+        _LOGGER.warning("ISPyB connection failure")
+    except sshtunnel.BaseSSHTunnelForwarderError:
+        _LOGGER.warning("Failed to establish a connector")
+    return conn
+
+
+def get_connector(
+    server: "sshtunnel.SSHTunnelForwarder | None" = None,
+    endpoint: Endpoint | None = None,
+) -> "SSHConnector | None":
+    """Tries to create an SSHConnector(), which may fail.
+    If an (already started) SSH server is provided the connector
+    shares its tunnel rather than creating one of its own
+    (there is no tunnel to share if we connect directly). Otherwise the
+    connector is for the given endpoint or, failing over, the first
+    of our endpoints that we can connect to.
+    """
+    if not CONNECTOR_CONFIGURED:
+        _LOGGER.debug("Insufficient configuration to create a connector")
+        return None
+    if server is not None and not Config.ISPYB_DIRECT:
+        return _create_connector(server=server)
+
+    deadline: Deadline | None = get_deadline()
+    for candidate in [endpoint] if endpoint else get_ordered_endpoints():
+        if conn := _create_connector(endpoint=candidate):
+            candidate.record_success()
+            return conn
+        candidate.record_failure()
+        if deadline and deadline.exhausted:
+            break
+    return None
+
+
+def _call_endpoint(
+    endpoint: Endpoint,
+    call: Callable[["SSHConnector"], _T],
+    cancellation: _Cancellation | None = None,
+) -> _T:
+    """Makes an ISPyB call on an endpoint (with a connector of its own),
+    recording the endpoint's health and latency.
+    Raises _EndpointUnavailable if we cannot connect.
+    """
+    start: float = time.monotonic()
+    connector: SSHConnector | None = get_connector(endpoint=endpoint)
+    if not connector:
+        raise _EndpointUnavailable(endpoint.name)
+    try:
+        if cancellation and not cancellation.attach(connector):
+            raise _CallCancelled(endpoint.name)
+        result: _T = call(connector)
+    except Exception:
+        # A cancelled call's failure is not the endpoint's
+        if not (cancellation and cancellation.cancelled):
+            endpoint.record_failure()
+        raise
+    finally:
+        if cancellation:
+            cancellation.detach()
+        # Request done, always stop the connector
+        connector.stop()
+    endpoint.record_success(time.monotonic() - start)
+    return result
+
+
+def _hedged_call(
+    endpoints: list[Endpoint], call: Callable[["SSHConnector"], _T]
+) -> _T | None:
+    """Makes an ISPyB call on the first endpoint and, if it has not answered
+    within its hedge delay, on the next one too, returning the first answer
+    (and cancelling the other call). Endpoints we cannot connect to are
+    replaced by the next (if there is one), returning None if there are none.
+    As with an unhedged call, an error raised by a call is raised (unless
+    a call that's in progress answers).
+    """
+    remaining: list[Endpoint] = list(endpoints)
+    pending: dict[Future, _Cancellation] = {}
+    error: Exception | None = None
+
+    def submit() -> None:
+        cancellation: _Cancellation = _Cancellation()
+        # Calls are made in a copy of our context (our deadline and timings)
+        future: Future = _CALL_EXECUTOR.submit(
+            copy_context().run, _call_endpoint, remaining.pop(0), call, cancellation
+        )
+        pending[future] = cancellation
+
+    deadline: Deadline | None = get_deadline()
+    hedge_delay_s: float | None = remaining[0].hedge_delay_s()
+    submit()
+    try:
+        while pending:
+            done, _ = wait(
+                pending,
+                timeout=hedge_delay_s if remaining else None,
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                _LOGGER.debug("Hedging ISPyB call (after %.2fs)", hedge_delay_s)
+                hedge_delay_s = None
+                submit()
+                continue
+            for future in done:
+                del pending[future]
+                try:
+                    return future.result()
+                except _EndpointUnavailable:
+                    if remaining and not (deadline and deadline.exhausted):
+                        submit()
+                except Exception as ex:  # pylint: disable=broad-exception-caught
+                    # Raised (as an unhedged call's is) unless a call
+                    # that's in progress answers
+                    _LOGGER.debug("%s from hedged ISPyB call", repr(ex))
+                    error = error or ex
+                    remaining.clear()
+    finally:
+        # The calls that lost
+        for cancellation in pending.values():
+            cancellation.cancel()
+    if error:
+        raise error
+    return None
+
+
+def call_ispyb(call: Callable[["SSHConnector"], _T]) -> _T | None:
+    """Makes an ISPyB call (with a new connector), using the best endpoint and
+    failing over to the others (hedging the call, if enabled).
+    Returns None if the call could not be made on any endpoint.
+    Errors raised by the call are raised.
+    """
+    if not CONNECTOR_CONFIGURED:
+        _LOGGER.debug("Insufficient configuration to create a connector")
+        return None
+    endpoints: list[Endpoint] = get_ordered_endpoints()
+    if Config.HEDGE_REQUESTS and len(endpoints) > 1:
+        return _hedged_call(endpoints, call)
+
+    deadline: Deadline | None = get_deadline()
+    for endpoint in endpoints:
+        try:
+            return _call_endpoint(endpoint, call)
+        except _EndpointUnavailable:
+            if deadline and deadline.exhausted:
+                break
+    return None
+
+
+def _call_ispyb_or_broker(
+    operation: str,
+    args: list[str],
+    call: Callable[["SSHConnector"], list[dict[str, Any]]],
+) -> list[dict[str, Any]] | None:
+    """Makes a 'retrieve' call using the broker (if it's enabled),
+    or (if it's not, or cannot be reached) with our own connector.
+    """
+    if Config.BROKER:
+        try:
+            with timed("ispyb"):
+                return call_broker(operation, args)
+        except BrokerUnavailable as ex:
+            _LOGGER.warning("Broker unavailable, calling ISPyB directly (%s)", ex)
+    return call_ispyb(call)
+
+
+def retrieve_sessions(
+    username: str, ssh_connector: "SSHConnector"
+) -> list[dict[str, Any]]:
+    """The records of a user's sessions (an empty list if there are none)."""
+    import ispyb  # pylint: disable=import-outside-toplevel
+
+    try:
+        with timed("ispyb"):
+            return ssh_connector.core.retrieve_sessions_for_person_login(username)
+    except ispyb.NoResult:
+        _LOGGER.debug("ispyb.NoResult for user '%s'", username)
+        return []
+
+
+def get_tas_from_remote_ispyb(
+    username: str, ssh_connector: "SSHConnector | None" = None
+) -> set[str] | None:
+    """Gets the user's proposal. It returns None on error, an empty set if
+    there are no proposals or a set of proposals.
+
+    If a connector is provided it is used (and left running),
+    otherwise a new connector is created (see call_ispyb()) and stopped
+    for the request.
+    """
+    assert username
+
+    rs: list[dict[str, Any]] | None = (
+        retrieve_sessions(username, ssh_connector)
+        if ssh_connector
+        else _call_ispyb_or_broker(
+            "sessions", [username], partial(retrieve_sessions, username)
+        )
+    )
+    # Anything to process?
+    if rs is None:
+        _LOGGER.warning("No SSH connector for user '%s'", username)
+        return None
+    return get_tas_from_records(username, rs)
+
+
+def get_tas_from_records(username: str, rs: list[dict[str, Any]]) -> set[str]:
+    """Turns the records ISPyB returns for a user's sessions
+    into a (possibly empty) set of target access strings.
+    """
+    prop_id_set: set[str] = set()
+    if not rs:
+        _LOGGER.debug("No results for user '%s'", username)
+        return prop_id_set
+
+    # Typically you'll find the following fields in each item
+    # in the rs response: -
+    #
+    #    'id': 0000000,
+    #    'proposalId': 00000,
+    #    'startDate': datetime.datetime(2022, 12, 1, 15, 56, 30)
+    #    'endDate': datetime.datetime(2022, 12, 3, 18, 34, 9)
+    #    'beamline': 'i00-0'
+    #    'proposalCode': 'lb'
+    #    'proposalNumber': '12345'
+    #    'sessionNumber': 1
+    #    'comments': None
+    #    'personRoleOnSession': 'Data Access'
+    #    'personRemoteOnSession': 1
+    #
+    # Codes are expected to consist of 2 letters.
+    # Typically: lb, mx, nt, nr, sw, bi.
+    # The codes we collect are defined in Config.TAS_CODES_SET.
+    # If this is not set (is blank) we collect all codes.
+    #
+    # The resultant strings should correspond to a title value in a Project record.
+    # We only return records where there is a sessionNumber,
+    # and we should get this sort of set: -
+    #
+    #       {"lb12345-20", "lb12345-22"}
+    #                       --      --
+    #                        | ----- |
+    #                     Code   |   Session
+    #                         Proposal
+    for record in rs:
+        if "proposalCode" in record:
+            pc_str = f'{record["proposalCode"]}'
+            if not pc_str:
+                continue
+            if not Config.TAS_CODES_SET or pc_str in Config.TAS_CODES_SET:
+                pn_str = f'{record["proposalNumber"]}'
+                sn_str = f'{record["sessionNumber"]}'
+                # We'll use these values if they represent integers...
+                pn_int = None
+                sn_int = None
+                try:
+                    pn_int = int(pn_str)
+                    sn_int = int(sn_str)
+                except ValueError:
+                    _LOGGER.debug(
+                        "Proposal or session is not a number (%s, %s)", pn_str, sn_str
+                    )
+                if pn_int and sn_int:
+                    # OK - add "<code><proposalNum>-<sessionNum>"
+                    prop_id_set.add(f"{pc_str}{pn_str}-{sn_str}")
+
+    # Display the collected results for the user.
+    # These will be cached.
+    count = len(prop_id_set)
+    _LOGGER.debug(
+        "%s proposals from %s records for '%s': %s",
+        count,
+        len(rs),
+        username,
+        prop_id_set,
+    )
+    return prop_id_set
+
+
+def retrieve_persons(
+    code: str, proposal_number: str, visit_number: str, ssh_connector: "SSHConnector"
+) -> list[dict[str, Any]]:
+    """The records of the members of a proposal visit
+    (an empty list if there are none, or the query failed).
+    """
+    # pylint: disable=import-outside-toplevel
+    import ispyb
+    import pymysql
+
+    try:
+        with timed("ispyb"):
+            return ssh_connector.core.retrieve_persons_for_session(
+                code, proposal_number, visit_number
+            )
+    except ispyb.NoResult:
+        _LOGGER.debug(
+            "ispyb.NoResult for '%s%s-%s'", code, proposal_number, visit_number
+        )
+    except (pymysql.MySQLError, ispyb.ISPyBException) as ispyb_err:
+        # The query failed - typically because our database account is not
+        # permitted to execute the stored procedure. We treat this as "no
+        # members" (the caller gets an empty set), but it is an operational
+        # problem so it is logged as a warning rather than passed over.
+        _LOGGER.warning(
+            "%s calling retrieve_persons_for_session for '%s%s-%s' (%s)",
+            ispyb_err.__class__.__name__,
+            code,
+            proposal_number,
+            visit_number,
+            ispyb_err,
+        )
+    return []
+
+
+def get_users_from_remote_ispyb(
+    code: str, proposal_number: str, visit_number: str
+) -> set[str] | None:
+    """Gets the users (logins) that are members of a proposal visit.
+    It returns None if ISPyB cannot be reached at all, an empty set if the
+    visit has no members, is not known, or the query itself failed, and
+    otherwise a set of logins.
+    """
+    rs: list[dict[str, Any]] | None = _call_ispyb_or_broker(
+        "persons",
+        [code, proposal_number, visit_number],
+        partial(retrieve_persons, code, proposal_number, visit_number),
+    )
+    if rs is None:
+        _LOGGER.warning(
+            "No SSH connector for '%s%s-%s'", code, proposal_number, visit_number
+        )
+        return None
+
+    # Each record is expected to look like this,
+    # and it is the 'login' we return: -
+    #
+    #   'familyName': 'Dave'
+    #   'givenName': 'Lister'
+    #   'login': 'abc12345'
+    #   'role': 'Principal Investigator'
+    #   'title': None
+    #
+    # Records without a login are of no use to the caller (the login is the
+    # value the stack knows a user by), so they are dropped.
+    user_set: set[str] = {record["login"] for record in rs if record.get("login")}
+
+    _LOGGER.debug(
+        "%s users from %s records for '%s%s-%s': %s",
+        len(user_set),
+        len(rs),
+        code,
+        proposal_number,
+        visit_number,
+        user_set,
+    )
+    return user_set
@@ -0,0 +1,63 @@
+"""MessagePack (https://msgpack.org) encoding of our responses.
+
+Large TAS sets are expensive to encode and parse as JSON, so responses
+are also offered in the (compact, binary) MessagePack format, using the
+'msgpack' package. Sets are encoded as (sorted) arrays.
+"""
+
+from typing import Any
+
+import msgpack
+
+MSGPACK_MEDIA_TYPE: str = "application/msgpack"
+# Media types clients may use to ask for MessagePack
+MSGPACK_MEDIA_TYPES: set[str] = {
+    MSGPACK_MEDIA_TYPE,
+    "application/x-msgpack",
+    "application/vnd.msgpack",
+}
+
+
+def _default(obj: Any) -> Any:
+    """Encodes the types MessagePack has no form for (sets, as sorted arrays)."""
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    raise TypeError(f"Cannot encode {obj.__class__.__name__} as MessagePack")
+
+
+def packb(obj: Any) -> bytes:
+    """Encodes an object as MessagePack."""
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def unpackb(data: bytes) -> Any:
+    """Decodes MessagePack (a single object)."""
+    return msgpack.unpackb(data, raw=False)
+
+
+def wants_msgpack(accept: str | None) -> bool:
+    """True if an Accept header prefers MessagePack to JSON.
+    Media types without a quality ('q') have a quality of 1, and JSON is
+    preferred when the qualities are the same (so a client that also accepts
+    '*/*' keeps getting JSON).
+    """
+    if not accept:
+        return False
+    msgpack_q: float = 0.0
+    json_q: float = 0.0
+    for media_range in accept.split(","):
+        media_type, *params = (part.strip() for part in media_range.split(";"))
+        quality: float = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        media_type = media_type.lower()
+        if media_type in MSGPACK_MEDIA_TYPES:
+            msgpack_q = max(msgpack_q, quality)
+        elif media_type in ("application/json", "application/*", "*/*"):
+            json_q = max(json_q, quality)
+    return msgpack_q > json_q
@@ -0,0 +1,284 @@
+"""The startup prewarm stage.
+
+Run (as 'python -m app.prewarm') before the app is declared 'ready',
+this collects the target access strings for a list of users so the first request
+for each of them is served from the cache rather than from ISPyB.
+
+Users come from a file of usernames (one per line) and/or the file of
+most-requested users that the app writes when it shuts down. Queries are made
+over a single SSH tunnel by a bounded number of threads (each with its own
+database connection) at a limited rate, and we give up once our time budget
+has been used - the service goes 'ready' anyway.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from typing import TYPE_CHECKING
+from urllib.parse import quote
+
+from pymemcache.client.retrying import RetryingClient
+
+from .common import (
+    check_cache_tas_codes,
+    configure_logging,
+    get_memcached_retrying_client,
+    set_user_tas,
+    user_cache_life_s,
+    utc_now,
+    valid_encoded_username,
+)
+from .config import Config
+from .deadline import Deadline, deadline_scope
+from .ispyb_access import get_connector, get_tas_from_remote_ispyb
+
+if TYPE_CHECKING:
+    from .remote_ispyb_connector import SSHConnector
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Spaces calls to wait() so they occur no more often than the given rate.
+    A rate of zero (or less) imposes no limit.
+    """
+
+    def __init__(self, rate_per_second: float):
+        self._interval: float = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+        self._lock: threading.Lock = threading.Lock()
+        self._next_slot: float = time.monotonic()
+
+    def wait(self, deadline: float) -> bool:
+        """Waits for our next slot, returning False (without waiting)
+        if the slot is beyond the deadline (a time.monotonic() value).
+        """
+        if not self._interval:
+            return time.monotonic() < deadline
+        with self._lock:
+            slot: float = max(self._next_slot, time.monotonic())
+            if slot >= deadline:
+                return False
+            self._next_slot = slot + self._interval
+        time.sleep(max(0.0, slot - time.monotonic()))
+        return True
+
+
+def _read_usernames_file(filename: str) -> list[str]:
+    """Usernames from a file, one per line, ignoring blank lines and comments."""
+    with open(filename, "r", encoding="utf-8") as usernames_file:
+        lines: list[str] = [line.strip() for line in usernames_file]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def _read_top_users_file(filename: str) -> dict[str, int]:
+    """The (JSON) map of usernames and the number of times they were requested."""
+    with open(filename, "r", encoding="utf-8") as top_users_file:
+        content: str = top_users_file.read()
+    top_users: dict[str, int] = json.loads(content) if content else {}
+    return top_users
+
+
+def get_prewarm_usernames() -> list[str]:
+    """The (unique) usernames to prewarm. Those in the usernames file come first,
+    followed by the most-requested users (most requested first).
+    """
+    usernames: list[str] = []
+    if Config.PREWARM_USERNAMES_FILE:
+        try:
+            usernames.extend(_read_usernames_file(Config.PREWARM_USERNAMES_FILE))
+        except OSError as o_err:
+            _LOGGER.warning(
+                "Cannot read usernames file '%s' (%s)",
+                Config.PREWARM_USERNAMES_FILE,
+                o_err,
+            )
+    if Config.PREWARM_TOP_USERS_FILE and os.path.isfile(Config.PREWARM_TOP_USERS_FILE):
+        try:
+            top_users: dict[str, int] = _read_top_users_file(
+                Config.PREWARM_TOP_USERS_FILE
+            )
+            usernames.extend(
+                sorted(top_users, key=lambda name: top_users[name], reverse=True)
+            )
+        except (OSError, ValueError) as err:
+            _LOGGER.warning(
+                "Cannot read top users file '%s' (%s)",
+                Config.PREWARM_TOP_USERS_FILE,
+                err,
+            )
+
+    # Remove duplicates (preserving order) and anything we could not cache
+    valid_usernames: list[str] = []
+    for username in dict.fromkeys(usernames):
+        encoded_username: str = quote(username)
+        if valid_encoded_username(encoded_username):
+            valid_usernames.append(username)
+    return valid_usernames
+
+
+def record_requested_users(requested_users: Counter) -> None:
+    """Merges the number of requests made for each user into the top users file,
+    keeping the most-requested users. Each worker process calls this when it
+    shuts down, so the file is locked while it's updated.
+    """
+    if not Config.PREWARM_TOP_USERS_FILE or not requested_users:
+        return
+
+    try:
+        with open(Config.PREWARM_TOP_USERS_FILE, "a+", encoding="utf-8") as top_file:
+            fcntl.flock(top_file, fcntl.LOCK_EX)
+            top_file.seek(0)
+            content: str = top_file.read()
+            top_users: Counter = Counter(json.loads(content) if content else {})
+            top_users.update(requested_users)
+            top_file.seek(0)
+            top_file.truncate()
+            top_file.write(
+                json.dumps(dict(top_users.most_common(Config.PREWARM_TOP_USERS)))
+            )
+    except (OSError, ValueError) as err:
+        _LOGGER.warning(
+            "Cannot record top users in '%s' (%s)", Config.PREWARM_TOP_USERS_FILE, err
+        )
+
+
+class _Prewarmer:
+    """Collects and caches target access strings for a queue of users,
+    using a number of threads that share one SSH tunnel.
+    """
+
+    def __init__(self, usernames: list[str], deadline: float):
+        self._usernames: queue.SimpleQueue = queue.SimpleQueue()
+        for username in usernames:
+            self._usernames.put(username)
+        self._deadline: float = deadline
+        self._rate_limiter: RateLimiter = RateLimiter(Config.PREWARM_QUERIES_PER_SECOND)
+        self._lock: threading.Lock = threading.Lock()
+        self._connectors: list[SSHConnector] = []
+        self._tunnel_connector_claimed: bool = False
+        self.num_cached: int = 0
+
+    def run(self) -> int:
+        """Prewarms the cache, returning the number of users cached."""
+        # One connector creates the tunnel that the others share
+        # (its SSH and database timeouts are limited by our budget)
+        with deadline_scope(Deadline(self._deadline - time.monotonic())):
+            tunnel_connector: SSHConnector | None = get_connector()
+        if not tunnel_connector:
+            _LOGGER.warning("No SSH connector - cannot prewarm")
+            return 0
+        self._connectors.append(tunnel_connector)
+
+        threads: list[threading.Thread] = []
+        for _ in range(max(1, Config.PREWARM_CONCURRENCY)):
+            # Daemon threads - we do not wait for them beyond our deadline
+            thread = threading.Thread(
+                target=self._worker, args=(tunnel_connector,), daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(max(0.0, self._deadline - time.monotonic()))
+
+        if any(thread.is_alive() for thread in threads):
+            _LOGGER.warning("Prewarm budget exhausted")
+        with self._lock:
+            # The tunnel's connector (the first) is stopped last
+            for connector in reversed(self._connectors):
+                connector.stop()
+        return self.num_cached
+
+    def _claim_connector(
+        self, tunnel_connector: "SSHConnector"
+    ) -> "SSHConnector | None":
+        """The first worker uses the connector that owns the tunnel,
+        the others connect to the database through its tunnel.
+        """
+        with self._lock:
+            if not self._tunnel_connector_claimed:
+                self._tunnel_connector_claimed = True
+                return tunnel_connector
+        connector: SSHConnector | None = get_connector(server=tunnel_connector.server)
+        if connector:
+            with self._lock:
+                self._connectors.append(connector)
+        return connector
+
+    def _worker(self, tunnel_connector: "SSHConnector") -> None:
+        """Takes users from the queue, until it's empty or we run out of time."""
+        connector: SSHConnector | None = None
+        client: RetryingClient = get_memcached_retrying_client()
+        try:
+            while self._rate_limiter.wait(self._deadline):
+                try:
+                    username: str = self._usernames.get_nowait()
+                except queue.Empty:
+                    break
+                if connector is None:
+                    connector = self._claim_connector(tunnel_connector)
+                    if connector is None:
+                        break
+                tas_set: set[str] | None = get_tas_from_remote_ispyb(
+                    username=username, ssh_connector=connector
+                )
+                if tas_set is None:
+                    _LOGGER.warning("Failed to get TAS set for '%s'", username)
+                    continue
+                # Users are prewarmed together, so their expiry can be staggered
+                set_user_tas(
+                    client,
+                    quote(username),
+                    tas_set,
+                    utc_now(),
+                    life_s=user_cache_life_s(stagger=Config.CACHE_EXPIRY_STAGGER),
+                )
+                with self._lock:
+                    self.num_cached += 1
+        finally:
+            client.close()
+
+
+def prewarm() -> int:
+    """Prewarms the cache, returning the number of users cached.
+    A new cache generation is started first if the proposal codes have changed,
+    so users are cached in the generation that will be served.
+    """
+    client: RetryingClient = get_memcached_retrying_client()
+    try:
+        check_cache_tas_codes(client)
+    finally:
+        client.close()
+
+    usernames: list[str] = get_prewarm_usernames()
+    if not usernames:
+        _LOGGER.info("Nothing to prewarm")
+        return 0
+
+    _LOGGER.info(
+        "Prewarming %d users (concurrency=%d rate=%s/s budget=%ss)...",
+        len(usernames),
+        Config.PREWARM_CONCURRENCY,
+        Config.PREWARM_QUERIES_PER_SECOND,
+        Config.PREWARM_BUDGET_SECONDS,
+    )
+    start: float = time.monotonic()
+    num_cached: int = _Prewarmer(
+        usernames, deadline=start + Config.PREWARM_BUDGET_SECONDS
+    ).run()
+    _LOGGER.info(
+        "Prewarmed %d/%d users in %.1fs",
+        num_cached,
+        len(usernames),
+        time.monotonic() - start,
+    )
+    return num_cached
+
+
+if __name__ == "__main__":
+    configure_logging()
+    prewarm()
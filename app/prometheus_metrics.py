@@ -1,6 +1,6 @@
 """Prometheus metrics used by the fragalysis API module.
 """
-from prometheus_client import Counter
+from prometheus_client import Counter, Gauge
 
 
 class PrometheusMetrics:
@@ -44,6 +44,29 @@ class PrometheusMetrics:
         "Number of proposal cache misses",
     )
     proposal_cache_miss.reset()
+    upstream_in_flight = Gauge(
+        "fragalysis_upstream_in_flight",
+        "Number of ISPyB operations in progress",
+    )
+    upstream_queue_depth = Gauge(
+        "fragalysis_upstream_queue_depth",
+        "Number of requests waiting to start an ISPyB operation",
+    )
+    upstream_rejections = Counter(
+        "fragalysis_upstream_rejections",
+        "Number of ISPyB operations rejected (overload)",
+    )
+    upstream_rejections.reset()
+    refresh_lease_contentions = Counter(
+        "fragalysis_refresh_lease_contentions",
+        "Number of user refreshes leased to another worker",
+    )
+    refresh_lease_contentions.reset()
+    refresh_lease_takeovers = Counter(
+        "fragalysis_refresh_lease_takeovers",
+        "Number of user refreshes taken over from another worker",
+    )
+    refresh_lease_takeovers.reset()
 
     @staticmethod
     def new_tunnel():
@@ -72,3 +95,23 @@ class PrometheusMetrics:
     @staticmethod
     def new_proposal_cache_miss():
         PrometheusMetrics.proposal_cache_miss.inc()
+
+    @staticmethod
+    def set_upstream_in_flight(value: int):
+        PrometheusMetrics.upstream_in_flight.set(value)
+
+    @staticmethod
+    def set_upstream_queue_depth(value: int):
+        PrometheusMetrics.upstream_queue_depth.set(value)
+
+    @staticmethod
+    def new_upstream_rejection():
+        PrometheusMetrics.upstream_rejections.inc()
+
+    @staticmethod
+    def new_refresh_lease_contention():
+        PrometheusMetrics.refresh_lease_contentions.inc()
+
+    @staticmethod
+    def new_refresh_lease_takeover():
+        PrometheusMetrics.refresh_lease_takeovers.inc()
@@ -0,0 +1,119 @@
+"""Leases that let one worker (of any pod sharing the cache) refresh a user.
+
+Each worker serialises its own requests, but separate workers (and pods)
+used to refresh the same expired user at the same time, multiplying the ISPyB
+queries. Before refreshing a user a worker now 'add's the user's lease key,
+which only one can do. The lease expires (so it is not lost if its process dies)
+and is deleted when the refresh is done.
+
+A worker that cannot take the lease serves the user's expired set if there is
+one. If there is not it waits (briefly) for the lease holder's refresh to reach
+the cache, and takes the refresh over if it does not.
+"""
+
+import logging
+import os
+import socket
+import time
+from datetime import datetime
+
+from pymemcache.client.retrying import RetryingClient
+
+from .common import (
+    REFRESH_LEASE_CONTENDED_COUNTER_KEY,
+    REFRESH_LEASE_TAKEOVER_COUNTER_KEY,
+    UserTimestamp,
+    get_cache_namespace,
+    get_encoded_username_lease_key,
+    get_user_timestamp,
+)
+from .config import Config
+from .counters import incr_counter
+from .deadline import Deadline
+from .prometheus_metrics import PrometheusMetrics
+
+_LOGGER = logging.getLogger(__name__)
+
+# The time (seconds) between looks at the cache while waiting for a refresh
+_POLL_INTERVAL_S: float = 0.05
+# Identifies the lease holder (for debugging)
+_HOLDER: str = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _lease_key(client: RetryingClient, encoded_username: str) -> str:
+    return get_encoded_username_lease_key(get_cache_namespace(client), encoded_username)
+
+
+def acquire_refresh_lease(client: RetryingClient, encoded_username: str) -> bool:
+    """Takes the lease to refresh a user, returning False
+    (and counting the contention) if another worker holds it.
+    """
+    if client.add(
+        _lease_key(client, encoded_username),
+        _HOLDER,
+        expire=max(1, Config.REFRESH_LEASE_SECONDS),
+        noreply=False,
+    ):
+        return True
+    _LOGGER.debug("Refresh of '%s' is leased to another worker", encoded_username)
+    incr_counter(REFRESH_LEASE_CONTENDED_COUNTER_KEY)
+    PrometheusMetrics.new_refresh_lease_contention()
+    return False
+
+
+def release_refresh_lease(client: RetryingClient, encoded_username: str) -> None:
+    """Releases a user's refresh lease (when the refresh is done)."""
+    client.delete(_lease_key(client, encoded_username))
+
+
+def take_over_refresh_lease(client: RetryingClient, encoded_username: str) -> bool:
+    """Records a refresh taken over from a lease holder that did not finish
+    (in time), and takes the lease if it has gone (returning True if it was taken).
+    """
+    _LOGGER.info("Taking over the refresh of '%s'", encoded_username)
+    incr_counter(REFRESH_LEASE_TAKEOVER_COUNTER_KEY)
+    PrometheusMetrics.new_refresh_lease_takeover()
+    return bool(
+        client.add(
+            _lease_key(client, encoded_username),
+            _HOLDER,
+            expire=max(1, Config.REFRESH_LEASE_SECONDS),
+            noreply=False,
+        )
+    )
+
+
+def _is_newer(timestamp: UserTimestamp | None, collected: datetime | None) -> bool:
+    return timestamp is not None and (
+        collected is None or timestamp.collected > collected
+    )
+
+
+def wait_for_refresh(
+    client: RetryingClient,
+    encoded_username: str,
+    previous: UserTimestamp | None,
+    deadline: Deadline | None,
+) -> UserTimestamp | None:
+    """Waits for another worker's refresh of a user (one collected after the
+    previous timestamp), returning its timestamp, or None if the refresh did not
+    reach the cache before the lease was released (or expired), the configured
+    wait, or the deadline.
+    """
+    collected: datetime | None = previous.collected if previous else None
+    wait_s: float = Config.REFRESH_LEASE_WAIT_SECONDS
+    if deadline:
+        wait_s = min(wait_s, deadline.remaining_s())
+    give_up: float = time.monotonic() + wait_s
+    lease_key: str = _lease_key(client, encoded_username)
+    while True:
+        timestamp: UserTimestamp | None = get_user_timestamp(client, encoded_username)
+        if _is_newer(timestamp, collected):
+            return timestamp
+        if client.get(lease_key) is None:
+            # Released (look once more, the refresh may have just been written)
+            timestamp = get_user_timestamp(client, encoded_username)
+            return timestamp if _is_newer(timestamp, collected) else None
+        if time.monotonic() + _POLL_INTERVAL_S > give_up:
+            return None
+        time.sleep(_POLL_INTERVAL_S)
@@ -1,20 +1,26 @@
 """Handle logic connecting to the ISPyB server & database"""
 
 import logging
+import random
+import socket
 import threading
 import time
 import traceback
 
 import ispyb
+import paramiko
 import pymysql
 import sshtunnel
 from ispyb.connector.mysqlsp.main import ISPyBMySQLSPConnector as Connector
 from pymysql import Connection
-from pymysql.cursors import Cursor, DictCursor
+from pymysql.cursors import Cursor, DictCursor, SSCursor
 from pymysql.err import OperationalError
 
 from .config import Config
+from .deadline import Deadline, get_deadline
+from .endpoints import Endpoint
 from .prometheus_metrics import PrometheusMetrics
+from .timing import timed
 
 logger: logging.Logger = logging.getLogger(__name__)
 
@@ -23,11 +29,60 @@ logger: logging.Logger = logging.getLogger(__name__)
 PYMYSQL_CONNECT_TIMEOUT_S = 3
 PYMYSQL_READ_TIMEOUT_S = 3
 PYMYSQL_WRITE_TIMEOUT_S = 10
-# MySQL DB connection attempts.
-# An attempt to cope with intermittent OperationalError exceptions
-# that are seen to occur at "busy times". See m2ms-1403.
-PYMYSQL_OE_RECONNECT_ATTEMPTS = 5
-PYMYSQL_EXCEPTION_RECONNECT_DELAY_S = 1
+# The shortest timeout we'll try to connect with (if a deadline is near)
+PYMYSQL_MIN_CONNECT_TIMEOUT_S = 0.5
+
+
+def _backoff_s(attempt: int) -> float:
+    """The delay before a connection retry, which grows exponentially
+    (to a maximum) with the attempt. 'Full jitter' (a random delay up to that)
+    spreads out the retries of the many connectors that fail at the same time.
+    """
+    return random.uniform(
+        0,
+        min(
+            Config.ISPYB_CONNECT_BACKOFF_MAX_SECONDS,
+            Config.ISPYB_CONNECT_BACKOFF_SECONDS * 2**attempt,
+        ),
+    )
+
+
+# sshtunnel's (module) timeouts are shared by every forwarder (and thread)
+# so they are left at the configured values. The SSH timeouts of a tunnel
+# started for a request are its forwarder's own (see _SSHTunnelForwarder).
+sshtunnel.SSH_TIMEOUT = Config.SSH_TIMEOUT_SECONDS
+sshtunnel.TUNNEL_TIMEOUT = Config.SSH_TIMEOUT_SECONDS
+sshtunnel.DEFAULT_LOGLEVEL = logging.ERROR
+
+
+class _SSHTunnelForwarder(sshtunnel.SSHTunnelForwarder):
+    """An SSHTunnelForwarder with its own SSH timeout, which limits its
+    connection (and handshake) to the gateway.
+    """
+
+    def __init__(self, *args, ssh_timeout_s: float, **kwargs):
+        self.ssh_timeout_s: float = ssh_timeout_s
+        super().__init__(*args, **kwargs)
+
+    def _get_transport(self):
+        if self.ssh_proxy:
+            transport: paramiko.Transport = super()._get_transport()
+        else:
+            # paramiko connects (a host and port) without a timeout
+            transport = paramiko.Transport(
+                socket.create_connection(
+                    (self.ssh_host, self.ssh_port), timeout=self.ssh_timeout_s
+                )
+            )
+            transport.set_keepalive(self.set_keepalive)
+            transport.use_compression(compress=self.compression)
+            transport.daemon = self.daemon_transport
+        if isinstance(transport.sock, socket.socket):
+            transport.sock.settimeout(self.ssh_timeout_s)
+        transport.banner_timeout = self.ssh_timeout_s
+        transport.handshake_timeout = self.ssh_timeout_s
+        transport.auth_timeout = self.ssh_timeout_s
+        return transport
 
 
 class SSHConnector(Connector):
@@ -45,20 +100,44 @@ class SSHConnector(Connector):
     # to a type-checker, and the annotation is never evaluated at runtime.
     # pylint: disable=abstract-method,unsubscriptable-object
 
-    def __init__(self):  # pylint: disable=super-init-not-called
+    def __init__(  # pylint: disable=super-init-not-called
+        self,
+        server: sshtunnel.SSHTunnelForwarder | None = None,
+        endpoint: Endpoint | None = None,
+    ):
         self.conn_inactivity = Config.ISPYB_CONN_INACTIVITY
         self.lock: threading.Lock = threading.Lock()
         self.conn: Connection[Cursor] | None = None
         self.server: sshtunnel.SSHTunnelForwarder | None = None
+        # Did we start the server (or are we sharing it)?
+        self.owns_server: bool = False
         self.last_activity_ts: float | None = None
 
+        if server is not None:
+            # Share an existing (started) tunnel.
+            # We only need our own database connection through it.
+            logger.debug(
+                "Creating connector (shared tunnel local_bind_port=%s)",
+                server.local_bind_port,
+            )
+            self.server = server
+            with timed("db-connect"):
+                self.db_connect(
+                    db_user=Config.ISPYB_USER,
+                    db_pass=Config.ISPYB_PASSWORD,
+                    db_name=Config.ISPYB_DB,
+                    stop_server_on_failure=False,
+                )
+            return
+
+        # The endpoint (if given) provides the hosts (and database port)
         creds = {
-            "ssh_host": Config.SSH_HOST,
+            "ssh_host": endpoint.ssh_host if endpoint else Config.SSH_HOST,
             "ssh_user": Config.SSH_USER,
             "ssh_pass": Config.SSH_PASSWORD,
             "ssh_pkey": Config.SSH_PRIVATE_KEY_FILENAME,
-            "db_host": Config.ISPYB_HOST,
-            "db_port": Config.ISPYB_PORT,
+            "db_host": endpoint.ispyb_host if endpoint else Config.ISPYB_HOST,
+            "db_port": endpoint.ispyb_port if endpoint else Config.ISPYB_PORT,
             "db_user": Config.ISPYB_USER,
             "db_pass": Config.ISPYB_PASSWORD,
             "db_name": Config.ISPYB_DB,
@@ -68,7 +147,7 @@ class SSHConnector(Connector):
         assert self.server
         logger.debug(
             "Started remote ssh_host=%s ssh_user=%s local_bind_port=%s",
-            Config.SSH_HOST,
+            creds["ssh_host"],
             Config.SSH_USER,
             self.server.local_bind_port,
         )
@@ -85,11 +164,18 @@ class SSHConnector(Connector):
         db_pass,
         db_name,
     ):
-        """Connect to the remote server"""
-        sshtunnel.SSH_TIMEOUT = 5.0
-        sshtunnel.TUNNEL_TIMEOUT = 5.0
-        sshtunnel.DEFAULT_LOGLEVEL = logging.ERROR
-        self.conn_inactivity = int(self.conn_inactivity)
+        """Connect to the remote server.
+        The SSH timeouts are limited by any (request) deadline.
+        """
+        ssh_timeout_s: float = Config.SSH_TIMEOUT_SECONDS
+        deadline: Deadline | None = get_deadline()
+        if deadline:
+            remaining_s: float = deadline.remaining_s()
+            if remaining_s <= 0:
+                logger.warning("No time left to start an SSH tunnel")
+                deadline.exhausted = True
+                raise ispyb.ConnectionError
+            ssh_timeout_s = min(ssh_timeout_s, remaining_s)
 
         if ssh_pkey:
             logger.debug(
@@ -97,11 +183,12 @@ class SSHConnector(Connector):
                 ssh_host,
                 ssh_user,
             )
-            self.server = sshtunnel.SSHTunnelForwarder(
+            self.server = _SSHTunnelForwarder(
                 (ssh_host),
                 ssh_username=ssh_user,
                 ssh_pkey=ssh_pkey,
                 remote_bind_address=(db_host, db_port),
+                ssh_timeout_s=ssh_timeout_s,
             )
         else:
             logger.debug(
@@ -109,11 +196,12 @@ class SSHConnector(Connector):
                 ssh_host,
                 ssh_user,
             )
-            self.server = sshtunnel.SSHTunnelForwarder(
+            self.server = _SSHTunnelForwarder(
                 (ssh_host),
                 ssh_username=ssh_user,
                 ssh_password=ssh_pass,
                 remote_bind_address=(db_host, db_port),
+                ssh_timeout_s=ssh_timeout_s,
             )
         logger.debug("Created SSHTunnelForwarder")
 
@@ -123,24 +211,70 @@ class SSHConnector(Connector):
         self.server.daemon_transport = True
 
         logger.debug("Starting SSH server...")
-        self.server.start()
+        with timed("ssh"):
+            self.server.start()
+        self.owns_server = True
         PrometheusMetrics.new_tunnel()
         logger.debug("Started SSH server")
 
+        with timed("db-connect"):
+            self.db_connect(db_user=db_user, db_pass=db_pass, db_name=db_name)
+
+    def db_connect(
+        self,
+        db_user,
+        db_pass,
+        db_name,
+        stop_server_on_failure=True,
+        db_host=None,
+        db_port=None,
+    ):
+        """Connect to the database through our (started) SSH server,
+        or directly to the given host and port.
+        The server is stopped if we fail to connect, unless told otherwise
+        (i.e. when the server is shared with other connectors).
+
+        Attempts (and the delays between them) are limited by any (request)
+        deadline - we give up early rather than exceed it.
+        """
+        if db_host is None:
+            assert self.server
+            db_host = "127.0.0.1"
+            db_port = self.server.local_bind_port
+        self.conn_inactivity = int(self.conn_inactivity)
+        deadline: Deadline | None = get_deadline()
+
         # Try to connect to the database
         # a number of times (because it is known to fail)
         # before giving up...
+        # An attempt to cope with intermittent OperationalError exceptions
+        # that are seen to occur at "busy times". See m2ms-1403.
         connect_attempts = 0
         self.conn = None
-        while self.conn is None and connect_attempts < PYMYSQL_OE_RECONNECT_ATTEMPTS:
+        while self.conn is None and connect_attempts < Config.ISPYB_CONNECT_ATTEMPTS:
+            if connect_attempts > 0:
+                delay_s: float = _backoff_s(connect_attempts - 1)
+                if deadline and deadline.remaining_s() - delay_s < (
+                    PYMYSQL_MIN_CONNECT_TIMEOUT_S
+                ):
+                    logger.warning("No time left to retry the database connection")
+                    deadline.exhausted = True
+                    break
+                time.sleep(delay_s)
+            connect_timeout_s: float = PYMYSQL_CONNECT_TIMEOUT_S
+            if deadline:
+                connect_timeout_s = max(
+                    PYMYSQL_MIN_CONNECT_TIMEOUT_S,
+                    min(connect_timeout_s, deadline.remaining_s()),
+                )
             try:
                 self.conn = pymysql.connect(
                     user=db_user,
                     password=db_pass,
-                    host="127.0.0.1",
-                    port=self.server.local_bind_port,
+                    host=db_host,
+                    port=db_port,
                     database=db_name,
-                    connect_timeout=PYMYSQL_CONNECT_TIMEOUT_S,
+                    connect_timeout=connect_timeout_s,
                     read_timeout=PYMYSQL_READ_TIMEOUT_S,
                     write_timeout=PYMYSQL_WRITE_TIMEOUT_S,
                 )
@@ -156,7 +290,6 @@ class SSHConnector(Connector):
                 logger.debug("%s", repr(oe_e))
                 connect_attempts += 1
                 PrometheusMetrics.new_ispyb_connection_attempt()
-                time.sleep(PYMYSQL_EXCEPTION_RECONNECT_DELAY_S)
             except Exception as e:  # pylint: disable=broad-exception-caught
                 if connect_attempts == 0:
                     # So we only log our connection attempts once
@@ -169,7 +302,6 @@ class SSHConnector(Connector):
                 logger.warning("Unexpected %s", repr(e))
                 connect_attempts += 1
                 PrometheusMetrics.new_ispyb_connection_attempt()
-                time.sleep(PYMYSQL_EXCEPTION_RECONNECT_DELAY_S)
 
         if self.conn is not None:
             if connect_attempts > 0:
@@ -179,14 +311,16 @@ class SSHConnector(Connector):
             if connect_attempts > 0:
                 logger.warning("Failed to connect")
             PrometheusMetrics.failed_ispyb_connection()
-            self.server.stop()
+            if stop_server_on_failure and self.server:
+                self.server.stop()
             raise ispyb.ConnectionError
         self.last_activity_ts = time.time()
 
-    def create_cursor(self, dictionary=False):
+    def create_cursor(self, dictionary=False, unbuffered=False):
         """Create a server/db cursor.
         The parent class calls this with 'dictionary=True' when it needs rows
-        returned as dictionaries rather than tuples.
+        returned as dictionaries rather than tuples. An 'unbuffered' cursor
+        returns (tuple) rows as they arrive rather than reading them all first.
         """
         if (
             not self.last_activity_ts
@@ -201,7 +335,10 @@ class SSHConnector(Connector):
         if self.conn is None:
             raise ispyb.ConnectionError
 
-        cursor = self.conn.cursor(DictCursor if dictionary else Cursor)
+        if unbuffered:
+            cursor = self.conn.cursor(SSCursor)
+        else:
+            cursor = self.conn.cursor(DictCursor if dictionary else Cursor)
         if cursor is None:
             raise ispyb.ConnectionError
         return cursor
@@ -227,11 +364,89 @@ class SSHConnector(Connector):
             raise ispyb.NoResult
         return result
 
+    def call_query(self, query, args=None):
+        """Run a (read-only) SQL query, returning the rows as dictionaries.
+        Unlike call_sp_retrieve() an empty result is not an error.
+        """
+        assert self.conn
+        with self.lock:
+            cursor = self.create_cursor(dictionary=True)
+            try:
+                cursor.execute(query, args)
+                result = cursor.fetchall()
+            finally:
+                cursor.close()
+        return list(result)
+
+    def call_query_stream(self, query, args=None):
+        """Run a (read-only) SQL query, yielding the rows (as tuples)
+        as they are read from the server. The connection is held
+        until the rows are exhausted.
+        """
+        assert self.conn
+        with self.lock:
+            cursor = self.create_cursor(unbuffered=True)
+            try:
+                cursor.execute(query, args)
+                yield from cursor
+            finally:
+                cursor.close()
+
+    def abort(self) -> None:
+        """Aborts (from another thread) a query in progress, by shutting down
+        the database connection's socket. The connector must still be stopped
+        (by the thread using it).
+        """
+        sock: socket.socket | None = getattr(self.conn, "_sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # Already closed
+                pass
+
     def stop(self):
-        """Stop the server"""
-        if self.server is not None:
+        """Close the database connection and stop the server (if it's ours)"""
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except pymysql.err.Error:
+                # Already closed
+                pass
+        if self.server is not None and self.owns_server:
             self.server.stop()
         self.server = None
         self.conn = None
         self.last_activity_ts = None
         logger.debug("Server stopped")
+
+
+class DirectConnector(SSHConnector):
+    """A connector that connects directly to the database, without an SSH tunnel,
+    for deployments that can reach ISPyB directly. Everything but the connection
+    (the retries, cursors, queries and metrics) is that of the SSHConnector.
+    """
+
+    # pylint: disable=abstract-method
+
+    def __init__(  # pylint: disable=super-init-not-called
+        self, endpoint: Endpoint | None = None
+    ):
+        self.conn_inactivity = Config.ISPYB_CONN_INACTIVITY
+        self.lock: threading.Lock = threading.Lock()
+        self.conn: Connection[Cursor] | None = None
+        self.server: sshtunnel.SSHTunnelForwarder | None = None
+        self.owns_server: bool = False
+        self.last_activity_ts: float | None = None
+
+        db_host: str | None = endpoint.ispyb_host if endpoint else Config.ISPYB_HOST
+        db_port: int | None = endpoint.ispyb_port if endpoint else Config.ISPYB_PORT
+        logger.debug("Creating direct connector (%s:%s)", db_host, db_port)
+        with timed("db-connect"):
+            self.db_connect(
+                db_user=Config.ISPYB_USER,
+                db_pass=Config.ISPYB_PASSWORD,
+                db_name=Config.ISPYB_DB,
+                db_host=db_host,
+                db_port=db_port,
+            )
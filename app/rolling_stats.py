@@ -0,0 +1,239 @@
+"""Rolling (recent) request statistics, kept by each worker.
+
+The counters cover the time since the pod started, which hides what is
+happening now. So each worker also records recent activity in rings of time
+slots, held in a shared-memory file (like its counters): a fine ring (10-second
+slots, covering 5 minutes) and a coarse ring (1-minute slots, covering an hour).
+A slot holds the requests to each of our endpoints, as a histogram of their
+latencies (in buckets that are each 25% wider than the last), and the number of
+queries and pings, and of the ISPyB queries and pings they needed.
+
+Requests are recorded by the RollingStatsMiddleware. The stats merge the slots
+of every running worker to report, for the last minute, 5 minutes and hour,
+the request rate, the cache hit ratio, the upstream (ISPyB) query rate
+and the p50, p95 and p99 latency of each endpoint.
+"""
+
+import bisect
+import mmap
+import threading
+import time
+from typing import Any
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .common import (
+    ISPYB_PING_COUNTER_KEY,
+    ISPYB_QUERY_COUNTER_KEY,
+    PING_COUNTER_KEY,
+    QUERY_COUNTER_KEY,
+)
+from .shared_memory import create_worker_mmap, read_worker_files, remove_worker_file
+
+# The endpoints (route paths) whose requests we record
+_ENDPOINTS: tuple[str, ...] = (
+    "/target-access/{username}",
+    "/target-access/{username}/{tas}",
+    "/users/{tas}",
+    "/ping/",
+)
+_ENDPOINT_INDEX: dict[str, int] = {path: index for index, path in enumerate(_ENDPOINTS)}
+# The counters we record
+_COUNTED: tuple[str, ...] = (
+    QUERY_COUNTER_KEY,
+    ISPYB_QUERY_COUNTER_KEY,
+    PING_COUNTER_KEY,
+    ISPYB_PING_COUNTER_KEY,
+)
+_COUNTED_INDEX: dict[str, int] = {key: index for index, key in enumerate(_COUNTED)}
+# The upper bounds (milliseconds) of the latency buckets, 1ms to about a minute,
+# and a final bucket for anything longer
+_LATENCY_BOUNDS_MS: list[float] = [1.25**exponent for exponent in range(50)]
+_NUM_BUCKETS: int = len(_LATENCY_BOUNDS_MS) + 1
+
+# A slot is its epoch (the time it covers, in slots since 1970),
+# the counts and each endpoint's latency histogram (64-bit values)
+_COUNTS_OFFSET: int = 1
+_HISTOGRAMS_OFFSET: int = _COUNTS_OFFSET + len(_COUNTED)
+_SLOT_LEN: int = _HISTOGRAMS_OFFSET + len(_ENDPOINTS) * _NUM_BUCKETS
+_EMPTY_SLOT: memoryview = memoryview(bytes(8 * _SLOT_LEN)).cast("q")
+
+# The rings (slot seconds, number of slots) and where they start
+_RINGS: tuple[tuple[int, int], ...] = ((10, 30), (60, 60))
+_RING_OFFSETS: tuple[int, ...] = (0, 30 * _SLOT_LEN)
+_ROLLING_SIZE: int = 8 * _SLOT_LEN * sum(num_slots for _, num_slots in _RINGS)
+_ROLLING_SUFFIX: str = ".rolling"
+
+# The windows we report (name, seconds and the ring used)
+_WINDOWS: tuple[tuple[str, int, int], ...] = (
+    ("1m", 60, 0),
+    ("5m", 300, 0),
+    ("1h", 3600, 1),
+)
+
+
+class _WorkerRollingStats:
+    """The rolling stats of this process."""
+
+    def __init__(self) -> None:
+        self._mmap: mmap.mmap
+        self.path: str | None
+        self._mmap, self.path = create_worker_mmap(_ROLLING_SUFFIX, _ROLLING_SIZE)
+        self._values: memoryview = memoryview(self._mmap).cast("q")
+        self._lock: threading.Lock = threading.Lock()
+
+    def add(self, offset: int, value: int) -> None:
+        """Adds a value to the current slot of each ring."""
+        now_s: float = time.time()
+        with self._lock:
+            for (slot_s, num_slots), ring_offset in zip(_RINGS, _RING_OFFSETS):
+                epoch: int = int(now_s // slot_s)
+                base: int = ring_offset + (epoch % num_slots) * _SLOT_LEN
+                if self._values[base] != epoch:
+                    # The slot's last use was a previous turn of the ring
+                    self._values[base : base + _SLOT_LEN] = _EMPTY_SLOT
+                    self._values[base] = epoch
+                self._values[base + offset] += value
+
+    def close(self) -> None:
+        self._values.release()
+        self._mmap.close()
+        remove_worker_file(self.path)
+
+
+# This process's rolling stats (created when first needed)
+_ROLLING_STATS: _WorkerRollingStats | None = None
+_ROLLING_STATS_LOCK: threading.Lock = threading.Lock()
+
+
+def _get_rolling_stats() -> _WorkerRollingStats:
+    global _ROLLING_STATS  # pylint: disable=global-statement
+    with _ROLLING_STATS_LOCK:
+        if _ROLLING_STATS is None:
+            _ROLLING_STATS = _WorkerRollingStats()
+        return _ROLLING_STATS
+
+
+def close_rolling_stats() -> None:
+    global _ROLLING_STATS  # pylint: disable=global-statement
+    with _ROLLING_STATS_LOCK:
+        if _ROLLING_STATS is not None:
+            _ROLLING_STATS.close()
+            _ROLLING_STATS = None
+
+
+def record_count(key: str, value: int = 1) -> None:
+    """Records a count (counters we do not record are ignored)."""
+    index: int | None = _COUNTED_INDEX.get(key)
+    if index is not None:
+        (_ROLLING_STATS or _get_rolling_stats()).add(_COUNTS_OFFSET + index, value)
+
+
+def record_latency(endpoint: str, duration_s: float) -> None:
+    """Records a request to an endpoint (a route path) and its latency.
+    Endpoints we do not record are ignored.
+    """
+    index: int | None = _ENDPOINT_INDEX.get(endpoint)
+    if index is not None:
+        bucket: int = bisect.bisect_left(_LATENCY_BOUNDS_MS, 1_000 * duration_s)
+        (_ROLLING_STATS or _get_rolling_stats()).add(
+            _HISTOGRAMS_OFFSET + index * _NUM_BUCKETS + bucket, 1
+        )
+
+
+class RollingStatsMiddleware:
+    """An (ASGI) middleware that records the latency of each HTTP request
+    to one of our endpoints.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app: ASGIApp = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start: float = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # The route (and its path) is added to the scope by the router
+            endpoint: str | None = getattr(scope.get("route"), "path", None)
+            if endpoint:
+                record_latency(endpoint, time.perf_counter() - start)
+
+
+def _percentile_ms(histogram: list[int], count: int, fraction: float) -> float:
+    """A percentile of a latency histogram (the upper bound of its bucket)."""
+    target: float = fraction * count
+    cumulative: int = 0
+    for bucket, bucket_count in enumerate(histogram):
+        cumulative += bucket_count
+        if cumulative >= target:
+            break
+    return round(_LATENCY_BOUNDS_MS[min(bucket, len(_LATENCY_BOUNDS_MS) - 1)], 1)
+
+
+def _window_statistics(totals: list[int], window_s: float) -> dict[str, Any]:
+    """The statistics of a window, from the (merged) totals of its slots."""
+    endpoints: dict[str, Any] = {}
+    num_requests: int = 0
+    for index, endpoint in enumerate(_ENDPOINTS):
+        start: int = _HISTOGRAMS_OFFSET + index * _NUM_BUCKETS
+        histogram: list[int] = totals[start : start + _NUM_BUCKETS]
+        count: int = sum(histogram)
+        num_requests += count
+        endpoint_stats: dict[str, Any] = {
+            "requests": count,
+            "rate": round(count / window_s, 3),
+        }
+        if count:
+            endpoint_stats["p50_ms"] = _percentile_ms(histogram, count, 0.50)
+            endpoint_stats["p95_ms"] = _percentile_ms(histogram, count, 0.95)
+            endpoint_stats["p99_ms"] = _percentile_ms(histogram, count, 0.99)
+        endpoints[endpoint] = endpoint_stats
+
+    counts: dict[str, int] = {
+        key: totals[_COUNTS_OFFSET + index] for index, key in enumerate(_COUNTED)
+    }
+    queries: int = counts[QUERY_COUNTER_KEY]
+    ispyb_queries: int = counts[ISPYB_QUERY_COUNTER_KEY]
+    hit_ratio: str = "None"
+    if queries:
+        hit_ratio = f"{int(100.0 * (queries - ispyb_queries) / queries + 0.5)}%"
+    return {
+        "seconds": round(window_s),
+        "request_rate": round(num_requests / window_s, 3),
+        "hit_ratio": hit_ratio,
+        "upstream_query_rate": round(
+            (ispyb_queries + counts[ISPYB_PING_COUNTER_KEY]) / window_s, 3
+        ),
+        "endpoints": endpoints,
+    }
+
+
+def get_rolling_statistics() -> dict[str, Any]:
+    """The statistics of each window, merged across the running workers."""
+    now_s: float = time.time()
+    workers: list[memoryview] = [
+        memoryview(data).cast("q")
+        for data in read_worker_files(_ROLLING_SUFFIX, _ROLLING_SIZE)
+    ]
+    windows: dict[str, Any] = {}
+    for name, window_s, ring in _WINDOWS:
+        slot_s, num_slots = _RINGS[ring]
+        current: int = int(now_s // slot_s)
+        first: int = current - window_s // slot_s + 1
+        totals: list[int] = [0] * _SLOT_LEN
+        for values in workers:
+            for epoch in range(first, current + 1):
+                base: int = _RING_OFFSETS[ring] + (epoch % num_slots) * _SLOT_LEN
+                if values[base] != epoch:
+                    # Nothing recorded in this slot
+                    continue
+                for index in range(_COUNTS_OFFSET, _SLOT_LEN):
+                    totals[index] += values[base + index]
+        # The window runs from the start of its first slot
+        # to now (part of the way through the current slot)
+        windows[name] = _window_statistics(totals, now_s - first * slot_s)
+    return windows
@@ -0,0 +1,104 @@
+"""Per-worker shared-memory files.
+
+Each worker keeps some of its state (its counters and rolling stats) in small
+files (one of each per process, named after the process ID) in the counters
+directory, which is normally in shared memory. Other processes (the stats app)
+read them, and remove the files of workers that are no longer running.
+
+The directory also holds the pod's startup marker, created by the first worker
+to start (which does the pod's startup work).
+"""
+
+import logging
+import mmap
+import os
+
+from .config import Config
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def create_worker_mmap(suffix: str, size: int) -> tuple[mmap.mmap, str | None]:
+    """A (zeroed) memory map of this process's file with the given suffix,
+    and the file's path. If the file cannot be created the map is of
+    (private) memory, and the path is None.
+    """
+    try:
+        os.makedirs(Config.COUNTERS_DIRECTORY, exist_ok=True)
+        path: str = os.path.join(Config.COUNTERS_DIRECTORY, f"{os.getpid()}{suffix}")
+        with open(path, "w+b") as worker_file:
+            worker_file.truncate(size)
+            return mmap.mmap(worker_file.fileno(), size), path
+    except OSError as err:
+        _LOGGER.warning("Unable to create a '%s' file (%s)", suffix, err)
+        return mmap.mmap(-1, size), None
+
+
+# The (pod's) startup marker, removed by the entrypoint before the workers start
+_STARTUP_MARKER: str = "startup"
+
+
+def claim_pod_startup() -> bool:
+    """True for the first process (of a pod) to call this, which creates the
+    startup marker. The marker is in the pod's own shared memory, and outlives
+    workers that are restarted. If it cannot be created every process claims
+    the startup.
+    """
+    try:
+        os.makedirs(Config.COUNTERS_DIRECTORY, exist_ok=True)
+        marker: int = os.open(
+            os.path.join(Config.COUNTERS_DIRECTORY, _STARTUP_MARKER),
+            os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+        )
+    except FileExistsError:
+        return False
+    except OSError as err:
+        _LOGGER.warning("Unable to create the startup marker (%s)", err)
+        return True
+    os.close(marker)
+    return True
+
+
+def remove_worker_file(path: str | None) -> None:
+    if path:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _pid_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_worker_files(suffix: str, size: int) -> list[bytes]:
+    """The content of the files (with the given suffix and size) of every
+    running worker. The files of workers that are no longer running are removed.
+    """
+    contents: list[bytes] = []
+    try:
+        filenames: list[str] = os.listdir(Config.COUNTERS_DIRECTORY)
+    except OSError:
+        return contents
+    for filename in filenames:
+        pid: str = filename.removesuffix(suffix)
+        if pid == filename or not pid.isdigit():
+            continue
+        path: str = os.path.join(Config.COUNTERS_DIRECTORY, filename)
+        try:
+            if not _pid_running(int(pid)):
+                os.remove(path)
+                continue
+            with open(path, "rb") as worker_file:
+                data: bytes = worker_file.read(size)
+        except OSError:
+            continue
+        if len(data) == size:
+            contents.append(data)
+    return contents
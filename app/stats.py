@@ -2,7 +2,7 @@
 """Collects ping and target-access query stats along with built-in memcached stats."""
 
 import subprocess
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 from datetime import datetime
 from typing import Any
 from urllib.parse import quote, unquote
@@ -10,7 +10,12 @@ from urllib.parse import quote, unquote
 import humanize
 from pymemcache.client.retrying import RetryingClient
 
+from app.admission import get_upstream_gauges
+from app.broker_client import BrokerUnavailable, get_broker_status
 from app.common import (
+    CHANGE_POLL_HIGH_WATER_MARK_KEY,
+    CHANGE_POLL_TIMESTAMP_KEY,
+    CHANGE_POLL_USER_COUNTER_KEY,
     ISPYB_PING_COUNTER_KEY,
     ISPYB_QUERY_COUNTER_KEY,
     PING_CACHE_KEY,
@@ -18,12 +23,23 @@ from app.common import (
     PING_COUNTER_KEY,
     PING_STATUS_CHANGE_TIMESTAMP_KEY,
     QUERY_COUNTER_KEY,
-    get_encoded_username_timestamp_key,
+    REFRESH_CHANGED_COUNTER_KEY,
+    REFRESH_LEASE_CONTENDED_COUNTER_KEY,
+    REFRESH_LEASE_TAKEOVER_COUNTER_KEY,
+    REFRESH_UNCHANGED_COUNTER_KEY,
+    UPSTREAM_REJECTED_COUNTER_KEY,
+    UserTasRecord,
+    UserTimestamp,
+    get_cache_generation,
+    get_cache_namespace,
     get_memcached_retrying_client,
+    get_user_tas_record,
+    get_user_timestamp,
     utc_now,
-    valid_encoded_username,
 )
 from app.config import Config
+from app.counters import get_unflushed_counts
+from app.rolling_stats import get_rolling_statistics
 
 
 def get_statistics() -> dict[str, Any]:
@@ -31,9 +47,16 @@ def get_statistics() -> dict[str, Any]:
 
     # Populates root keys:
     #
+    # - broker (if enabled)
+    # - change_poll (if enabled)
+    # - cache
     # - code_set
+    # - expiry
     # - memcached
     # - ping
+    # - refresh_lease
+    # - rolling
+    # - upstream
     # - users
 
     stats_response: dict[str, Any] = {"code_set": list(Config.TAS_CODES_SET)}
@@ -50,23 +73,29 @@ def get_statistics() -> dict[str, Any]:
         memcached_stats[stat] = val
     stats_response["memcached"] = memcached_stats
 
+    # The cache namespace (users are only found in the current generation)
+
+    namespace: str = get_cache_namespace(client)
+    stats_response["cache"] = {
+        "namespace": Config.CACHE_NAMESPACE,
+        "generation": get_cache_generation(client),
+    }
+
     # Collect our own stats (ping/query counts)
 
     ping_status: str | None = client.get(PING_CACHE_KEY)
     ping_status_str: str = ping_status or "Unknown"
 
-    ping_count: int = client.get(PING_COUNTER_KEY)
-    if ping_count is None:
-        ping_count = 0
-    ispyb_ping_count: int = client.get(ISPYB_PING_COUNTER_KEY)
-    if ispyb_ping_count is None:
-        ispyb_ping_count = 0
-    query_count: int = client.get(QUERY_COUNTER_KEY)
-    if query_count is None:
-        query_count = 0
-    ispyb_query_count: int = client.get(ISPYB_QUERY_COUNTER_KEY)
-    if ispyb_query_count is None:
-        ispyb_query_count = 0
+    # The counts in the cache, and those the workers are yet to add to it
+    unflushed_counts: dict[str, int] = get_unflushed_counts()
+    ping_count: int = client.get(PING_COUNTER_KEY) or 0
+    ping_count += unflushed_counts[PING_COUNTER_KEY]
+    ispyb_ping_count: int = client.get(ISPYB_PING_COUNTER_KEY) or 0
+    ispyb_ping_count += unflushed_counts[ISPYB_PING_COUNTER_KEY]
+    query_count: int = client.get(QUERY_COUNTER_KEY) or 0
+    query_count += unflushed_counts[QUERY_COUNTER_KEY]
+    ispyb_query_count: int = client.get(ISPYB_QUERY_COUNTER_KEY) or 0
+    ispyb_query_count += unflushed_counts[ISPYB_QUERY_COUNTER_KEY]
 
     now: datetime = utc_now()
 
@@ -116,6 +145,66 @@ def get_statistics() -> dict[str, Any]:
         "query_reduction": f"{query_reduction_pcent}%",
     }
 
+    # Recent activity (of the running workers)
+
+    stats_response["rolling"] = get_rolling_statistics()
+
+    # Change polling (if enabled)
+
+    if Config.CHANGE_POLL_INTERVAL_SECONDS > 0:
+        change_poll_timestamp: datetime | None = client.get(CHANGE_POLL_TIMESTAMP_KEY)
+        change_poll_age_str: str = "Meaningless"
+        if isinstance(change_poll_timestamp, datetime):
+            change_poll_age_str = humanize.naturaldelta(now - change_poll_timestamp)
+        high_water_mark: datetime | None = client.get(CHANGE_POLL_HIGH_WATER_MARK_KEY)
+        stats_response["change_poll"] = {
+            "interval_seconds": Config.CHANGE_POLL_INTERVAL_SECONDS,
+            "action": "refresh" if Config.CHANGE_POLL_REFRESH else "invalidate",
+            "timestamp": (
+                change_poll_timestamp.isoformat()
+                if change_poll_timestamp
+                else "No poll yet"
+            ),
+            "age": change_poll_age_str,
+            "high_water_mark": (
+                high_water_mark.isoformat() if high_water_mark else "None"
+            ),
+            "user_count": client.get(CHANGE_POLL_USER_COUNTER_KEY) or 0,
+        }
+
+    # The ISPyB broker (if enabled)
+
+    if Config.BROKER:
+        try:
+            stats_response["broker"] = {"available": True} | get_broker_status()
+        except BrokerUnavailable as ex:
+            stats_response["broker"] = {"available": False, "error": str(ex)}
+
+    # Upstream admission control
+    # (with the operations in progress, and waiting, in every worker)
+
+    upstream_in_flight, upstream_queue_depth = get_upstream_gauges()
+    stats_response["upstream"] = {
+        "max_concurrency": Config.UPSTREAM_MAX_CONCURRENCY,
+        "max_queue": Config.UPSTREAM_MAX_QUEUE,
+        "pod_max_concurrency": Config.UPSTREAM_POD_MAX_CONCURRENCY or "None",
+        "rejected_count": (client.get(UPSTREAM_REJECTED_COUNTER_KEY) or 0)
+        + unflushed_counts[UPSTREAM_REJECTED_COUNTER_KEY],
+        "in_flight": upstream_in_flight,
+        "queue_depth": upstream_queue_depth,
+    }
+
+    # Refresh leases (refreshes found in progress elsewhere, and taken over)
+
+    stats_response["refresh_lease"] = {
+        "lease_seconds": Config.REFRESH_LEASE_SECONDS,
+        "wait_seconds": Config.REFRESH_LEASE_WAIT_SECONDS,
+        "contended_count": (client.get(REFRESH_LEASE_CONTENDED_COUNTER_KEY) or 0)
+        + unflushed_counts[REFRESH_LEASE_CONTENDED_COUNTER_KEY],
+        "takeover_count": (client.get(REFRESH_LEASE_TAKEOVER_COUNTER_KEY) or 0)
+        + unflushed_counts[REFRESH_LEASE_TAKEOVER_COUNTER_KEY],
+    }
+
     # Collect users and their target access lists.
     # We do this by calling 'memdump' which prints all the keys: -
     #   $ memdump -s localhost
@@ -125,6 +214,8 @@ def get_statistics() -> dict[str, Any]:
     #   ispyb-ping-counter
     #   ping-counter
     #   timestamp-ispyb-ping
+    #   taa:1:u:dave%20lister
+    #   taa:1:t:dave%20lister
     #
     # And we display a summary of the the user info: -
     #
@@ -135,29 +226,75 @@ def get_statistics() -> dict[str, Any]:
     )
     keys = result.stdout.decode("utf-8").split()
 
-    # Unquote and sort usernames
+    # Unquote and sort usernames (the user keys of the current generation)
+    user_key_prefix: str = f"{namespace}u:"
     usernames: list[str] = []
-    usernames.extend(unquote(key) for key in keys if valid_encoded_username(key))
+    usernames.extend(
+        unquote(key[len(user_key_prefix) :])
+        for key in keys
+        if key.startswith(user_key_prefix)
+    )
     usernames.sort()
 
     user_stats: list[dict[str, Any]] = []
     num_usernames: int = 0  # Number of usernames cached
     num_tas: int = 0  # Total number of TAS
     max_tas: int = 0  # Largest no. of TAS for any user
+    stored_bytes: int = 0  # Total (cached) size of the TAS
+    max_stored_bytes: int = 0  # Largest (cached) size of any user's TAS
+    num_compressed: int = 0  # Number of users whose TAS are compressed
+    num_chunked: int = 0  # Number of users whose TAS are chunked
+    expiries: Counter = Counter()  # Number of users with each expiry (minutes)
     for username in usernames:
         encoded_username: str = quote(username)
-        collected: datetime = client.get(
-            get_encoded_username_timestamp_key(encoded_username)
-        )
-        collected_iso: str = collected.isoformat()
-        access: set[str] = client.get(encoded_username)
-        tas = len(access)
+        timestamp: UserTimestamp | None = get_user_timestamp(client, encoded_username)
+        collected_iso: str = timestamp.collected.isoformat() if timestamp else "Unknown"
+        record: UserTasRecord | None = get_user_tas_record(client, encoded_username)
+        if record is None:
+            # Incomplete or corrupt
+            continue
+        tas = len(record.tas)
         user_stats.append(
-            {"username": username, "tas_count": tas, "collected": collected_iso}
+            {
+                "username": username,
+                "tas_count": tas,
+                "collected": collected_iso,
+                "life_s": timestamp.life_s if timestamp else None,
+                "expiry_s": timestamp.expiry_s if timestamp else None,
+                "stored_bytes": record.stored_bytes,
+                "compressed": record.compressed,
+                "chunks": record.chunks,
+            }
         )
         num_usernames += 1
         num_tas += tas
         max_tas = max(max_tas, tas)
+        stored_bytes += record.stored_bytes
+        max_stored_bytes = max(max_stored_bytes, record.stored_bytes)
+        num_compressed += int(record.compressed)
+        num_chunked += int(record.chunks > 0)
+        if timestamp:
+            expiries[round(timestamp.expiry_s / 60)] += 1
+
+    # Adaptive expiry.
+    # The refreshes of cached sets that did (and did not) change them,
+    # and the number of users with each expiry.
+    refresh_changed_count: int = client.get(REFRESH_CHANGED_COUNTER_KEY) or 0
+    refresh_changed_count += unflushed_counts[REFRESH_CHANGED_COUNTER_KEY]
+    refresh_unchanged_count: int = client.get(REFRESH_UNCHANGED_COUNTER_KEY) or 0
+    refresh_unchanged_count += unflushed_counts[REFRESH_UNCHANGED_COUNTER_KEY]
+    stats_response["expiry"] = {
+        "expiry_minutes": Config.CACHE_EXPIRY_MINUTES,
+        "max_expiry_minutes": max(
+            Config.CACHE_EXPIRY_MINUTES, Config.CACHE_EXPIRY_MAX_MINUTES
+        ),
+        "jitter_percent": Config.CACHE_EXPIRY_JITTER_PERCENT,
+        "refresh_changed_count": refresh_changed_count,
+        "refresh_unchanged_count": refresh_unchanged_count,
+        "user_expiry_minutes": {
+            f"{minutes}": expiries[minutes] for minutes in sorted(expiries)
+        },
+    }
 
     client.close()
 
@@ -167,6 +304,11 @@ def get_statistics() -> dict[str, Any]:
         "total_tas_count": num_tas,
         "max_tas_count": max_tas,
         "avg_tas_count": avg_tas,
+        "total_stored_bytes": stored_bytes,
+        "total_stored_size": humanize.naturalsize(stored_bytes),
+        "max_stored_bytes": max_stored_bytes,
+        "compressed_count": num_compressed,
+        "chunked_count": num_chunked,
         "user_stats": user_stats,
     }
 
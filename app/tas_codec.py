@@ -0,0 +1,142 @@
+"""A compact representation of a set of target access strings (TAS).
+
+Rather than the set's repr() we cache a sorted, prefix-delta-encoded
+('front-coded') form of it. Sorted TAS share long prefixes
+(i.e. "lb12345-1", "lb12345-2", ...), so each string is stored as the
+length of the prefix it shares with the previous one and the remaining
+suffix, one per line: -
+
+    0:lb12345-1
+    8:2
+
+The encoded form is compressed (zlib) if it is larger than a threshold.
+A leading byte records whether it has been compressed, and is followed by
+the set's ETag (a hash of the encoded set, so it is stable for the same set)
+which is calculated once, when the set is encoded.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import zlib
+from typing import Any, NamedTuple
+
+from .msgpack_codec import packb
+
+_PLAIN: bytes = b"p"
+_COMPRESSED: bytes = b"z"
+# The length of an ETag (hex characters)
+_ETAG_LEN: int = 16
+
+
+class TasPayload(bytes):
+    """An encoded (and possibly compressed) TAS set.
+    A distinct type so the cache serializer can recognise it.
+    """
+
+    @property
+    def compressed(self) -> bool:
+        return self[:1] == _COMPRESSED
+
+    @property
+    def etag(self) -> str:
+        return self[1 : 1 + _ETAG_LEN].decode("ascii")
+
+
+class TasResponseBody(bytes):
+    """The (pre-serialized) JSON '/target-access/{username}' response body
+    for a TAS set, preceded by the set's ETag.
+    A distinct type so the cache serializer can recognise it.
+    """
+
+    @property
+    def etag(self) -> str:
+        return self[:_ETAG_LEN].decode("ascii")
+
+    @property
+    def body(self) -> bytes:
+        return self[_ETAG_LEN:]
+
+
+class TasChunks(NamedTuple):
+    """Describes a payload too large for one cache item, which is
+    split into a number of chunks (stored under their own keys).
+    The size and CRC allow the reassembled payload to be checked.
+    """
+
+    num_chunks: int
+    size: int
+    crc: int
+
+    def to_str(self) -> str:
+        return f"{self.num_chunks},{self.size},{self.crc}"
+
+    @classmethod
+    def from_str(cls, value: str) -> "TasChunks":
+        num_chunks, size, crc = value.split(",")
+        return cls(num_chunks=int(num_chunks), size=int(size), crc=int(crc))
+
+
+def encode_tas_set(tas_set: set[str], compress_threshold: int) -> TasPayload:
+    """Encodes a TAS set, compressing it if the encoding
+    exceeds the threshold (in bytes).
+    """
+    lines: list[str] = []
+    previous: str = ""
+    for tas in sorted(tas_set):
+        prefix_len: int = len(os.path.commonprefix((previous, tas)))
+        lines.append(f"{prefix_len}:{tas[prefix_len:]}")
+        previous = tas
+    encoded: bytes = "\n".join(lines).encode("utf-8")
+    etag: bytes = hashlib.sha256(encoded).hexdigest()[:_ETAG_LEN].encode("ascii")
+    if len(encoded) > compress_threshold:
+        return TasPayload(_COMPRESSED + etag + zlib.compress(encoded))
+    return TasPayload(_PLAIN + etag + encoded)
+
+
+def get_tas_set_etag(tas_set: set[str]) -> str:
+    """The ETag of a TAS set (the one it would have if encoded)."""
+    # There's no need to compress it
+    return encode_tas_set(tas_set, compress_threshold=sys.maxsize).etag
+
+
+def encode_tas_response_body(
+    tas_set: set[str], etag: str, msgpack: bool = False
+) -> TasResponseBody:
+    """The JSON (or MessagePack) response body for a TAS set (with its ETag).
+    It matches the 'TargetAccessGetUserTasResponse' model,
+    with the strings sorted so the body is the same for the same set.
+    """
+    content: dict[str, Any] = {
+        "count": len(tas_set),
+        "target_access": sorted(tas_set),
+    }
+    body: bytes = (
+        packb(content)
+        if msgpack
+        else json.dumps(content, separators=(",", ":")).encode("utf-8")
+    )
+    return TasResponseBody(etag.encode("ascii") + body)
+
+
+def decode_tas_set(payload: bytes) -> set[str]:
+    """Decodes an encoded TAS set. It raises ValueError (or zlib.error)
+    if the payload is not one of ours.
+    """
+    kind: bytes = payload[:1]
+    encoded: bytes = payload[1 + _ETAG_LEN :]
+    if kind == _COMPRESSED:
+        encoded = zlib.decompress(encoded)
+    elif kind != _PLAIN:
+        raise ValueError(f"Unknown TAS payload kind ({kind!r})")
+
+    tas_set: set[str] = set()
+    if not encoded:
+        return tas_set
+    previous: str = ""
+    for line in encoded.decode("utf-8").split("\n"):
+        prefix_len, _, suffix = line.partition(":")
+        previous = previous[: int(prefix_len)] + suffix
+        tas_set.add(previous)
+    return tas_set
@@ -0,0 +1,137 @@
+"""Per-request timing of the phases of a request.
+
+Code that does something worth timing (a cache read, starting the SSH tunnel,
+connecting to the database, an ISPyB query, serialization) wraps it in
+'timed(phase)'. The time spent is added to the phase's total for the request
+being handled, which is found through a context variable set by the
+TimingMiddleware. Outside a request (in background threads) 'timed()' does
+nothing. Phases can be nested (i.e. a cache write includes its serialization).
+
+The middleware returns the phase totals (and the request total) in a
+'Server-Timing' response header, if enabled, and logs requests that take
+longer than the configured threshold as a (JSON) structured record.
+"""
+
+import json
+import logging
+from contextlib import AbstractContextManager, nullcontext
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Any
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import Config
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class RequestTimings:
+    """The total time (seconds) spent in each phase of a request."""
+
+    __slots__ = ("phases",)
+
+    def __init__(self) -> None:
+        self.phases: dict[str, float] = {}
+
+    def add(self, phase: str, duration_s: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + duration_s
+
+    def server_timing(self, total_s: float) -> str:
+        """The phases (and total) as a Server-Timing header value."""
+        metrics: list[str] = [
+            f"{phase};dur={1_000 * duration_s:.1f}"
+            for phase, duration_s in self.phases.items()
+        ]
+        metrics.append(f"total;dur={1_000 * total_s:.1f}")
+        return ", ".join(metrics)
+
+
+_REQUEST_TIMINGS: ContextVar[RequestTimings | None] = ContextVar(
+    "request_timings", default=None
+)
+_NOT_TIMED: AbstractContextManager = nullcontext()
+
+
+class _Span:
+    """Adds the time spent in a 'with' block to a phase."""
+
+    __slots__ = ("_timings", "_phase", "_start")
+
+    def __init__(self, timings: RequestTimings, phase: str):
+        self._timings: RequestTimings = timings
+        self._phase: str = phase
+        self._start: float = 0.0
+
+    def __enter__(self) -> None:
+        self._start = perf_counter()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._timings.add(self._phase, perf_counter() - self._start)
+
+
+def timed(phase: str) -> AbstractContextManager:
+    """A context manager that times a phase of the current request."""
+    timings: RequestTimings | None = _REQUEST_TIMINGS.get()
+    if timings is None:
+        return _NOT_TIMED
+    return _Span(timings, phase)
+
+
+class TimingMiddleware:
+    """An (ASGI) middleware that times each HTTP request,
+    adding a Server-Timing header and logging slow requests.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app: ASGIApp = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: RequestTimings = RequestTimings()
+        token = _REQUEST_TIMINGS.set(timings)
+        start: float = perf_counter()
+        status_code: int = 0
+        # Event streams are long-lived (they're never slow requests)
+        event_stream: bool = False
+
+        async def send_with_timing(message: Message) -> None:
+            nonlocal status_code, event_stream
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                event_stream = any(
+                    name == b"content-type" and value.startswith(b"text/event-stream")
+                    for name, value in message.get("headers", [])
+                )
+                if Config.SERVER_TIMING:
+                    headers: MutableHeaders = MutableHeaders(scope=message)
+                    headers.append(
+                        "Server-Timing", timings.server_timing(perf_counter() - start)
+                    )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _REQUEST_TIMINGS.reset(token)
+            total_ms: float = 1_000 * (perf_counter() - start)
+            if (
+                Config.SLOW_REQUEST_MS
+                and total_ms >= Config.SLOW_REQUEST_MS
+                and not event_stream
+            ):
+                record: dict[str, Any] = {
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status_code,
+                    "total_ms": round(total_ms, 1),
+                    "phases_ms": {
+                        phase: round(1_000 * duration_s, 1)
+                        for phase, duration_s in timings.phases.items()
+                    },
+                }
+                _LOGGER.warning("Slow request %s", json.dumps(record))
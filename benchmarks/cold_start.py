@@ -0,0 +1,135 @@
+"""Measures the cold start of a worker.
+
+A worker imports 'app.app' and then serves its first request. Modules that
+are slow to import (the ISPyB, SSH and MySQL modules, YAML, humanize and
+dateutil) are now only imported when they are first needed, so they no longer
+delay the import. We report: -
+
+-   The time to import 'app.app' in a new interpreter
+-   The time to import the deferred modules (what the import used to include)
+-   Which of the deferred modules are (still) loaded by the import
+-   The time from launching uvicorn to the first served '/version/' request
+
+The last step runs the app's startup, which needs memcached
+(at TAA_MEMCACHED_LOCATION). It is skipped if uvicorn fails to serve.
+
+Run from the project root: -
+
+    python -m benchmarks.cold_start
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+# Number of times each measurement is repeated (we report the median)
+_REPEATS: int = 5
+# Modules that are slow to import, and are only imported when needed
+_DEFERRED_MODULES: tuple[str, ...] = (
+    "dateutil.parser",
+    "humanize",
+    "ispyb",
+    "paramiko",
+    "pymysql",
+    "sshtunnel",
+    "yaml",
+)
+# The port used for the first request measurement
+_PORT: int = 18080
+# How long to wait for the first request (seconds)
+_FIRST_REQUEST_TIMEOUT_S: float = 30.0
+
+
+def _import_s(statement: str) -> float:
+    """The median time (seconds) to run an import statement in a new interpreter."""
+    code: str = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    times: list[float] = []
+    for _ in range(_REPEATS):
+        output: str = subprocess.run(
+            [sys.executable, "-c", code], check=True, capture_output=True, text=True
+        ).stdout
+        times.append(float(output.split()[-1]))
+    return statistics.median(times)
+
+
+def _loaded_deferred_modules() -> list[str]:
+    """The deferred modules that are loaded by importing 'app.app'."""
+    code: str = (
+        "import sys\n"
+        "import app.app\n"
+        f"print(' '.join(m for m in {_DEFERRED_MODULES!r} if m in sys.modules))\n"
+    )
+    output: str = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout
+    return output.split()
+
+
+def _first_request_s() -> float | None:
+    """The time (seconds) from launching uvicorn to the first served request,
+    or None if nothing was served.
+    """
+    url: str = f"http://127.0.0.1:{_PORT}/version/"
+    start: float = time.perf_counter()
+    with subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "app.app:auth",
+            "--port",
+            str(_PORT),
+            "--log-level",
+            "warning",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    ) as server:
+        try:
+            while time.perf_counter() - start < _FIRST_REQUEST_TIMEOUT_S:
+                if server.poll() is not None:
+                    return None
+                try:
+                    with urllib.request.urlopen(url, timeout=1) as response:
+                        if response.status == 200:
+                            return time.perf_counter() - start
+                except (urllib.error.URLError, ConnectionError):
+                    time.sleep(0.01)
+            return None
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main() -> None:
+    app_s: float = _import_s("import app.app")
+    deferred_s: float = _import_s(
+        "\n".join(f"import {module}" for module in _DEFERRED_MODULES)
+    )
+    print(f"Import app.app            {1_000 * app_s:>8.1f}ms")
+    print(f"Import deferred modules   {1_000 * deferred_s:>8.1f}ms")
+    loaded: list[str] = _loaded_deferred_modules()
+    print(f"Deferred modules loaded   {', '.join(loaded) if loaded else 'none':>8}")
+
+    first_request: list[float] = []
+    for _ in range(_REPEATS):
+        first_request_s: float | None = _first_request_s()
+        if first_request_s is None:
+            print("First request             (not served - is memcached running?)")
+            return
+        first_request.append(first_request_s)
+    print(
+        f"First request             {1_000 * statistics.median(first_request):>8.1f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
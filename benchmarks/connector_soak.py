@@ -0,0 +1,417 @@
+"""A soak test of the connector lifecycle, failing if resources leak.
+
+Every ISPyB call creates a connector (an SSH tunnel, with its forwarding threads,
+and a MySQL connection through it), makes its query and stops the connector.
+A path that forgets to stop a connector (or only stops part of one) leaves
+sockets and threads behind, which a worker only notices when it runs out.
+
+We drive tens of thousands of create/query/stop cycles through the app's own
+code (user and visit queries, with endpoint failover and hedging, and
+connectors sharing one tunnel, as the prewarm does) against a local stand-in
+for the SSH tunnel and the database. The stand-ins use real sockets and threads
+(a listener, a forwarding thread and a thread for each connection) so leaks
+are visible, and inject failures: tunnels that fail to start, connections
+that fail (and are retried), and queries that find nothing, raise a data error
+or lose their connection.
+
+After a warm-up we sample (when the cycles in flight are done) the number of
+threads, open file descriptors and (tracemalloc) traced memory. The test fails
+if, at the end, threads or descriptors have grown beyond a small allowance,
+memory has a growth trend, or any stand-in tunnel or connection was never
+stopped (even if its socket was closed by the garbage collector).
+
+Run from the project root: -
+
+    python -m benchmarks.connector_soak [cycles]
+"""
+
+import gc
+import logging
+import os
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, NamedTuple
+
+import pymysql
+import sshtunnel
+
+# The configuration the app is imported with (two endpoints, hedged calls,
+# no delay between connection attempts and a short endpoint cool-down)
+_ENVIRONMENT: dict[str, str] = {
+    "TAA_ISPYB_ENDPOINTS": "bastion-1/ispyb-1:3306,bastion-2/ispyb-2:3306",
+    "TAA_SSH_USER": "soak",
+    "TAA_SSH_PASSWORD": "soak",
+    "TAA_ISPYB_USER": "soak",
+    "TAA_ISPYB_PASSWORD": "soak",
+    "TAA_ISPYB_DIRECT": "no",
+    "TAA_BROKER": "no",
+    "TAA_HEDGE_REQUESTS": "yes",
+    "TAA_HEDGE_DELAY_SECONDS": "0.002",
+    "TAA_ISPYB_CONNECT_BACKOFF_SECONDS": "0",
+    "TAA_ENDPOINT_COOLDOWN_SECONDS": "0.5",
+}
+
+_DEFAULT_CYCLES: int = 20_000
+# The cycles run at once
+_CONCURRENCY: int = 4
+# The share of the cycles that are a warm-up (before the baseline sample)
+_WARM_UP_FRACTION: float = 0.1
+# The number of samples taken
+_SAMPLES: int = 40
+# How long (seconds) to wait for (hedged) calls to finish before a sample
+_SETTLE_S: float = 2.0
+
+# Injected failures (the probability of each)
+_TUNNEL_FAILURE_RATE: float = 0.02
+_CONNECT_FAILURE_RATE: float = 0.05
+_NO_RESULT_RATE: float = 0.2
+_DATA_ERROR_RATE: float = 0.01
+_LOST_CONNECTION_RATE: float = 0.01
+# The longest time (seconds) a stand-in query takes
+_QUERY_MAX_S: float = 0.002
+
+# The growth (from the baseline) we allow before we call it a leak
+_THREAD_ALLOWANCE: int = 2
+_FD_ALLOWANCE: int = 4
+# The (fitted) memory growth allowed over the whole soak (bytes)
+_MEMORY_GROWTH_ALLOWANCE: int = 1_000_000
+
+_SEED: int = 42
+_RNG: random.Random = random.Random(_SEED)
+
+
+class _Resources:
+    """The stand-in tunnels and connections that have not been stopped."""
+
+    def __init__(self) -> None:
+        self._lock: threading.Lock = threading.Lock()
+        self.tunnels: int = 0
+        self.connections: int = 0
+
+    def add(self, tunnels: int = 0, connections: int = 0) -> None:
+        with self._lock:
+            self.tunnels += tunnels
+            self.connections += connections
+
+
+_OPEN: _Resources = _Resources()
+
+
+def _fails(rate: float) -> bool:
+    return _RNG.random() < rate
+
+
+class _StandInTunnel:
+    """Stands in for the app's SSHTunnelForwarder. Like the real one it
+    listens on a local port, with a forwarding thread (and a thread for each
+    connection), all of which are closed when it is stopped.
+    """
+
+    def __init__(self, ssh_address_or_host: Any, **_: Any):
+        self.ssh_host: Any = ssh_address_or_host
+        self.daemon_forward_servers: bool = True
+        self.daemon_transport: bool = True
+        self.local_bind_port: int = 0
+        self._listener: socket.socket | None = None
+        self._stopping: threading.Event = threading.Event()
+        self._lock: threading.Lock = threading.Lock()
+        self._connections: list[socket.socket] = []
+        self._threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        if _fails(_TUNNEL_FAILURE_RATE):
+            raise sshtunnel.BaseSSHTunnelForwarderError(
+                f"Could not establish session to SSH gateway ({self.ssh_host})"
+            )
+        self._listener = socket.create_server(("127.0.0.1", 0))
+        self._listener.settimeout(0.05)
+        self.local_bind_port = self._listener.getsockname()[1]
+        forwarder: threading.Thread = threading.Thread(
+            target=self._forward, name="stand-in-forwarder", daemon=True
+        )
+        self._threads.append(forwarder)
+        forwarder.start()
+        _OPEN.add(tunnels=1)
+
+    def _forward(self) -> None:
+        assert self._listener
+        while not self._stopping.is_set():
+            try:
+                connection, _ = self._listener.accept()
+            except TimeoutError:
+                continue
+            except OSError:
+                break
+            with self._lock:
+                self._connections.append(connection)
+                channel: threading.Thread = threading.Thread(
+                    target=self._serve,
+                    args=(connection,),
+                    name="stand-in-channel",
+                    daemon=True,
+                )
+                self._threads.append(channel)
+            channel.start()
+
+    def _serve(self, connection: socket.socket) -> None:
+        """Reads (and discards) what the client sends, until it closes."""
+        try:
+            while connection.recv(1024):
+                pass
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+    def stop(self) -> None:
+        if self._listener is None:
+            return
+        self._stopping.set()
+        try:
+            # Wakes the forwarding thread (waiting to accept a connection)
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        with self._lock:
+            for connection in self._connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+        self._listener.close()
+        self._listener = None
+        _OPEN.add(tunnels=-1)
+
+
+class _StandInCursor:
+    """Stands in for a pymysql cursor, making 'retrieve' calls."""
+
+    def __init__(self, connection: "_StandInConnection"):
+        self._connection: _StandInConnection = connection
+        self._rows: list[dict[str, Any]] = []
+
+    def callproc(self, procname: str, args: tuple[Any, ...]) -> None:
+        self._connection.send(procname)
+        time.sleep(_RNG.uniform(0, _QUERY_MAX_S))
+        if _fails(_DATA_ERROR_RATE):
+            raise pymysql.err.DataError(1406, "Data too long")
+        if _fails(_LOST_CONNECTION_RATE):
+            raise pymysql.err.OperationalError(2013, "Lost connection to server")
+        if _fails(_NO_RESULT_RATE):
+            self._rows = []
+        elif procname == "retrieve_sessions_for_person_login":
+            self._rows = [
+                {"proposalCode": "lb", "proposalNumber": "12345", "sessionNumber": n}
+                for n in range(1, 11)
+            ]
+        else:
+            self._rows = [{"login": f"{args[0]}{args[1]}-{n}"} for n in range(5)]
+
+    def fetchall(self) -> list[dict[str, Any]]:
+        return self._rows
+
+    def close(self) -> None:
+        self._rows = []
+
+
+class _StandInConnection:
+    """Stands in for a pymysql connection (a socket through the tunnel)."""
+
+    DataError: type[Exception] = pymysql.err.DataError
+
+    def __init__(self, sock: socket.socket):
+        self._sock: socket.socket | None = sock
+        _OPEN.add(connections=1)
+
+    def send(self, procname: str) -> None:
+        if self._sock is None:
+            raise pymysql.err.InterfaceError(0, "")
+        self._sock.sendall(procname.encode("utf-8"))
+
+    def cursor(self, *_: Any) -> _StandInCursor:
+        return _StandInCursor(self)
+
+    def close(self) -> None:
+        if self._sock is None:
+            raise pymysql.err.Error("Already closed")
+        self._sock.close()
+        self._sock = None
+        _OPEN.add(connections=-1)
+
+
+def _stand_in_connect(**kwargs: Any) -> _StandInConnection:
+    """Stands in for pymysql.connect(), connecting to the (stand-in) tunnel."""
+    if _fails(_CONNECT_FAILURE_RATE):
+        raise pymysql.err.OperationalError(2003, "Can't connect to MySQL server")
+    try:
+        sock: socket.socket = socket.create_connection(
+            (kwargs["host"], kwargs["port"]), timeout=kwargs.get("connect_timeout")
+        )
+    except OSError as ex:
+        raise pymysql.err.OperationalError(2003, repr(ex)) from ex
+    return _StandInConnection(sock)
+
+
+def _open_fds() -> int:
+    """The number of open file descriptors (-1 if we cannot tell)."""
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return -1
+
+
+class _Sample(NamedTuple):
+    """The resources in use after a number of cycles."""
+
+    cycles: int
+    # Stand-in tunnels and connections that were not stopped (before they
+    # are garbage collected, which closes a forgotten connector's connection)
+    unstopped: int
+    threads: int
+    fds: int
+    memory: int
+
+
+def _sample(cycles: int) -> _Sample:
+    """The resources in use once the calls in flight (i.e. hedged calls)
+    are done.
+    """
+    give_up: float = time.monotonic() + _SETTLE_S
+    while (_OPEN.tunnels or _OPEN.connections) and time.monotonic() < give_up:
+        time.sleep(0.01)
+    unstopped: int = _OPEN.tunnels + _OPEN.connections
+    gc.collect()
+    return _Sample(
+        cycles,
+        unstopped,
+        threading.active_count(),
+        _open_fds(),
+        tracemalloc.get_traced_memory()[0],
+    )
+
+
+def _soak(
+    cycles: int, operations: list[Callable[[], Any]]
+) -> tuple[list[_Sample], Counter]:
+    """Runs the cycles (random operations), returning the samples
+    and the outcomes.
+    """
+    outcomes: Counter = Counter()
+
+    def cycle(_: int) -> None:
+        try:
+            result: Any = _RNG.choice(operations)()
+            outcomes["ok" if result is not None else "none"] += 1
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            outcomes[ex.__class__.__name__] += 1
+
+    samples: list[_Sample] = []
+    warm_up: int = int(cycles * _WARM_UP_FRACTION)
+    batch: int = max(1, (cycles - warm_up) // _SAMPLES)
+    done: int = 0
+    with ThreadPoolExecutor(max_workers=_CONCURRENCY) as executor:
+        for size in [warm_up] + [batch] * _SAMPLES:
+            list(executor.map(cycle, range(size)))
+            done += size
+            sample: _Sample = _sample(done)
+            samples.append(sample)
+            print(
+                f"{sample.cycles:>8} {sample.unstopped:>9} {sample.threads:>8}"
+                f" {sample.fds:>8} {sample.memory / 1024:>10.1f}",
+                flush=True,
+            )
+    return samples, outcomes
+
+
+def main() -> None:
+    cycles: int = int(sys.argv[1]) if len(sys.argv) > 1 else _DEFAULT_CYCLES
+
+    # The app's configuration is read when it's imported
+    os.environ.update(_ENVIRONMENT)
+    # pylint: disable=import-outside-toplevel,protected-access
+    from app import remote_ispyb_connector
+    from app.ispyb_access import (
+        get_connector,
+        get_tas_from_remote_ispyb,
+        get_users_from_remote_ispyb,
+    )
+
+    # The (expected) failures are logged as warnings
+    logging.disable(logging.WARNING)
+    remote_ispyb_connector._SSHTunnelForwarder = _StandInTunnel
+    pymysql.connect = _stand_in_connect
+
+    def shared_tunnel() -> set[str] | None:
+        """Connectors sharing one tunnel (as the prewarm uses them)."""
+        tunnel_connector = get_connector()
+        if tunnel_connector is None:
+            return None
+        connectors = [tunnel_connector]
+        try:
+            for _ in range(2):
+                if connector := get_connector(server=tunnel_connector.server):
+                    connectors.append(connector)
+            tas: set[str] = set()
+            for connector in connectors:
+                tas |= get_tas_from_remote_ispyb("abc12345", connector) or set()
+            return tas
+        finally:
+            # Stopped in the reverse order (the tunnel's connector last)
+            for connector in reversed(connectors):
+                connector.stop()
+
+    operations: list[Callable[[], Any]] = [
+        lambda: get_tas_from_remote_ispyb(f"user-{_RNG.randrange(1_000)}"),
+        lambda: get_users_from_remote_ispyb("lb", "12345", f"{_RNG.randrange(50)}"),
+        shared_tunnel,
+    ]
+
+    tracemalloc.start()
+    print(f"{'cycles':>8} {'unstopped':>9} {'threads':>8} {'fds':>8} {'memory':>8}KiB")
+    start: float = time.perf_counter()
+    samples, outcomes = _soak(cycles, operations)
+    elapsed_s: float = time.perf_counter() - start
+    tracemalloc.stop()
+
+    print(f"{cycles} cycles in {elapsed_s:.1f}s: {dict(outcomes.most_common())}")
+    baseline: _Sample = samples[0]
+    final: _Sample = samples[-1]
+    unstopped: int = max(sample.unstopped for sample in samples)
+    thread_growth: int = final.threads - baseline.threads
+    fd_growth: int = final.fds - baseline.fds
+    memory_slope: float = statistics.linear_regression(
+        [sample.cycles for sample in samples], [sample.memory for sample in samples]
+    ).slope
+    memory_growth: float = memory_slope * (final.cycles - baseline.cycles)
+    print(
+        f"Growth: threads {thread_growth:+d}, fds {fd_growth:+d},"
+        f" memory {memory_growth / 1024:+.1f}KiB (fitted)"
+    )
+
+    leaks: list[str] = []
+    if unstopped:
+        leaks.append(f"{unstopped} tunnel(s) or connection(s) not stopped")
+    if thread_growth > _THREAD_ALLOWANCE:
+        leaks.append(f"threads grew by {thread_growth}")
+    if fd_growth > _FD_ALLOWANCE:
+        leaks.append(f"file descriptors grew by {fd_growth}")
+    if memory_growth > _MEMORY_GROWTH_ALLOWANCE:
+        leaks.append(f"memory grew by {memory_growth / 1024:.1f}KiB")
+    if leaks:
+        print(f"FAIL: {'; '.join(leaks)}")
+        sys.exit(1)
+    print("PASS")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Replays a request trace to compare upstream refresh storms with fixed,
+jittered and staggered cache expiry.
+
+After a restart (or a large prewarm) every user's set is collected within a few
+minutes. With a fixed expiry they all expire together, and the next request
+of each user opens an SSH tunnel (a refresh) at about the same time. Each set's
+life is now reduced by a random amount (TAA_CACHE_EXPIRY_JITTER_PERCENT) and
+prewarmed sets can be staggered across the whole expiry (TAA_CACHE_EXPIRY_STAGGER).
+
+The trace (requests, as '<seconds> <username>' lines) is replayed against a
+simulated cache using the app's own set life ('user_cache_life_s()'). Every user
+in the trace is prewarmed at the start. A refresh occupies ISPyB for a random
+time and we report, for each expiry policy, the refreshes, the peak number of
+concurrent refreshes and the busiest minute. Without a trace file a synthetic
+one is generated (users with a skewed mix of request rates).
+
+The test fails unless the configured policy (the defaults, unless they're
+overridden by the environment) at least halves both of the fixed policy's peaks.
+Jitter alone barely reduces them - it's staggering the prewarmed sets that
+spreads their refreshes.
+
+Run from the project root: -
+
+    python -m benchmarks.expiry_storm [trace-file]
+"""
+
+import heapq
+import random
+import sys
+from collections import Counter
+from collections.abc import Iterator
+
+from app.common import user_cache_life_s
+from app.config import Config
+
+# The synthetic trace
+_USERS: int = 2_000
+_TRACE_S: float = 4 * 60 * 60
+# The mean time (seconds) between a user's requests (the users' rates vary)
+_MEAN_REQUEST_INTERVAL_S: float = 60.0
+# The time taken to prewarm all the users (seconds)
+_PREWARM_S: float = 120.0
+# The median (and spread) of the time a refresh takes (seconds)
+_REFRESH_MEDIAN_S: float = 1.5
+_REFRESH_SIGMA: float = 0.5
+# The expiry policies (jitter percentage and stagger) compared
+# with the configured policy
+_POLICIES: tuple[tuple[str, float, bool], ...] = (
+    ("fixed", 0.0, False),
+    ("jitter", 10.0, False),
+    ("jitter+stagger", 10.0, True),
+)
+# The configured policy's peaks must be no more than this fraction
+# of the fixed policy's
+_MAX_PEAK_RATIO: float = 0.5
+
+_SEED: int = 42
+
+
+def _synthetic_trace(rng: random.Random) -> Iterator[tuple[float, str]]:
+    """Requests (time, username) from users with (Pareto) varying rates."""
+    requests: list[tuple[float, str]] = []
+    for user in range(_USERS):
+        mean_interval_s: float = _MEAN_REQUEST_INTERVAL_S * rng.paretovariate(1.5) / 3
+        at_s: float = rng.expovariate(1 / mean_interval_s)
+        while at_s < _TRACE_S:
+            requests.append((at_s, f"user-{user}"))
+            at_s += rng.expovariate(1 / mean_interval_s)
+    requests.sort()
+    yield from requests
+
+
+def _read_trace(filename: str) -> Iterator[tuple[float, str]]:
+    """Requests (time, username) from a file, relative to the first request."""
+    requests: list[tuple[float, str]] = []
+    with open(filename, "r", encoding="utf-8") as trace_file:
+        for line in trace_file:
+            fields: list[str] = line.split(maxsplit=1)
+            if len(fields) == 2:
+                requests.append((float(fields[0]), fields[1].strip()))
+    requests.sort()
+    start_s: float = requests[0][0] if requests else 0.0
+    for at_s, username in requests:
+        yield at_s - start_s, username
+
+
+def _replay(
+    trace: list[tuple[float, str]], stagger: bool, rng: random.Random
+) -> tuple[int, int, int]:
+    """Replays the trace, returning the number of refreshes,
+    their peak concurrency and the most started in any minute.
+    """
+    # When each user's set expires
+    expires: dict[str, float] = {}
+    for username in sorted({username for _, username in trace}):
+        collected_s: float = rng.uniform(0, _PREWARM_S)
+        expires[username] = collected_s + user_cache_life_s(stagger=stagger)
+
+    # The times the (in-progress) refreshes end, and the users being refreshed
+    in_flight: list[float] = []
+    refreshing: dict[str, float] = {}
+    refreshes: int = 0
+    peak: int = 0
+    per_minute: Counter = Counter()
+    for at_s, username in trace:
+        while in_flight and in_flight[0] <= at_s:
+            heapq.heappop(in_flight)
+        if refreshing.get(username, 0.0) > at_s or expires[username] > at_s:
+            continue
+        # A refresh (the new set is collected when it ends)
+        refresh_s: float = rng.lognormvariate(0, _REFRESH_SIGMA) * _REFRESH_MEDIAN_S
+        heapq.heappush(in_flight, at_s + refresh_s)
+        refreshing[username] = at_s + refresh_s
+        expires[username] = at_s + refresh_s + user_cache_life_s()
+        refreshes += 1
+        peak = max(peak, len(in_flight))
+        per_minute[int(at_s // 60)] += 1
+    return refreshes, peak, max(per_minute.values(), default=0)
+
+
+def main() -> None:
+    rng: random.Random = random.Random(_SEED)
+    trace: list[tuple[float, str]] = list(
+        _read_trace(sys.argv[1]) if len(sys.argv) > 1 else _synthetic_trace(rng)
+    )
+    users: int = len({username for _, username in trace})
+    print(
+        f"{len(trace):,} requests from {users:,} users"
+        f" (expiry {Config.CACHE_EXPIRY_MINUTES} minutes)"
+    )
+    print(f"{'Policy':<16}{'Refreshes':>10}{'Peak concurrent':>17}{'Peak/minute':>13}")
+    configured: tuple[str, float, bool] = (
+        "configured",
+        Config.CACHE_EXPIRY_JITTER_PERCENT,
+        Config.CACHE_EXPIRY_STAGGER,
+    )
+    results: dict[str, tuple[int, int, int]] = {}
+    for name, jitter_percent, stagger in _POLICIES + (configured,):
+        Config.CACHE_EXPIRY_JITTER_PERCENT = jitter_percent
+        # The same random values for each policy (the set lives, which use the
+        # 'random' module, must not repeat the values of the replay's generator)
+        random.seed(_SEED + 1)
+        results[name] = _replay(trace, stagger, random.Random(_SEED))
+        refreshes, peak, peak_per_minute = results[name]
+        print(f"{name:<16}{refreshes:>10,}{peak:>17,}{peak_per_minute:>13,}")
+
+    _, fixed_peak, fixed_peak_per_minute = results["fixed"]
+    _, peak, peak_per_minute = results["configured"]
+    failures: list[str] = []
+    if peak > fixed_peak * _MAX_PEAK_RATIO:
+        failures.append(f"peak concurrency {peak} (fixed {fixed_peak})")
+    if peak_per_minute > fixed_peak_per_minute * _MAX_PEAK_RATIO:
+        failures.append(
+            f"busiest minute {peak_per_minute} (fixed {fixed_peak_per_minute})"
+        )
+    if failures:
+        print(f"FAIL: the configured expiry does not flatten the {'; '.join(failures)}")
+        sys.exit(1)
+    print("PASS")
+
+
+if __name__ == "__main__":
+    main()
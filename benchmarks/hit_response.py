@@ -0,0 +1,94 @@
+"""Compares the CPU time of a '/target-access/{username}' cache hit.
+
+The original hit deserialized the cached (repr) set with eval(), built a
+TargetAccessGetUserTasResponse (validating the set) and FastAPI then
+re-encoded it as JSON. Now the refresh stores the response body and a hit
+simply returns those bytes. The compact (decoded) set is what we fall back
+to when there is no cached response body.
+
+Only the CPU work of a hit is measured (the cache serializer's round-trip
+and the response), not the memcached network round-trip.
+
+Run from the project root: -
+
+    python -m benchmarks.hit_response
+"""
+
+import time
+from collections.abc import Callable
+from typing import Any
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app.app import TargetAccessGetUserTasResponse
+from app.common import TaSerde
+from app.config import Config
+from app.tas_codec import decode_tas_set, encode_tas_response_body, encode_tas_set
+
+# Numbers of TAS in a user's set
+_SIZES: tuple[int, ...] = (10, 1_000, 50_000)
+# Minimum CPU time (seconds) to spend measuring each case
+_MIN_CPU_S: float = 1.0
+
+_SERDE: TaSerde = TaSerde()
+_KEY: str = "benchmark"
+
+
+def _tas_set(size: int) -> set[str]:
+    """A realistic set - 50 visits for each proposal."""
+    return {f"lb{10000 + i // 50}-{i % 50 + 1}" for i in range(size)}
+
+
+def _original_hit(value: bytes, flags: int) -> bytes:
+    tas_set: set[str] = _SERDE.deserialize(_KEY, value, flags)
+    model = TargetAccessGetUserTasResponse(count=len(tas_set), target_access=tas_set)
+    return JSONResponse(content=jsonable_encoder(model)).body
+
+
+def _compact_hit(value: bytes, flags: int) -> bytes:
+    tas_set: set[str] = decode_tas_set(_SERDE.deserialize(_KEY, value, flags))
+    model = TargetAccessGetUserTasResponse(count=len(tas_set), target_access=tas_set)
+    return JSONResponse(content=jsonable_encoder(model)).body
+
+
+def _pre_serialized_hit(value: bytes, flags: int) -> bytes:
+    response_body = _SERDE.deserialize(_KEY, value, flags)
+    return Response(content=response_body.body, media_type="application/json").body
+
+
+def _cpu_us(hit: Callable[[bytes, int], bytes], cached: tuple[Any, int]) -> float:
+    """The mean CPU time (microseconds) of a hit."""
+    value, flags = cached
+    value = value.encode("utf-8") if isinstance(value, str) else value
+    calls: int = 0
+    start: float = time.process_time()
+    while (elapsed := time.process_time() - start) < _MIN_CPU_S:
+        hit(value, flags)
+        calls += 1
+    return 1_000_000 * elapsed / calls
+
+
+def main() -> None:
+    print(
+        f"{'TAS':>8} {'original':>12} {'compact':>12}"
+        f" {'response':>12} {'speed-up':>9}"
+    )
+    for size in _SIZES:
+        tas_set: set[str] = _tas_set(size)
+        payload = encode_tas_set(tas_set, Config.CACHE_COMPRESS_THRESHOLD_BYTES)
+        original_us: float = _cpu_us(_original_hit, _SERDE.serialize(_KEY, tas_set))
+        compact_us: float = _cpu_us(_compact_hit, _SERDE.serialize(_KEY, payload))
+        response_us: float = _cpu_us(
+            _pre_serialized_hit,
+            _SERDE.serialize(_KEY, encode_tas_response_body(tas_set, payload.etag)),
+        )
+        print(
+            f"{size:>8} {original_us:>10.1f}us {compact_us:>10.1f}us"
+            f" {response_us:>10.1f}us {original_us / response_us:>8.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
 #!/usr/bin/env python
-"""Clears the cache for a given user."""
+"""Clears the cache for a given user (or every user).
+
+This invalidates the user just as the '/target-access/{username}' DELETE
+endpoint does, removing the cached target access strings and the time
+they were collected. With '--all' every user is invalidated
+(by starting a new cache generation).
+"""
 
 import sys
 from typing import NoReturn
@@ -9,27 +15,35 @@ from pymemcache.client.retrying import RetryingClient
 
 from app.common import (
     get_memcached_retrying_client,
+    invalidate_users,
+    new_cache_generation,
     valid_encoded_username,
 )
 
 
 def error(msg: str) -> NoReturn:
     print(f"ERROR: {msg}")
-    print('Usage: clear.py [username|"user name"]')
+    print('Usage: clear.py [--all|username|"user name"]')
     sys.exit(1)
 
 
 if len(sys.argv) != 2:
     error("Missing username")
 
+if sys.argv[1] == "--all":
+    _CLIENT: RetryingClient = get_memcached_retrying_client()
+    print(f"New cache generation ({new_cache_generation(_CLIENT)})")
+    _CLIENT.close()
+    sys.exit(0)
+
 _USERNAME: str = sys.argv[1]
 _ENCODED_USERNAME: str = quote(_USERNAME)
 
 if not valid_encoded_username(_ENCODED_USERNAME):
     error(f'"{_USERNAME}" is not a valid username')
 
-# Get the Target Access strings for the user
+# Remove the Target Access strings for the user
 # and the time they were collected
-_CLIENT: RetryingClient = get_memcached_retrying_client()
-_ = _CLIENT.delete(_ENCODED_USERNAME)
+_CLIENT = get_memcached_retrying_client()
+invalidate_users(_CLIENT, [_USERNAME])
 _CLIENT.close()
@@ -2,10 +2,32 @@
 
 #set -e
 
+# Launch the (optional) ISPyB broker, shared by all the workers
+# (they call ISPyB directly if it cannot be reached).
+if [ "${TAA_BROKER}" = "yes" ]; then
+    echo "+> Launching ISPyB broker..."
+    python -m app.broker &
+fi
+
+# Prewarm the cache (for a list of users) before we declare ourselves 'ready'.
+# It first starts a new cache generation if the proposal codes have changed.
+# The stage is limited by TAA_PREWARM_BUDGET_SECONDS,
+# after which we become ready anyway. Failure is not fatal.
+rm -f "${HOME}/RUNNING"
+echo "+> Prewarming..."
+python -m app.prewarm
+touch "${HOME}/RUNNING"
+
+# The first worker to start does the pod's startup work
+# (it creates a marker in shared memory, which must not be left from a previous run).
+rm -f "${TAA_COUNTERS_DIRECTORY:-/dev/shm/taa-counters}/startup"
+
 # Run the container using both the customer-facing stats service
 # and the internal authentication service endpoint.
 # Done by launching two uvicorn instances in parallel.
+# The auth service replaces this shell (exec) so it receives our signals
+# (and can record its most-requested users when it's stopped).
 echo "+> Launching uvicorn (x2)..."
 echo "+> WORKERS=${WORKERS}"
 uvicorn app.app:stats --host 0.0.0.0 --port 8081 & \
-    uvicorn app.app:auth --host 0.0.0.0 --port 8080 --workers ${WORKERS}
+    exec uvicorn app.app:auth --host 0.0.0.0 --port 8080 --workers ${WORKERS}
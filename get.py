@@ -1,13 +1,16 @@
 #!/usr/bin/env python
-"""Gets the cache for a given user."""
+"""Gets the cache for a given user (using the API client).
+With '--msgpack' the (binary) MessagePack response is requested,
+and it is decoded (and printed as JSON).
+"""
 
+import json
 import os
 import sys
 from typing import NoReturn
 from urllib.parse import quote
 
-import requests
-
+from app.client import TargetAccessClient, TargetAccessClientError
 from app.common import (
     valid_encoded_username,
 )
@@ -15,14 +18,18 @@ from app.common import (
 
 def error(msg: str) -> NoReturn:
     print(f"ERROR: {msg}")
-    print('Usage: get.py [username|"user name"]')
+    print('Usage: get.py [--msgpack] [username|"user name"]')
     sys.exit(1)
 
 
-if len(sys.argv) != 2:
+_ARGS: list[str] = sys.argv[1:]
+_MSGPACK: bool = "--msgpack" in _ARGS
+if _MSGPACK:
+    _ARGS.remove("--msgpack")
+if len(_ARGS) != 1:
     error("Missing username")
 
-_USERNAME: str = sys.argv[1]
+_USERNAME: str = _ARGS[0]
 _ENCODED_USERNAME: str = quote(_USERNAME)
 _QUERY_KEY: str = os.environ["TAA_QUERY_KEY"]
 
@@ -31,12 +38,17 @@ if not valid_encoded_username(_ENCODED_USERNAME):
 
 # Trigger a local request (using the API)
 # to get the Target Access strings for the user
-resp: requests.Response = requests.get(
-    f"http://auth/target-access/{_ENCODED_USERNAME}",
-    headers={"X-TAAQueryKey": _QUERY_KEY},
-    timeout=4,
-)
-if resp.status_code == 200:
-    print(resp.text)
-else:
-    error(f"Failed get request ({resp.status_code}) '{resp.text}")
+with TargetAccessClient(
+    "http://auth", query_key=_QUERY_KEY, timeout_s=4, msgpack=_MSGPACK
+) as client:
+    try:
+        tas: frozenset[str] = client.get_user_tas(_USERNAME)
+    except TargetAccessClientError as ex:
+        error(f"Failed get request ({ex.status_code}) '{ex}'")
+    print(
+        json.dumps(
+            {"count": len(tas), "target_access": sorted(tas)}, separators=(",", ":")
+        )
+    )
+    latency: dict[str, float] = client.get_metrics()["latency"]["target-access"]
+    print(f"({'MessagePack' if _MSGPACK else 'JSON'} in {latency['p50_ms']}ms)")
@@ -12,8 +12,10 @@ import humanize
 from pymemcache.client.retrying import RetryingClient
 
 from app.common import (
-    get_encoded_username_timestamp_key,
+    UserTimestamp,
     get_memcached_retrying_client,
+    get_user_tas,
+    get_user_timestamp,
     utc_now,
     valid_encoded_username,
 )
@@ -37,20 +39,32 @@ if not valid_encoded_username(_ENCODED_USERNAME):
 # Get the Target Access strings for the user
 # and the time they were collected
 _CLIENT: RetryingClient = get_memcached_retrying_client()
-_TAS: set[str] = _CLIENT.get(_ENCODED_USERNAME) or set()
-_COLLECTED: datetime | None = _CLIENT.get(
-    get_encoded_username_timestamp_key(_ENCODED_USERNAME)
-)
+_TAS: set[str] = get_user_tas(_CLIENT, _ENCODED_USERNAME) or set()
+_TIMESTAMP: UserTimestamp | None = get_user_timestamp(_CLIENT, _ENCODED_USERNAME)
 _CLIENT.close()
 
-_COLLECTED_STR: str = _COLLECTED.isoformat() if _COLLECTED else "Nothing collected"
+_COLLECTED_STR: str = "Nothing collected"
 _AGE_STR: str = "Meaningless"
-if isinstance(_COLLECTED, datetime):
-    _AGE_STR = humanize.naturaldelta(utc_now() - _COLLECTED)
+_LIFE_STR: str = "Meaningless"
+_EXPIRY_STR: str = "Meaningless"
+if _TIMESTAMP:
+    _NOW: datetime = utc_now()
+    _COLLECTED_STR = _TIMESTAMP.collected.isoformat()
+    _AGE_STR = humanize.naturaldelta(_NOW - _TIMESTAMP.collected)
+    _REMAINING_S: float = _TIMESTAMP.remaining_s(_NOW)
+    _EXPIRY_STR = humanize.naturaldelta(_TIMESTAMP.expiry_s)
+    _LIFE_STR = (
+        f"{humanize.naturaldelta(_TIMESTAMP.life_s)}"
+        f" ({'expires in ' if _REMAINING_S >= 0 else 'expired '}"
+        f"{humanize.naturaldelta(abs(_REMAINING_S))}"
+        f"{'' if _REMAINING_S >= 0 else ' ago'})"
+    )
 
 print(f"  Username: '{_USERNAME}' ({_ENCODED_USERNAME})")
 print(f" Collected: {_COLLECTED_STR}")
 print(f" Cache age: {_AGE_STR}")
+print(f"Cache life: {_LIFE_STR}")
+print(f"    Expiry: {_EXPIRY_STR} (adaptive)")
 print(f"No. of TAS: {len(_TAS)}")
 if _TAS:
     print("   TAS Set:")
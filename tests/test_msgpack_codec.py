@@ -0,0 +1,59 @@
+"""Tests of our MessagePack encoding, and of the negotiation of its use."""
+
+from typing import Any
+
+import pytest
+
+from app.msgpack_codec import packb, unpackb, wants_msgpack
+
+_VALUES: list[Any] = [
+    None,
+    True,
+    0x100000000,
+    -0x81,
+    "lb12345-1",
+    b"\x00" * 0x100,
+    {"count": 2, "target_access": ["lb12345-1", "lb12345-2"]},
+    {"nested": [{"a": [None, True, -1]}, {"b": {"c": b"\x01"}}]},
+]
+
+
+@pytest.mark.parametrize("value", _VALUES)
+def test_round_trip(value: Any) -> None:
+    assert unpackb(packb(value)) == value
+
+
+def test_packb_sorts_sets() -> None:
+    tas: set[str] = {"lb12345-2", "lb12345-10", "lb12345-1"}
+    assert unpackb(packb({"target_access": tas})) == {"target_access": sorted(tas)}
+
+
+@pytest.mark.parametrize(
+    "accept",
+    [
+        "application/msgpack",
+        "application/x-msgpack",
+        "application/msgpack, application/json;q=0.5",
+        "application/json;q=0.9, application/vnd.msgpack",
+    ],
+)
+def test_wants_msgpack(accept: str) -> None:
+    assert wants_msgpack(accept)
+
+
+@pytest.mark.parametrize(
+    "accept",
+    [
+        None,
+        "",
+        "application/json",
+        "*/*",
+        # Equal qualities prefer JSON
+        "application/msgpack, */*",
+        "application/json, application/msgpack",
+        "application/msgpack;q=0.5, application/*;q=0.5",
+        "application/msgpack;q=0",
+    ],
+)
+def test_wants_json(accept: str | None) -> None:
+    assert not wants_msgpack(accept)
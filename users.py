@@ -17,7 +17,8 @@ import ispyb
 import sshtunnel
 
 from app.common import split_tas
-from app.remote_ispyb_connector import SSHConnector
+from app.config import Config
+from app.remote_ispyb_connector import DirectConnector, SSHConnector
 
 
 def error(msg: str) -> NoReturn:
@@ -71,7 +72,7 @@ print(f"     Visit: '{_VISIT_NUMBER}'")
 # for each request.
 _CONNECTOR: SSHConnector | None = None
 try:
-    _CONNECTOR = SSHConnector()
+    _CONNECTOR = DirectConnector() if Config.ISPYB_DIRECT else SSHConnector()
 except ispyb.ConnectionError:
     error("ISPyB connection failure (are the ISPyB credentials correct?)")
 except sshtunnel.BaseSSHTunnelForwarderError:
@@ -91,5 +92,4 @@ try:
         _VISIT_NUMBER,
     )
 finally:
-    if _CONNECTOR.server:
-        _CONNECTOR.server.stop()
+    _CONNECTOR.stop()